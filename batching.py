@@ -0,0 +1,85 @@
+import json
+import re
+
+from utils import estimate_tokens
+
+
+BATCH_PROMPT = """Improve this content.
+Don't comment on file names or other meta data, just the actual text.
+The <content> is in JSON format and maps file names to changed text snippets.
+Make sure to give very concise feedback per file.
+Start the feedback for each file with a line "### <file name>".
+Start each point about a specific line with "Line <number>:", counting from the
+first line number of its snippet, so it can be shown next to that line.
+"""
+
+
+def format_batch(batch):
+    """Serialize a batch of `{file: [snippet, ...]}` for the prompt."""
+    return json.dumps(
+        {
+            file: {
+                f"lines {s['start_line']}-{s['end_line']}": s["text"] for s in snippets
+            }
+            for file, snippets in batch.items()
+        },
+        indent=1,
+    )
+
+
+def plan_batches(content, max_tokens, model=None, overhead=0):
+    """Pack the snippets of several files into batches of at most `max_tokens`.
+
+    `content` maps file names to lists of snippets as returned by
+    `get_context_from_files`, and `overhead` is the number of tokens every
+    request spends on instructions. Files are kept whole where possible.
+    Files that don't fit into a batch on their own are split across batches
+    at snippet boundaries. Returns a list of `{file: [snippet, ...]}` dicts.
+    """
+    budget = max(max_tokens - overhead, 1)
+    batches = []
+    batch, batch_tokens = {}, 0
+
+    def flush():
+        nonlocal batch, batch_tokens
+        if batch:
+            batches.append(batch)
+        batch, batch_tokens = {}, 0
+
+    for file, snippets in content.items():
+        sizes = [estimate_tokens(format_batch({file: [s]}), model) for s in snippets]
+        file_tokens = sum(sizes)
+        if file_tokens <= budget:
+            if batch_tokens + file_tokens > budget:
+                flush()
+            batch[file] = list(snippets)
+            batch_tokens += file_tokens
+            continue
+        # Too large for a single batch: fill batches snippet by snippet.
+        for snippet, size in zip(snippets, sizes):
+            if batch and batch_tokens + size > budget:
+                flush()
+            batch.setdefault(file, []).append(snippet)
+            batch_tokens += size
+    flush()
+    return batches
+
+
+def parse_batch_answer(answer, files):
+    """Map a batched answer back to its files, based on the "### <file>" headers.
+
+    Text that can't be attributed to a single file is assigned to all
+    files of the batch jointly, under their comma-separated names.
+    """
+    files = list(files)
+    header = re.compile(r"^#+\s*`?(.+?)`?:?\s*$")
+    feedback = {}
+    current = ", ".join(files)
+    for line in answer.split("\n"):
+        match = header.match(line)
+        if match and match.group(1).strip() in files:
+            current = match.group(1).strip()
+            continue
+        feedback.setdefault(current, []).append(line)
+    feedback = {file: "\n".join(lines).strip() for file, lines in feedback.items()}
+    return {file: text for file, text in feedback.items() if text}
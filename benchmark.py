@@ -0,0 +1,520 @@
+"""End-to-end benchmark of the webhook pipeline against local stand-ins.
+
+Starts a fake GitHub API and a fake OpenAI-compatible endpoint on localhost,
+replays synthetic PRs of varying size through `process_webhook` and reports
+latency percentiles, time to the first feedback in the PR comment,
+throughput, requests per stage and tokens sent.
+
+Run with: python benchmark.py --runs 20 --concurrency 4 --llm-latency 0.5
+
+With --startup, it instead measures how long importing the app takes in a
+fresh interpreter, its peak memory, and whether it pulls in Ray.
+"""
+import argparse
+import asyncio
+import base64
+from collections import Counter
+from dataclasses import dataclass
+import difflib
+import hashlib
+import json
+import logging
+import math
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+import httpx
+import uvicorn
+
+from dispatcher import RateLimiter
+import main
+import utils
+from utils import TokenCache, estimate_tokens
+
+
+OWNER, REPO = "owner", "repo"
+# The model `review` uses by default.
+MODEL = "codellama/CodeLlama-34b-Instruct-hf"
+
+
+@dataclass
+class Scenario:
+    """Shape of the synthetic PRs of a benchmark scenario."""
+
+    name: str
+    files: int
+    hunks: int
+    lines: int
+    tree_size: int
+
+
+SCENARIOS = [
+    Scenario("small", files=2, hunks=1, lines=50, tree_size=10),
+    Scenario("medium", files=10, hunks=3, lines=200, tree_size=100),
+    Scenario("large", files=50, hunks=5, lines=500, tree_size=1000),
+]
+
+
+def make_pr(scenario, number):
+    """Build the files, tree and diff of a synthetic PR.
+
+    File contents include the PR number, so that different PRs don't share
+    cached suggestions.
+    """
+    files, diff = {}, []
+    for i in range(scenario.files):
+        path = f"docs/page_{i}.md"
+        old = [f"Line {j} of page {i} in PR {number}." for j in range(scenario.lines)]
+        new = list(old)
+        for h in reversed(range(scenario.hunks)):
+            position = (h + 1) * scenario.lines // (scenario.hunks + 1)
+            new.insert(position, f"Teh new paragraph {h} dosen't read well.")
+        files[path] = "\n".join(new)
+        diff.append(f"diff --git a/{path} b/{path}")
+        diff.extend(
+            line.rstrip("\n")
+            for line in difflib.unified_diff(old, new, f"a/{path}", f"b/{path}")
+        )
+    tree = dict(files)
+    for i in range(scenario.tree_size):
+        tree[f"src/module_{i}.md"] = f"Unchanged file {i}."
+    return {"files": tree, "diff": "\n".join(diff) + "\n", "head_sha": f"sha{number}"}
+
+
+def github_app(prs, counts):
+    """Fake GitHub API serving the synthetic PRs in `prs` by PR number."""
+    app = FastAPI()
+    blobs = {}
+
+    def pr_files(number):
+        return prs[int(number)]["files"]
+
+    @app.get("/raw/{owner}/{repo}/pull/{number}.diff")
+    async def diff(owner, repo, number):
+        counts["diff"] += 1
+        return PlainTextResponse(prs[int(number)]["diff"])
+
+    @app.get("/repos/{owner}/{repo}/pulls/{number}")
+    async def pull(owner, repo, number):
+        counts["pulls"] += 1
+        return {"head": {"ref": f"feature-{number}", "sha": prs[int(number)]["head_sha"]}}
+
+    @app.get("/repos/{owner}/{repo}/compare/{basehead}")
+    async def compare(owner, repo, basehead):
+        counts["compare"] += 1
+        return Response(status_code=404)
+
+    @app.get("/repos/{owner}/{repo}/contents/{path:path}")
+    async def contents(owner, repo, path, ref):
+        counts["contents"] += 1
+        number = ref[len("sha"):]
+        content = pr_files(number).get(path)
+        if content is None:
+            return Response(status_code=404)
+        return PlainTextResponse(content)
+
+    @app.get("/repos/{owner}/{repo}/git/trees/{ref}")
+    async def tree(owner, repo, ref):
+        counts["trees"] += 1
+        number = ref[len("sha"):]
+        items = []
+        for path, content in pr_files(number).items():
+            sha = hashlib.sha1(content.encode("utf-8")).hexdigest()
+            blobs[sha] = content
+            items.append({
+                "path": path,
+                "sha": sha,
+                "type": "blob",
+                "size": len(content),
+                "url": f"https://api.github.com/repos/{owner}/{repo}/git/blobs/{sha}",
+            })
+        return {"tree": items}
+
+    @app.get("/repos/{owner}/{repo}/git/blobs/{sha}")
+    async def blob(owner, repo, sha):
+        counts["blobs"] += 1
+        return {"content": base64.b64encode(blobs[sha].encode("utf-8")).decode()}
+
+    @app.post("/graphql")
+    async def graphql(request: Request):
+        counts["graphql"] += 1
+        variables = (await request.json())["variables"]
+        repository = {}
+        for alias, value in variables.items():
+            if alias.startswith("e"):
+                # Expressions look like "sha<PR number>:<path>".
+                sha, path = value.split(":", 1)
+                content = pr_files(sha[len("sha"):]).get(path)
+            elif alias.startswith("o"):
+                content = blobs.get(value)
+            else:
+                continue
+            repository[alias] = content and {
+                "text": content, "isBinary": False, "byteSize": len(content.encode("utf-8")),
+            }
+        return {"data": {"repository": repository}}
+
+    def record_feedback(number, body):
+        # Comments use the PR number as ID, and the fake LLM always says "Fix".
+        if "Fix" in body and "first_feedback" not in prs[int(number)]:
+            prs[int(number)]["first_feedback"] = time.perf_counter()
+
+    @app.post("/repos/{owner}/{repo}/issues/{number}/comments")
+    async def comment(owner, repo, number, request: Request):
+        counts["comments"] += 1
+        record_feedback(number, (await request.json())["body"])
+        url = f"https://api.github.com/repos/{owner}/{repo}/issues/comments/{number}"
+        return JSONResponse({"url": url}, status_code=201)
+
+    @app.patch("/repos/{owner}/{repo}/issues/comments/{comment_id}")
+    async def update_comment(owner, repo, comment_id, request: Request):
+        counts["comments"] += 1
+        record_feedback(comment_id, (await request.json())["body"])
+        return {}
+
+    @app.post("/repos/{owner}/{repo}/pulls/{number}/reviews")
+    async def create_review(owner, repo, number, request: Request):
+        counts["reviews"] += 1
+        review = await request.json()
+        record_feedback(number, review["body"] + "".join(c["body"] for c in review["comments"]))
+        return {"html_url": f"https://github.com/{owner}/{repo}/pull/{number}#review"}
+
+    return app
+
+
+ANSWER = "Fix the typos: 'Teh' and 'dosen't'."
+
+
+def llm_app(latency, completion_tokens, counts):
+    """Fake OpenAI-compatible chat completions endpoint.
+
+    Streamed answers are spread evenly over `latency` seconds.
+    """
+    app = FastAPI()
+
+    async def stream():
+        words = ANSWER.split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(latency / len(words))
+            chunk = {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion.chunk",
+                "choices": [{
+                    "index": 0,
+                    "delta": {"content": word if i == 0 else f" {word}"},
+                    "finish_reason": None,
+                }],
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+        prompt_tokens = sum(
+            estimate_tokens(m["content"], body["model"]) for m in body["messages"]
+        )
+        counts["llm_requests"] += 1
+        counts["prompt_tokens"] += prompt_tokens
+        counts["completion_tokens"] += completion_tokens
+        if body.get("stream"):
+            return StreamingResponse(stream(), media_type="text/event-stream")
+        await asyncio.sleep(latency)
+        return {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {
+                    "role": "assistant",
+                    "content": ANSWER,
+                },
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    return app
+
+
+def serve_locally(app):
+    """Run `app` on a free localhost port in a background thread."""
+    server = uvicorn.Server(
+        uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+class LocalTransport(httpx.AsyncHTTPTransport):
+    """Send every request to a local server, whatever its original host."""
+
+    def __init__(self, base_url, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = httpx.URL(base_url)
+
+    async def handle_async_request(self, request):
+        request.url = request.url.copy_with(
+            scheme=self.base_url.scheme,
+            host=self.base_url.host,
+            port=self.base_url.port,
+        )
+        return await super().handle_async_request(request)
+
+
+def comment_event(number):
+    """Payload of a `@docu-mentor run` comment on the PR."""
+    api = f"https://api.github.com/repos/{OWNER}/{REPO}"
+    return {
+        "action": "created",
+        "installation": {"id": 1},
+        "repository": {"full_name": f"{OWNER}/{REPO}"},
+        "issue": {
+            "html_url": f"https://github.com/{OWNER}/{REPO}/pull/{number}",
+            "pull_request": {"url": f"{api}/pulls/{number}"},
+        },
+        "comment": {
+            "body": "@docu-mentor run",
+            "user": {"login": "benchmark"},
+            "issue_url": f"{api}/issues/{number}",
+        },
+    }
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list."""
+    values = sorted(values)
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+async def run_scenario(scenario, prs, counts, runs, concurrency, first_number):
+    """Replay `runs` PRs of the scenario, `concurrency` at a time."""
+    counts.clear()
+    numbers = range(first_number, first_number + runs)
+    for number in numbers:
+        prs[number] = make_pr(scenario, number)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_feedback = [], []
+
+    async def replay(number):
+        async with semaphore:
+            start = time.perf_counter()
+            await main.process_webhook(comment_event(number))
+            latencies.append(time.perf_counter() - start)
+            first_feedback.append(prs[number].get("first_feedback", math.inf) - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(replay(number) for number in numbers))
+    elapsed = time.perf_counter() - start
+
+    github = {
+        stage: count / runs
+        for stage, count in sorted(counts.items())
+        if stage not in ("llm_requests", "prompt_tokens", "completion_tokens")
+    }
+    return {
+        "scenario": scenario.name,
+        "runs": runs,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "first_feedback_p50": percentile(first_feedback, 50),
+        "throughput": runs / elapsed,
+        "github_requests": github,
+        "llm_requests": counts["llm_requests"] / runs,
+        "prompt_tokens": counts["prompt_tokens"] / runs,
+        "completion_tokens": counts["completion_tokens"] / runs,
+    }
+
+
+def configure(settings):
+    """Set module attributes, given as `{(module, name): value}`, and return the previous values."""
+    previous = {(module, name): getattr(module, name) for module, name in settings}
+    for (module, name), value in settings.items():
+        setattr(module, name, value)
+    return previous
+
+
+async def run_benchmark(scenarios, args):
+    """Run the scenarios against local stand-ins, and restore the bot's settings afterwards."""
+    prs, counts = {}, Counter()
+    github, _, github_url = serve_locally(github_app(prs, counts))
+    llm, _, llm_url = serve_locally(
+        llm_app(args.llm_latency, args.completion_tokens, counts)
+    )
+
+    blob_cache_dir = tempfile.mkdtemp(prefix="docu-mentor-blobs-")
+    previous = configure({
+        (main.get_openai(), "api_base"): f"{llm_url}/v1",
+        (main.get_openai(), "api_key"): "benchmark",
+        # Ray workers would call the real endpoint, so keep all LLM calls in-process.
+        (main, "USE_RAY"): "false",
+        (main, "FETCH_WHOLE_TREE"): args.whole_tree,
+        (main, "STREAM_FEEDBACK"): args.stream,
+        (main, "token_cache"): TokenCache(
+            fetch=lambda installation_id: asyncio.sleep(0, ("token", time.time() + 3600))
+        ),
+        (main, "rate_limiter"): RateLimiter({
+            MODEL: {"rpm": args.llm_rpm, "tpm": args.llm_tpm, "concurrency": args.llm_concurrency}
+        }),
+        (utils, "GITHUB_FILES_API"): args.files_api,
+        (utils, "BLOB_CACHE"): args.blob_cache,
+        (utils, "BLOB_CACHE_DIR"): blob_cache_dir,
+        (utils, "_blob_cache"): None,
+        (utils, "_http_client"): httpx.AsyncClient(
+            transport=LocalTransport(
+                github_url,
+                limits=httpx.Limits(
+                    max_connections=utils.HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=utils.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                ),
+            ),
+            timeout=httpx.Timeout(utils.HTTP_TIMEOUT),
+        ),
+    })
+
+    results = []
+    try:
+        for i, scenario in enumerate(scenarios):
+            results.append(await run_scenario(
+                scenario, prs, counts, args.runs, args.concurrency, i * args.runs + 1
+            ))
+    finally:
+        await utils.close_http_client()
+        configure(previous)
+        shutil.rmtree(blob_cache_dir, ignore_errors=True)
+        github.should_exit = llm.should_exit = True
+    return results
+
+
+STARTUP_CODE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "ray": "ray" in sys.modules,
+    "openai": "openai" in sys.modules,
+}}))
+"""
+
+
+def measure_startup(module, runs=3):
+    """Import `module` in `runs` fresh interpreters and report the median import time."""
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_CODE.format(module=module)],
+            capture_output=True, text=True, check=True,
+        ).stdout
+        # The app may log to stdout as well.
+        samples.append(json.loads(output.strip().split("\n")[-1]))
+    samples.sort(key=lambda sample: sample["seconds"])
+    return {"module": module, "runs": runs, **samples[len(samples) // 2]}
+
+
+def format_startup(result):
+    return (
+        f"{result['module']:>8}: import {result['seconds']:.2f}s, "
+        + f"peak memory {result['peak_mb']:.0f} MB, "
+        + f"Ray imported: {'yes' if result['ray'] else 'no'}, "
+        + f"openai imported: {'yes' if result['openai'] else 'no'}"
+    )
+
+
+def format_result(result):
+    github = ", ".join(f"{k}={v:g}" for k, v in result["github_requests"].items())
+    return (
+        f"{result['scenario']:>8}: p50 {result['p50']:.3f}s, p99 {result['p99']:.3f}s, "
+        + f"first feedback p50 {result['first_feedback_p50']:.3f}s, "
+        + f"{result['throughput']:.2f} PRs/s | per PR: GitHub {github} | "
+        + f"LLM requests={result['llm_requests']:g}, "
+        + f"prompt tokens={result['prompt_tokens']:g}, "
+        + f"completion tokens={result['completion_tokens']:g}"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", action="append", choices=[s.name for s in SCENARIOS],
+                        help="Scenarios to run, all by default.")
+    parser.add_argument("--runs", type=int, default=10, help="PRs replayed per scenario, or imports with --startup.")
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="PRs processed at the same time.")
+    parser.add_argument("--llm-latency", type=float, default=0.2,
+                        help="Seconds the fake LLM takes per request.")
+    parser.add_argument("--completion-tokens", type=int, default=100,
+                        help="Completion tokens the fake LLM reports per request.")
+    parser.add_argument("--llm-rpm", type=int, default=100000,
+                        help="Requests per minute allowed by the rate limiter.")
+    parser.add_argument("--llm-tpm", type=int, default=100000000,
+                        help="Tokens per minute allowed by the rate limiter.")
+    parser.add_argument("--llm-concurrency", type=int, default=100,
+                        help="LLM requests in flight at the same time.")
+    parser.add_argument("--whole-tree", action="store_true",
+                        help="Fetch the whole repository tree, like FETCH_WHOLE_TREE.")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream answers into the comment, like STREAM_FEEDBACK.")
+    parser.add_argument("--blob-cache", choices=["tiered", "memory", "none"],
+                        default="memory", help="Blob cache, like BLOB_CACHE.")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure the import time of the app instead.")
+    parser.add_argument("--files-api", choices=["graphql", "rest"], default="graphql",
+                        help="How to fetch file contents, like GITHUB_FILES_API.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Show the bot's logs.")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    if args.startup:
+        results = [measure_startup(module, args.runs) for module in ["heroku", "main"]]
+        if args.json:
+            print(json.dumps(results, indent=2))
+        else:
+            for result in results:
+                print(format_startup(result))
+        return results
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    loggers = [logging.getLogger(), logging.getLogger("Docu Mentor")]
+    levels = [logger.level for logger in loggers]
+    if not args.verbose:
+        for logger in loggers:
+            logger.setLevel(logging.WARNING)
+    try:
+        results = asyncio.run(run_benchmark(scenarios, args))
+    finally:
+        for logger, level in zip(loggers, levels):
+            logger.setLevel(level)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(format_result(result))
+    return results
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,283 @@
+"""Offline review of a local git checkout, without GitHub.
+
+Reviews whole files, or only the changes between two refs, of a local
+checkout and writes the feedback to `results.jsonl` and `report.md` in the
+output directory. Results are appended as they come in, so running the
+same command again after an interruption only reviews what's missing.
+
+Run with: python bulk.py ../ray --path doc/ --output doc-review
+Or, for the changes of a release: python bulk.py ../ray --base ray-2.8.0 --head ray-2.9.0
+
+With --ray, the files are read, chunked and reviewed as a Ray Data pipeline
+that scales across the nodes of the cluster. This needs `pip install
+"ray[data]"`, and the checkout at the same path on all nodes, e.g. on a
+shared file system.
+--api-base points the reviews to another OpenAI-compatible endpoint, such
+as a local stub.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import subprocess
+
+from batching import BATCH_PROMPT
+import main
+from prefilter import prefilter
+from utils import MAX_FILE_SIZE, get_context_from_files, matches_filter, parse_diff_to_line_numbers
+
+logger = logging.getLogger("Docu Mentor")
+
+RESULTS_FILE = "results.jsonl"
+REPORT_FILE = "report.md"
+
+
+def git(root, *args):
+    return subprocess.run(
+        ["git", "-C", root, *args], capture_output=True, check=True
+    ).stdout
+
+
+def read_text(data):
+    """Decode file contents, or return None for binary or oversized files."""
+    if len(data) > MAX_FILE_SIZE or b"\0" in data[:8000]:
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+def list_files(root, paths=(), base=None, head=None):
+    """Return a row per file to review, with the checkout, its `file` and changed `lines`.
+
+    Without `base`, all tracked files are reviewed in full, which `whole`
+    says. With `base`, only the lines added between `base` and `head`, or
+    the working tree if `head` isn't given. `paths` filters the files like
+    the bot's comment does. The files themselves are read by `read_file`.
+    """
+    if base:
+        diff = git(root, "diff", "--no-color", "--no-ext-diff", base, *([head] if head else []))
+        files_with_lines = parse_diff_to_line_numbers(diff.decode("utf-8", errors="replace"))
+    else:
+        files_with_lines = {
+            file: None for file in git(root, "ls-files", "-z").decode("utf-8").split("\0") if file
+        }
+    return [
+        {"root": root, "head": head or "", "file": file, "lines": lines or [], "whole": lines is None}
+        for file, lines in files_with_lines.items()
+        if matches_filter(file, paths) and lines != []
+    ]
+
+
+def read_file(row, done=frozenset()):
+    """Read a listed file, and key it by its text and changed lines.
+
+    Returns a list with a row with the file's `text`, `lines` and `key`, or
+    none for binary files and files with a key in `done`, as Ray Data's
+    `flat_map` expects.
+    """
+    file = row["file"]
+    if row["head"]:
+        data = git(row["root"], "show", f"{row['head']}:{file}")
+    else:
+        with open(os.path.join(row["root"], file), "rb") as f:
+            data = f.read()
+    text = read_text(data)
+    if text is None:
+        return []
+    lines = list(range(len(text.split("\n")))) if row["whole"] else list(row["lines"])
+    key = hashlib.sha256(
+        json.dumps([main.SYSTEM_CONTENT, BATCH_PROMPT, file, text, lines]).encode("utf-8")
+    ).hexdigest()
+    if key in done:
+        return []
+    return [{"file": file, "text": text, "lines": lines, "key": key}]
+
+
+def chunk(row):
+    """Split a file into the snippets the model sees, dropping those the prefilter skips.
+
+    Returns a list with a single row, or none if nothing is left to review,
+    as Ray Data's `flat_map` expects.
+    """
+    file = row["file"]
+    files_with_lines = {file: list(row["lines"])}
+    snippets = get_context_from_files(
+        {file: row["text"]}, files_with_lines, max_tokens=main.MAX_SNIPPET_TOKENS
+    )
+    snippets, _ = prefilter(snippets, files_with_lines)
+    if not snippets.get(file):
+        return []
+    return [{"file": file, "key": row["key"], "snippets": json.dumps(snippets[file])}]
+
+
+class Reviewer:
+    """Review batches of chunked files with `routed_review`.
+
+    Works as the callable class of Ray Data's `map_batches`, and in-process.
+    LLM requests are always sent from the process itself, not by the
+    bot's mentor actors, so `api_base` applies and no actors outlive the
+    run. Each Ray Data actor has its own event loop, rate limiter and
+    suggestion cache, so the rate limits apply per actor. The tokens of a
+    batch are counted on its first file.
+    """
+
+    def __init__(self, repo="", api_base=None):
+        # The rate limiter and suggestion cache are then created in-process too.
+        main.USE_RAY = "false"
+        openai = main.get_openai()
+        if api_base:
+            openai.api_base = api_base
+        self.repo = repo
+        self.loop = asyncio.new_event_loop()
+
+    def __call__(self, batch):
+        files = list(batch["file"])
+        content = {file: json.loads(s) for file, s in zip(files, batch["snippets"])}
+        result = self.loop.run_until_complete(main.routed_review(content, self.repo))
+        first = [True] + [False] * (len(files) - 1)
+        return {
+            "file": files,
+            "key": list(batch["key"]),
+            "feedback": [result["feedback"].get(file, "") for file in files],
+            "failed": [file in result["failed_files"] for file in files],
+            "model": [result["model"]] * len(files),
+            "prompt_tokens": [result["prompt_tokens"] if f else 0 for f in first],
+            "completion_tokens": [result["completion_tokens"] if f else 0 for f in first],
+        }
+
+
+def review_rows(rows, batch_size, concurrency=1, use_ray=False, repo="", api_base=None,
+                done=frozenset()):
+    """Read, chunk and review the listed `rows`, yielding a result row per reviewed file.
+
+    Files with a key in `done` were reviewed before and are skipped.
+    """
+    if use_ray:
+        import ray.data
+
+        dataset = ray.data.from_items(rows).flat_map(
+            read_file, fn_kwargs={"done": done}
+        ).flat_map(chunk).map_batches(
+            Reviewer,
+            batch_size=batch_size,
+            compute=ray.data.ActorPoolStrategy(size=concurrency),
+            fn_constructor_kwargs={"repo": repo, "api_base": api_base},
+        )
+        yield from dataset.iter_rows()
+        return
+    reviewer = Reviewer(repo, api_base)
+    chunked = [c for row in rows for f in read_file(row, done) for c in chunk(f)]
+    for i in range(0, len(chunked), batch_size):
+        batch = chunked[i : i + batch_size]
+        result = reviewer({key: [c[key] for c in batch] for key in batch[0]})
+        for values in zip(*result.values()):
+            yield dict(zip(result, values))
+
+
+def load_results(path):
+    """Read the result rows of earlier runs, the latest one per file."""
+    results = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    # E.g. the last line of an interrupted run.
+                    continue
+                results[row["file"]] = row
+    return results
+
+
+def write_report(results, path):
+    """Write the feedback per file as Markdown."""
+    with open(path, "w") as f:
+        f.write("# Docu Mentor review\n\n")
+        for file, row in sorted(results.items()):
+            if row["feedback"]:
+                f.write(f"## {file}\n\n{row['feedback']}\n\n")
+        failed = sorted(file for file, row in results.items() if row["failed"])
+        if failed:
+            f.write("## Not reviewed\n\n" + "".join(f"- {file}\n" for file in failed))
+
+
+def run(root, output, paths=(), base=None, head=None, batch_size=10, concurrency=1,
+        use_ray=False, repo="", api_base=None):
+    """Review a checkout, resuming from the results in `output`. Returns a summary dict."""
+    os.makedirs(output, exist_ok=True)
+    results_path = os.path.join(output, RESULTS_FILE)
+    results = load_results(results_path)
+    rows = list_files(root, paths, base, head)
+    done = frozenset(row["key"] for row in results.values() if not row["failed"])
+    logger.info(f"Reviewing {len(rows)} files, {len(done)} reviewed before")
+    summary = {
+        "files": len(rows), "reviewed": 0, "failed": 0,
+        "prompt_tokens": 0, "completion_tokens": 0,
+    }
+    with open(results_path, "a") as f:
+        for row in review_rows(rows, batch_size, concurrency, use_ray, repo, api_base, done):
+            row = {
+                "file": str(row["file"]),
+                "key": str(row["key"]),
+                "feedback": str(row["feedback"]),
+                "failed": bool(row["failed"]),
+                "model": str(row["model"]),
+                "prompt_tokens": int(row["prompt_tokens"]),
+                "completion_tokens": int(row["completion_tokens"]),
+            }
+            f.write(json.dumps(row) + "\n")
+            f.flush()
+            results[row["file"]] = row
+            summary["failed" if row["failed"] else "reviewed"] += 1
+            summary["prompt_tokens"] += row["prompt_tokens"]
+            summary["completion_tokens"] += row["completion_tokens"]
+    # Files reviewed before, unchanged or with nothing to review.
+    summary["skipped"] = len(rows) - summary["reviewed"] - summary["failed"]
+    current = {row["file"] for row in rows}
+    write_report(
+        {file: row for file, row in results.items() if file in current},
+        os.path.join(output, REPORT_FILE),
+    )
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("root", help="Path of the local git checkout.")
+    parser.add_argument("--path", action="append", default=[],
+                        help="Only review files whose path contains this, like the bot's comment.")
+    parser.add_argument("--base", help="Only review the changes since this ref.")
+    parser.add_argument("--head", help="Ref to compare --base to, the working tree by default.")
+    parser.add_argument("--output", default="docu-mentor-review",
+                        help="Directory for results.jsonl and report.md.")
+    parser.add_argument("--batch-files", type=int, default=10,
+                        help="Files per review batch.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Reviewer actors with --ray.")
+    parser.add_argument("--ray", action="store_true", help="Run as a Ray Data pipeline.")
+    parser.add_argument("--repo", default="",
+                        help="Repository name, like owner/repo, for MODEL_ROUTES.")
+    parser.add_argument("--api-base", help="OpenAI-compatible endpoint to use instead.")
+    return parser.parse_args(argv)
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    if args.head and not args.base:
+        raise SystemExit("--head needs --base")
+    if not args.ray:
+        main.USE_RAY = "false"
+    summary = run(
+        args.root, args.output, args.path, args.base, args.head, args.batch_files,
+        args.concurrency, args.ray, args.repo, args.api_base,
+    )
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,184 @@
+import asyncio
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pickle
+import sys
+import tempfile
+import threading
+import time
+
+
+def cache_key(*parts):
+    """Return a stable hash of the given JSON-serializable parts."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class MemoryCache:
+    """In-process cache with LRU eviction and an optional time to live.
+
+    If `max_bytes` is set, entries are also evicted once their total size,
+    as measured by `sys.getsizeof`, exceeds it.
+    """
+
+    def __init__(self, max_entries=1000, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    async def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, created = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self._pop(key)
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def _pop(self, key):
+        value, _ = self.entries.pop(key)
+        self.size -= sys.getsizeof(value)
+
+    async def set(self, key, value):
+        if key in self.entries:
+            self._pop(key)
+        self.entries[key] = (value, time.time())
+        self.size += sys.getsizeof(value)
+        while len(self.entries) > self.max_entries or (
+            self.max_bytes is not None and self.size > self.max_bytes
+        ):
+            self._pop(next(iter(self.entries)))
+
+
+class DiskCache:
+    """On-disk cache with one file per entry, capped in total size.
+
+    Entries are evicted least recently used first. The sizes and order of
+    the entries are kept in memory, from a scan of the directory that's
+    repeated every `rescan_every` writes to pick up the entries of other
+    processes that share it, so writes don't need to scan the directory.
+    """
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024, ttl=None, rescan_every=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.rescan_every = rescan_every
+        self._entries = None
+        self._size = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        with self._lock:
+            if self._entries is not None and path in self._entries:
+                self._entries.move_to_end(path)
+        return value
+
+    def _set(self, key, value):
+        path = self._path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(value, f)
+                size = f.tell()
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self._writes += 1
+            if self._entries is None or self._writes % self.rescan_every == 0:
+                self._scan()
+            else:
+                self._size += size - self._entries.pop(path, 0)
+                self._entries[path] = size
+            self._evict()
+
+    def _scan(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        self._entries = OrderedDict((path, size) for _, size, path in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._entries:
+            path, size = self._entries.popitem(last=False)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._size -= size
+
+    async def get(self, key):
+        # Not asyncio.to_thread, which needs Python 3.9.
+        return await asyncio.get_running_loop().run_in_executor(None, self._get, key)
+
+    async def set(self, key, value):
+        await asyncio.get_running_loop().run_in_executor(None, self._set, key, value)
+
+
+class TieredCache:
+    """Cache that checks a fast tier first, then a larger, slower one.
+
+    Values found in the slow tier are copied to the fast tier, and new
+    values are written to both.
+    """
+
+    def __init__(self, fast, slow):
+        self.fast = fast
+        self.slow = slow
+
+    async def get(self, key):
+        value = await self.fast.get(key)
+        if value is None:
+            value = await self.slow.get(key)
+            if value is not None:
+                await self.fast.set(key, value)
+        return value
+
+    async def set(self, key, value):
+        await self.fast.set(key, value)
+        await self.slow.set(key, value)
+
+
+class ActorCache:
+    """Cache backed by a Ray actor that exposes `get` and `set` methods."""
+
+    def __init__(self, actor):
+        self.actor = actor
+
+    async def get(self, key):
+        return await self.actor.get.remote(key)
+
+    async def set(self, key, value):
+        await self.actor.set.remote(key, value)
@@ -0,0 +1,158 @@
+import asyncio
+from dotenv import load_dotenv
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+from metrics import count, span
+
+load_dotenv()
+
+logger = logging.getLogger("Docu Mentor")
+
+# Default limits per model. Override them for specific models with a JSON
+# object like {"model name": {"rpm": 60, "tpm": 100000, "concurrency": 10}}.
+LLM_RPM = int(os.environ.get("LLM_RPM", 60))
+LLM_TPM = int(os.environ.get("LLM_TPM", 100000))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 10))
+LLM_RATE_LIMITS = json.loads(os.environ.get("LLM_RATE_LIMITS", "{}"))
+
+# Retries and timeout of a single LLM request.
+LLM_MAX_RETRIES = int(os.environ.get("LLM_MAX_RETRIES", 3))
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", 120))
+LLM_BACKOFF_BASE = float(os.environ.get("LLM_BACKOFF_BASE", 1))
+LLM_BACKOFF_MAX = float(os.environ.get("LLM_BACKOFF_MAX", 30))
+
+
+class TokenBucket:
+    """Token bucket that refills `rate` tokens per minute, up to `rate` tokens."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        # Requests larger than the bucket would never fit, so cap them.
+        amount = min(amount, self.rate)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated) * self.rate / 60
+                )
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) * 60 / self.rate)
+
+
+class RateLimiter:
+    """Per-model limits on requests per minute, tokens per minute and concurrency."""
+
+    def __init__(self, limits=None):
+        self.limits = LLM_RATE_LIMITS if limits is None else limits
+        self.models = {}
+
+    def _get(self, model):
+        if model not in self.models:
+            limits = self.limits.get(model, {})
+            self.models[model] = (
+                TokenBucket(limits.get("rpm", LLM_RPM)),
+                TokenBucket(limits.get("tpm", LLM_TPM)),
+                asyncio.Semaphore(limits.get("concurrency", LLM_MAX_CONCURRENCY)),
+            )
+        return self.models[model]
+
+    async def acquire(self, model, tokens):
+        """Wait until a request of `tokens` tokens may be sent to `model`."""
+        requests, token_bucket, semaphore = self._get(model)
+        await semaphore.acquire()
+        try:
+            await requests.acquire()
+            await token_bucket.acquire(tokens)
+        except BaseException:
+            semaphore.release()
+            raise
+
+    async def release(self, model):
+        """Mark a request to `model` as done."""
+        self._get(model)[2].release()
+
+
+class ActorRateLimiter:
+    """Rate limiter backed by a Ray actor, to share limits across the cluster."""
+
+    def __init__(self, actor):
+        self.actor = actor
+
+    async def acquire(self, model, tokens):
+        await self.actor.acquire.remote(model, tokens)
+
+    async def release(self, model):
+        await self.actor.release.remote(model)
+
+
+def is_retryable(error):
+    """Whether an LLM request that failed with `error` is worth retrying."""
+    # Errors raised in Ray tasks wrap the original exception.
+    error = getattr(error, "cause", None) or error
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    # If openai wasn't even imported, the error can't come from it.
+    openai = sys.modules.get("openai")
+    if openai is None:
+        return False
+    if isinstance(error, (
+        openai.error.RateLimitError,
+        openai.error.ServiceUnavailableError,
+        openai.error.APIConnectionError,
+        openai.error.Timeout,
+        openai.error.TryAgain,
+    )):
+        return True
+    if isinstance(error, openai.error.APIError):
+        return (error.http_status or 500) >= 500
+    return False
+
+
+def backoff_delay(attempt, base=LLM_BACKOFF_BASE, maximum=LLM_BACKOFF_MAX):
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
+
+
+async def dispatch(
+        call,
+        limiter,
+        model,
+        tokens,
+        retries=LLM_MAX_RETRIES,
+        timeout=LLM_TIMEOUT,
+    ):
+    """Run `call()` under the rate limits of `model`, retrying transient errors.
+
+    `call` is a function returning a new awaitable for each attempt, and
+    `tokens` is the estimated number of tokens of the request. Each attempt
+    is cancelled after `timeout` seconds.
+    """
+    for attempt in range(retries + 1):
+        with span("rate_limit"):
+            await limiter.acquire(model, tokens)
+        try:
+            count("llm_requests")
+            with span("llm_request"):
+                return await asyncio.wait_for(call(), timeout)
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            count("llm_retries")
+            delay = backoff_delay(attempt)
+            logger.info(f"Request to {model} failed ({e!r}), retrying in {delay:.1f}s")
+        finally:
+            await limiter.release(model)
+        await asyncio.sleep(delay)
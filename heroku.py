@@ -1,31 +1,83 @@
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
 from dotenv import load_dotenv
+import asyncio
+import httpx
 import os
 import logging
 import sys
-import json
-import requests
 
-from fastapi import FastAPI, Request
+from fastapi import Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
 
-from main import handle_webhook
+from dispatcher import backoff_delay
+from main import create_app, dropped_response, event_router
+from utils import HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS
 
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logger = logging.getLogger("Docu Mentor")
 load_dotenv()
 
-
-load_dotenv()
-
 ANYSCALE_TOKEN = os.environ.get("ANYSCALE_TOKEN")
 ANYSCALE_SERVICE_URL = os.environ.get("BASE_URL")
 
-
-app = FastAPI()
+# Timeout (in seconds) and retries of requests forwarded to the Anyscale service.
+FORWARD_TIMEOUT = float(os.environ.get("FORWARD_TIMEOUT", 10))
+FORWARD_RETRIES = int(os.environ.get("FORWARD_RETRIES", 3))
+FORWARD_BACKOFF_BASE = float(os.environ.get("FORWARD_BACKOFF_BASE", 0.5))
+
+# The delivery ID lets the service drop duplicates, which makes retries safe.
+FORWARDED_HEADERS = [
+    "Content-Type", "X-GitHub-Delivery", "X-GitHub-Event", "X-Hub-Signature-256",
+]
+RETRY_STATUS_CODES = {502, 503, 504}
+
+_forward_client = None
+
+
+def get_forward_client():
+    """Return the pooled HTTP client for requests to the Anyscale service."""
+    global _forward_client
+    if _forward_client is None or _forward_client.is_closed:
+        _forward_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(FORWARD_TIMEOUT),
+        )
+    return _forward_client
+
+
+async def forward(url, body, headers):
+    """POST `body` to `url`, retrying connection errors and unavailable upstreams.
+
+    Returns the open, streamed response of the last attempt, which the
+    caller has to close.
+    """
+    client = get_forward_client()
+    for attempt in range(FORWARD_RETRIES + 1):
+        last = attempt == FORWARD_RETRIES
+        try:
+            response = await client.send(
+                client.build_request("POST", url, content=body, headers=headers),
+                stream=True,
+            )
+        except httpx.TransportError as e:
+            if last:
+                raise
+            logger.info(f"Forwarding to {url} failed: {e!r}, retrying")
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or last:
+                return response
+            await response.aclose()
+            logger.info(f"Forwarding to {url} got {response.status_code}, retrying")
+        await asyncio.sleep(backoff_delay(attempt, base=FORWARD_BACKOFF_BASE))
+
+
+# The bot's own routes, with the job queue running in this process.
+app = create_app()
 
 app.add_middleware(
     CORSMiddleware,
@@ -38,22 +90,33 @@ app.add_middleware(
 )
 
 
-@app.post("/query")
-async def handle_query(request: Request):
-    data = await request.json()
-    headers = {"Authorization": f"Bearer {ANYSCALE_TOKEN}"}
+@app.on_event("shutdown")
+async def shutdown():
+    if _forward_client is not None:
+        await _forward_client.aclose()
 
-    res = requests.post(f"{ANYSCALE_SERVICE_URL}/webhook/", headers=headers, json=data)
-    content = json.loads(res.content)
-
-    return JSONResponse(content=content, status_code=200)
-
-
-@app.get("/")
-async def root():
-    return {"message": "Docu Mentor reporting for duty!"}
 
+@app.post("/query")
+async def handle_query(request: Request):
+    """Forward a webhook delivery to the Anyscale service and pass its answer through."""
+    body = await request.body()
+    # Don't bother the service with deliveries it would drop anyway.
+    reason, data = event_router.route(request.headers, body)
+    if data is None:
+        return dropped_response(reason)
+    headers = {k: request.headers[k] for k in FORWARDED_HEADERS if k in request.headers}
+    headers["Authorization"] = f"Bearer {ANYSCALE_TOKEN}"
+
+    try:
+        res = await forward(f"{ANYSCALE_SERVICE_URL}/webhook/", body, headers)
+    except httpx.TransportError as e:
+        logger.info(f"Anyscale service unreachable: {e!r}")
+        return JSONResponse(content={"status": "unreachable"}, status_code=502)
+
+    return StreamingResponse(
+        res.aiter_bytes(),
+        status_code=res.status_code,
+        media_type=res.headers.get("Content-Type"),
+        background=BackgroundTask(res.aclose),
+    )
 
-@app.post("/webhook/")
-async def handle_webhook_route(request: Request):
-   return await handle_webhook(request)
@@ -0,0 +1,145 @@
+import asyncio
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+import logging
+import os
+import time
+
+load_dotenv()
+
+logger = logging.getLogger("Docu Mentor")
+
+# Maximum number of webhook jobs waiting to be processed.
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 100))
+# Number of background workers processing jobs.
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+# Maximum number of jobs processed at the same time for a single repository.
+JOB_MAX_PER_REPO = int(os.environ.get("JOB_MAX_PER_REPO", 2))
+# Number of recent delivery IDs remembered to drop redeliveries.
+JOB_DEDUP_SIZE = int(os.environ.get("JOB_DEDUP_SIZE", 1000))
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """Bounded queue of webhook jobs processed by background asyncio workers.
+
+    `handler` is a coroutine function that takes the webhook payload. Jobs
+    are deduplicated by delivery ID, and at most `max_per_repo` jobs run
+    concurrently for the same repository. Jobs of a repository without a
+    free slot wait in a queue of their own, so they don't hold up workers
+    that could process jobs of other repositories.
+    """
+
+    def __init__(
+            self,
+            handler,
+            max_size=JOB_QUEUE_SIZE,
+            num_workers=JOB_WORKERS,
+            max_per_repo=JOB_MAX_PER_REPO,
+            dedup_size=JOB_DEDUP_SIZE,
+        ):
+        self.handler = handler
+        self.max_size = max_size
+        self.num_workers = num_workers
+        self.max_per_repo = max_per_repo
+        self.dedup_size = dedup_size
+        # Jobs that can start right away, and the jobs waiting for a slot of
+        # their repository. Repositories are dropped from both dicts when idle.
+        self.queue = None
+        self.workers = []
+        self.active = {}
+        self.waiting = {}
+        self.seen = OrderedDict()
+        self.pending = OrderedDict()
+        self.processed = 0
+        self.failed = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    def start(self):
+        """Start the workers. Must be called from within the event loop."""
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        if not self.workers:
+            self.workers = [
+                asyncio.ensure_future(self._work()) for _ in range(self.num_workers)
+            ]
+
+    async def stop(self):
+        """Cancel the workers. Jobs still in the queue are dropped."""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    def submit(self, delivery_id, repo, data):
+        """Enqueue a job and return False if the delivery was already seen.
+
+        Raises `QueueFull` if the queue has no room left.
+        """
+        self.start()
+        if delivery_id and delivery_id in self.seen:
+            self.duplicates += 1
+            return False
+        if len(self.pending) >= self.max_size:
+            self.rejected += 1
+            raise QueueFull(f"Job queue is full ({self.max_size} jobs).")
+        job_id = delivery_id or object()
+        job = (job_id, repo, data)
+        if self.active.get(repo, 0) < self.max_per_repo:
+            self.active[repo] = self.active.get(repo, 0) + 1
+            self.queue.put_nowait(job)
+        else:
+            self.waiting.setdefault(repo, deque()).append(job)
+        self.pending[job_id] = time.monotonic()
+        if delivery_id:
+            self.seen[delivery_id] = True
+            if len(self.seen) > self.dedup_size:
+                self.seen.popitem(last=False)
+        return True
+
+    def stats(self):
+        """Return queue depth, age of the oldest pending job and job counters."""
+        oldest = next(iter(self.pending.values()), None)
+        return {
+            "depth": len(self.pending),
+            "oldest_age": time.monotonic() - oldest if oldest is not None else 0.0,
+            "processed": self.processed,
+            "failed": self.failed,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+        }
+
+    def _release(self, repo):
+        """Hand the repository's slot to its next waiting job, or free it."""
+        waiting = self.waiting.get(repo)
+        if waiting:
+            self.queue.put_nowait(waiting.popleft())
+            if not waiting:
+                del self.waiting[repo]
+        elif self.active[repo] > 1:
+            self.active[repo] -= 1
+        else:
+            del self.active[repo]
+
+    async def _work(self):
+        while True:
+            job_id, repo, data = await self.queue.get()
+            try:
+                wait = time.monotonic() - self.pending.pop(job_id)
+                logger.info(f"Processing job for {repo} after {wait:.2f}s in queue")
+                await self.handler(data)
+                self.processed += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.failed += 1
+                logger.exception(f"Job for {repo} failed")
+            finally:
+                self.pending.pop(job_id, None)
+                # Before task_done, so that joining the queue waits for waiting jobs too.
+                self._release(repo)
+                self.queue.task_done()
@@ -1,23 +1,37 @@
+import asyncio
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
-import httpx
 from dotenv import load_dotenv
+import functools
+import inspect
 import os
-import openai
 import logging
-import string
 import sys
-import ray
-from ray import serve
+import time
+import httpx
 
+from batching import BATCH_PROMPT, format_batch, parse_batch_answer, plan_batches
+from cache import ActorCache, DiskCache, MemoryCache, cache_key
+from dispatcher import ActorRateLimiter, RateLimiter, dispatch
+from jobs import JobQueue, QueueFull
+from metrics import count, record_duration, span, trace_delivery
+from prefilter import prefilter
+from reviews import anchor_feedback, post_review, split_text
+from router import BOT_LOGIN, MENTION, EventRouter, clean_comment
+from routing import REVIEW_MODEL, TRIAGE_PROMPT, is_clean, route_for
 from utils import (
-    generate_jwt,
-    get_installation_access_token,
+    FileBudget,
+    TokenCache,
     get_diff_url,
     get_branch_files,
-    get_pr_head_branch,
-    parse_diff_to_line_numbers,
+    get_changed_files,
+    get_compare_diff_url,
+    get_pr_head,
+    aiter_diff_files,
     get_context_from_files,
+    get_http_client,
+    close_http_client,
+    estimate_tokens,
 )
 
 
@@ -52,8 +66,53 @@ APP_ID = os.environ.get("APP_ID")
 PRIVATE_KEY = os.environ.get("PRIVATE_KEY", "")
 
 ANYSCALE_API_ENDPOINT = "https://api.endpoints.anyscale.com/v1"
-openai.api_base = ANYSCALE_API_ENDPOINT
-openai.api_key = os.environ.get("ANYSCALE_API_KEY")
+
+# Whether to send LLM requests and share state through Ray: "auto" uses Ray if
+# the app already runs in a Ray cluster, e.g. on Ray Serve, "true" starts or
+# connects to a cluster on first use, and "false" keeps everything in-process.
+USE_RAY = os.environ.get("USE_RAY", "auto").lower()
+
+# Set to "true" to download the whole repository tree instead of only
+# the files changed in the PR.
+FETCH_WHOLE_TREE = os.environ.get("FETCH_WHOLE_TREE", "false").lower() == "true"
+
+# Set to "true" to share installation access tokens across Serve replicas.
+SHARE_TOKEN_CACHE = os.environ.get("SHARE_TOKEN_CACHE", "false").lower() == "true"
+
+# Changed ranges estimated at more tokens than this are split into several snippets.
+MAX_SNIPPET_TOKENS = int(os.environ.get("MAX_SNIPPET_TOKENS", 1000))
+
+# Maximum number of prompt tokens per LLM request when batching files.
+MAX_BATCH_TOKENS = int(os.environ.get("MAX_BATCH_TOKENS", 4000))
+
+# Cache for LLM suggestions: "memory", "ray" (shared actor), "disk" or "none".
+SUGGESTION_CACHE = os.environ.get("SUGGESTION_CACHE", "memory").lower()
+SUGGESTION_CACHE_SIZE = int(os.environ.get("SUGGESTION_CACHE_SIZE", 1000))
+SUGGESTION_CACHE_TTL = int(os.environ.get("SUGGESTION_CACHE_TTL", 24 * 60 * 60))
+SUGGESTION_CACHE_DIR = os.environ.get("SUGGESTION_CACHE_DIR", ".cache/suggestions")
+
+# Set to "true" to post a comment right away and update it while the answers
+# stream in, at most once every STREAM_UPDATE_INTERVAL seconds.
+STREAM_FEEDBACK = os.environ.get("STREAM_FEEDBACK", "false").lower() == "true"
+STREAM_UPDATE_INTERVAL = float(os.environ.get("STREAM_UPDATE_INTERVAL", 2))
+
+# Where to post the results: "review" posts a pull request review with comments
+# on the lines the feedback is about, "comment" keeps a single PR comment updated.
+REVIEW_OUTPUT = os.environ.get("REVIEW_OUTPUT", "review").lower()
+
+# Number of long-lived mentor actors that send LLM requests when Ray is initialized,
+# the requests each handles at once, and the size of each actor's answer cache.
+# Set MENTOR_POOL_SIZE to 0 to send each request as a separate Ray task instead.
+MENTOR_POOL_SIZE = int(os.environ.get("MENTOR_POOL_SIZE", 4))
+MENTOR_CONCURRENCY = int(os.environ.get("MENTOR_CONCURRENCY", 16))
+MENTOR_CACHE_SIZE = int(os.environ.get("MENTOR_CACHE_SIZE", 1000))
+
+# Store of the last reviewed head SHA, hunks and comment of each PR, used to
+# only review new changes on later runs: "memory", "ray", "disk" or "none".
+REVIEW_STATE = os.environ.get("REVIEW_STATE", "memory").lower()
+REVIEW_STATE_SIZE = int(os.environ.get("REVIEW_STATE_SIZE", 1000))
+REVIEW_STATE_TTL = int(os.environ.get("REVIEW_STATE_TTL", 30 * 24 * 60 * 60))
+REVIEW_STATE_DIR = os.environ.get("REVIEW_STATE_DIR", ".cache/reviews")
 
 
 SYSTEM_CONTENT = """You are a helpful assistant.
@@ -73,77 +132,976 @@ The <content> will be in JSON format and contains file name keys and text values
 Make sure to give very concise feedback per file.
 """
 
+openai = None
+
+
+def get_openai():
+    """Import the openai module and point it to Anyscale Endpoints on first use."""
+    global openai
+    if openai is None:
+        import openai as module
+        module.api_base = ANYSCALE_API_ENDPOINT
+        module.api_key = os.environ.get("ANYSCALE_API_KEY")
+        openai = module
+    return openai
+
+
+_ray_init_failed = False
+
+
+def get_ray():
+    """Return the ray module if Ray is used, or None to keep everything in-process."""
+    global _ray_init_failed
+    if USE_RAY == "false" or _ray_init_failed:
+        return None
+    if USE_RAY == "auto":
+        # If Ray wasn't even imported, the app doesn't run in a Ray cluster.
+        ray = sys.modules.get("ray")
+        return ray if ray is not None and ray.is_initialized() else None
+    import ray
+    if not ray.is_initialized():
+        try:
+            ray.init()
+        except Exception as e:
+            logger.info(f"Ray init failed: {e!r}")
+            _ray_init_failed = True
+            return None
+    return ray
+
+
+@functools.lru_cache(maxsize=None)
+def as_remote(function_or_class):
+    """The Ray task or actor class of a function or class, created on first use."""
+    import ray
+    return ray.remote(function_or_class)
+
+
+def actor_name(cls, name, *args, **options):
+    """Name of a shared actor, versioned by its code and configuration.
+
+    Replicas with changed code or settings get new actors instead of the
+    ones of the previous deployment.
+    """
+    try:
+        source = inspect.getsource(cls)
+    except (OSError, TypeError):
+        source = cls.__qualname__
+    version = cache_key(source, repr(args), repr(sorted(options.items())))[:12]
+    return f"docu-mentor-{name}-{version}"
+
+
+class SharedActor:
+    """Named actor that all Serve replicas share, created by the first one that needs it.
+
+    The actor isn't detached, so it goes away with the replica that created
+    it, at the latest when the deployment does. Calls to an actor that's
+    gone create it again, owned by the calling replica. Methods are called
+    like on an actor handle, with `await actor.method.remote(...)`.
+    """
+
+    def __init__(self, cls, name, *args, **options):
+        self.cls = cls
+        self.args = args
+        self.options = options
+        self.name = actor_name(cls, name, *args, **options)
+        self._handle = None
+
+    def handle(self):
+        if self._handle is None:
+            self._handle = as_remote(self.cls).options(
+                name=self.name, namespace="docu-mentor", get_if_exists=True, **self.options
+            ).remote(*self.args)
+        return self._handle
+
+    async def call(self, method, *args):
+        import ray
+        try:
+            return await getattr(self.handle(), method).remote(*args)
+        except ray.exceptions.RayActorError:
+            logger.info(f"Actor {self.name} is gone, creating it again")
+            self._handle = None
+            return await getattr(self.handle(), method).remote(*args)
+
+    def __getattr__(self, method):
+        return SharedActorMethod(self, method)
+
+
+class SharedActorMethod:
+    def __init__(self, actor, method):
+        self.actor = actor
+        self.method = method
+
+    def remote(self, *args):
+        return self.actor.call(self.method, *args)
+
+
+def chat_messages(content, system_content, prompt):
+    return [
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": f"This is the content: {content}. {prompt}"},
+    ]
+
+
+def parse_completion(result, model):
+    usage = result.get("usage")
+    prompt_tokens = usage.get("prompt_tokens")
+    completion_tokens = usage.get("completion_tokens")
+    content = result["choices"][0]["message"]["content"]
+
+    return content, model, prompt_tokens, completion_tokens
+
+
 def mentor(
         content,
-        model="codellama/CodeLlama-34b-Instruct-hf",
+        model=REVIEW_MODEL,
         system_content=SYSTEM_CONTENT,
         prompt=PROMPT
     ):
-    result = openai.ChatCompletion.create(
+    result = get_openai().ChatCompletion.create(
         model=model,
-        messages=[
-            {"role": "system", "content": system_content},
-            {"role": "user", "content": f"This is the content: {content}. {prompt}"},
-        ],
+        messages=chat_messages(content, system_content, prompt),
         temperature=0,
     )
-    usage = result.get("usage")
-    prompt_tokens = usage.get("prompt_tokens")
-    completion_tokens = usage.get("completion_tokens")
-    content = result["choices"][0]["message"]["content"]
+    return parse_completion(result, model)
 
-    return content, model, prompt_tokens, completion_tokens
 
-try:
-    ray.init()
-except:
-    logger.info("Ray init failed.")
+async def amentor(
+        content,
+        model=REVIEW_MODEL,
+        system_content=SYSTEM_CONTENT,
+        prompt=PROMPT
+    ):
+    """Like `mentor`, but doesn't block the event loop while waiting for the model."""
+    result = await get_openai().ChatCompletion.acreate(
+        model=model,
+        messages=chat_messages(content, system_content, prompt),
+        temperature=0,
+    )
+    return parse_completion(result, model)
+
+
+async def amentor_stream(
+        content,
+        model=REVIEW_MODEL,
+        system_content=SYSTEM_CONTENT,
+        prompt=PROMPT,
+        on_text=None,
+    ):
+    """Like `amentor`, but streams the answer and calls `on_text` with the text so far.
+
+    Streamed responses don't report token usage, so it's estimated.
+    """
+    messages = chat_messages(content, system_content, prompt)
+    chunks = await get_openai().ChatCompletion.acreate(
+        model=model,
+        messages=messages,
+        temperature=0,
+        stream=True,
+    )
+    text = ""
+    async for chunk in chunks:
+        delta = chunk["choices"][0].get("delta", {}).get("content")
+        if delta:
+            text += delta
+            if on_text:
+                on_text(text)
+    prompt_tokens = sum(estimate_tokens(m["content"], model) for m in messages)
+    return text, model, prompt_tokens, estimate_tokens(text, model)
 
 
-@ray.remote
 def mentor_task(content, model, system_content, prompt):
-    return mentor(content, model, system_content, prompt)
+    # Compared to the "llm_request" stage, this leaves out queueing in Ray.
+    with span("llm_task"):
+        return mentor(content, model, system_content, prompt)
+
+
+class MentorActor:
+    """Long-lived worker that sends LLM requests over a persistent connection pool.
+
+    Answers are cached locally, so repeated requests don't reach the model.
+    """
+
+    def __init__(self, cache_size, cache_ttl):
+        self.session = None
+        self.cache = MemoryCache(cache_size, cache_ttl)
+        self.pending = 0
+        self.requests = 0
+        self.cache_hits = 0
+
+    async def mentor(self, content, model, system_content, prompt):
+        key = cache_key(model, system_content, prompt, content)
+        cached = await self.cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            # Cached answers didn't cost any tokens this time.
+            return cached[0], model, 0, 0
+        if self.session is None:
+            import aiohttp
+            self.session = aiohttp.ClientSession()
+        # Without a session, openai opens a new connection for every request.
+        get_openai().aiosession.set(self.session)
+        self.pending += 1
+        self.requests += 1
+        try:
+            with span("llm_task"):
+                result = await amentor(content, model, system_content, prompt)
+        finally:
+            self.pending -= 1
+        await self.cache.set(key, result)
+        return result
+
+    def stats(self):
+        return {"pending": self.pending, "requests": self.requests, "cache_hits": self.cache_hits}
+
+
+class MentorPool:
+    """Sends each request to the least loaded of a fixed set of mentor actors.
+
+    The load of an actor is the number of this caller's requests that are
+    still in flight on it. `stats` reports the queue depth of each actor
+    across all callers.
+    """
+
+    def __init__(self, actors):
+        self.actors = actors
+        self.in_flight = [[] for _ in actors]
+
+    def submit(self, content, model, system_content, prompt):
+        import ray
+        for refs in self.in_flight:
+            if refs:
+                _, refs[:] = ray.wait(refs, num_returns=len(refs), timeout=0)
+        index = min(range(len(self.actors)), key=lambda i: len(self.in_flight[i]))
+        ref = self.actors[index].mentor.remote(content, model, system_content, prompt)
+        self.in_flight[index].append(ref)
+        return ref
+
+    async def stats(self):
+        return await asyncio.gather(*(actor.stats.remote() for actor in self.actors))
+
+
+mentor_pool = None
+
+
+def get_mentor_pool():
+    """Return the pool of mentor actors, or None without Ray or if the pool is disabled."""
+    global mentor_pool
+    if mentor_pool is None and MENTOR_POOL_SIZE > 0 and get_ray():
+        # Named actors are shared by all Serve replicas.
+        actors = [
+            SharedActor(
+                MentorActor, f"mentor-{i}", MENTOR_CACHE_SIZE, SUGGESTION_CACHE_TTL,
+                max_concurrency=MENTOR_CONCURRENCY,
+            ).handle()
+            for i in range(MENTOR_POOL_SIZE)
+        ]
+        mentor_pool = MentorPool(actors)
+    return mentor_pool
+
+
+def submit_mentor(content, model, system_content, prompt):
+    """Start a request in the mentor pool, or as a Ray task if the pool is disabled."""
+    pool = get_mentor_pool()
+    if pool:
+        return pool.submit(content, model, system_content, prompt)
+    return as_remote(mentor_task).remote(content, model, system_content, prompt)
+
+
+async def call_model(content, model, system_content, prompt):
+    """Send a single request to the model, through Ray if Ray is used."""
+    ray = get_ray()
+    if ray is None:
+        return await amentor(content, model, system_content, prompt)
+    global mentor_pool
+    for attempt in range(2):
+        ref = submit_mentor(content, model, system_content, prompt)
+        try:
+            return await ref
+        except asyncio.CancelledError:
+            ray.cancel(ref)
+            raise
+        except ray.exceptions.RayActorError:
+            if attempt or mentor_pool is None:
+                raise
+            # The replica that created the mentor actors is gone, look them up again.
+            logger.info("A mentor actor is gone, creating the pool again")
+            mentor_pool = None
 
-def ray_mentor(
+
+class RateLimiterActor:
+    """LLM rate limits shared by the whole cluster."""
+
+    def __init__(self):
+        self.limiter = RateLimiter()
+
+    async def acquire(self, model, tokens):
+        await self.limiter.acquire(model, tokens)
+
+    async def release(self, model):
+        await self.limiter.release(model)
+
+
+rate_limiter = None
+
+
+def get_rate_limiter():
+    """Return the LLM rate limiter, shared across the cluster if Ray is initialized."""
+    global rate_limiter
+    if rate_limiter is None:
+        if get_ray():
+            rate_limiter = ActorRateLimiter(SharedActor(RateLimiterActor, "rate-limiter"))
+        else:
+            rate_limiter = RateLimiter()
+    return rate_limiter
+
+
+class CacheActor:
+    """In-memory cache shared by all Serve replicas."""
+
+    def __init__(self, max_entries, ttl):
+        self.cache = MemoryCache(max_entries, ttl)
+
+    async def get(self, key):
+        return await self.cache.get(key)
+
+    async def set(self, key, value):
+        await self.cache.set(key, value)
+
+
+suggestion_cache = None
+
+
+def get_suggestion_cache():
+    """Return the configured suggestion cache, or None if caching is disabled."""
+    global suggestion_cache
+    if suggestion_cache is None:
+        if SUGGESTION_CACHE == "ray" and get_ray():
+            suggestion_cache = ActorCache(SharedActor(
+                CacheActor, "suggestion-cache", SUGGESTION_CACHE_SIZE, SUGGESTION_CACHE_TTL
+            ))
+        elif SUGGESTION_CACHE == "disk":
+            suggestion_cache = DiskCache(SUGGESTION_CACHE_DIR, ttl=SUGGESTION_CACHE_TTL)
+        elif SUGGESTION_CACHE != "none":
+            suggestion_cache = MemoryCache(SUGGESTION_CACHE_SIZE, SUGGESTION_CACHE_TTL)
+    return suggestion_cache
+
+
+review_state = None
+
+
+def get_review_state():
+    """Return the store of previous reviews per PR, or None if it's disabled."""
+    global review_state
+    if review_state is None:
+        if REVIEW_STATE == "ray" and get_ray():
+            review_state = ActorCache(SharedActor(
+                CacheActor, "review-state", REVIEW_STATE_SIZE, REVIEW_STATE_TTL
+            ))
+        elif REVIEW_STATE == "disk":
+            review_state = DiskCache(REVIEW_STATE_DIR, ttl=REVIEW_STATE_TTL)
+        elif REVIEW_STATE != "none":
+            review_state = MemoryCache(REVIEW_STATE_SIZE, REVIEW_STATE_TTL)
+    return review_state
+
+
+def hunk_hash(file, snippet):
+    """Hash of a snippet's text, independent of where it is in the file."""
+    return cache_key(file, snippet["text"])
+
+
+def drop_reviewed_hunks(content, reviewed):
+    """Remove the snippets whose hashes are in `reviewed`, a `{file: [hash]}` dict."""
+    fresh = {}
+    for file, snippets in content.items():
+        seen = set(reviewed.get(file, ()))
+        snippets = [s for s in snippets if hunk_hash(file, s) not in seen]
+        if snippets:
+            fresh[file] = snippets
+    return fresh
+
+
+async def review(
         content: dict,
-        model="codellama/CodeLlama-34b-Instruct-hf",
+        model=REVIEW_MODEL,
         system_content=SYSTEM_CONTENT,
-        prompt="Improve this content."
+        prompt=BATCH_PROMPT,
+        max_batch_tokens=MAX_BATCH_TOKENS,
+        on_progress=None,
     ):
-    futures = [
-        mentor_task.remote(v, model, system_content, prompt)
-        for v in content.values()
-        ]
-    suggestions = ray.get(futures)
-    content = {k: v[0] for k, v in zip(content.keys(), suggestions)}
-    prompt_tokens = sum(v[2] for v in suggestions)
-    completion_tokens = sum(v[3] for v in suggestions)
+    """Get suggestions for each file, packing files into as few requests as possible.
+
+    Files with cached suggestions are skipped. The remaining files are
+    planned into batches of at most `max_batch_tokens` prompt tokens, which
+    are sent concurrently, as Ray tasks if Ray is initialized. If
+    `on_progress` is given, the answers are streamed instead, and it's
+    called whenever they grow, with a function that returns the per-file
+    suggestions so far. They're only parsed when it's called. Returns a
+    summary dict with the formatted and per-file suggestions, the files that
+    couldn't be reviewed, the model used, the token counts, the number of
+    requests and the number of cache hits.
+    """
+    cache = get_suggestion_cache()
+    keys = {
+        file: cache_key(model, system_content, prompt, snippets)
+        for file, snippets in content.items()
+    }
+    feedback = {}
+    if cache:
+        with span("suggestion_cache"):
+            cached = await asyncio.gather(*(cache.get(key) for key in keys.values()))
+        feedback = {file: value for file, value in zip(keys, cached) if value is not None}
+    misses = {file: v for file, v in content.items() if file not in feedback}
 
+    overhead = estimate_tokens(system_content + prompt, model)
+    batches = plan_batches(misses, max_batch_tokens, model, overhead)
+    logger.info(
+        f"Planned {len(batches)} requests for {len(misses)} files: "
+        + "; ".join(", ".join(batch) for batch in batches)
+    )
+
+    partial = {}
+
+    def feedback_so_far():
+        answers = [(batches[i], partial[i]) for i in sorted(partial)]
+        return {**feedback, **collect_feedback(answers)}
+
+    def progress(index, text):
+        partial[index] = text
+        on_progress(feedback_so_far)
+
+    def request(index, batch):
+        if on_progress:
+            # Streaming happens in-process, as Ray tasks return their result at once.
+            return amentor_stream(
+                format_batch(batch), model, system_content, prompt,
+                on_text=lambda text: progress(index, text),
+            )
+        return call_model(format_batch(batch), model, system_content, prompt)
+
+    limiter = get_rate_limiter()
+    results = await asyncio.gather(
+        *(
+            dispatch(
+                lambda index=index, batch=batch: request(index, batch),
+                limiter,
+                model,
+                overhead + estimate_tokens(format_batch(batch), model),
+            )
+            for index, batch in enumerate(batches)
+        ),
+        return_exceptions=True,
+    )
+
+    # A failed request only loses the feedback for the files in its batch.
+    answers, failed, suggestions = [], set(), []
+    for batch, result in zip(batches, results):
+        if isinstance(result, Exception):
+            logger.info(f"Request for {', '.join(batch)} failed: {result!r}")
+            failed.update(batch)
+            continue
+        suggestions.append(result)
+        count("prompt_tokens", result[2])
+        count("completion_tokens", result[3])
+        answers.append((batch, result[0]))
+    answers.extend(
+        ({file: None}, "_Docu Mentor couldn't review (all of) this file, please try again later._")
+        for file in sorted(failed)
+    )
+    fresh = collect_feedback(answers)
+    # Feedback without "### <file>" headers is only kept under the joint
+    # names of the batch, so it isn't cached for any of its files.
+    jointly = {
+        file for batch, _ in answers if len(batch) > 1 and ", ".join(batch) in fresh
+        for file in batch
+    }
+    if cache:
+        for file in misses:
+            if file not in failed and file not in jointly:
+                await cache.set(keys[file], fresh.get(file, ""))
+    feedback.update(fresh)
+
+    # Cached suggestions didn't cost any tokens this time.
+    return {
+        "content": format_feedback(feedback),
+        "feedback": feedback,
+        "failed_files": sorted(failed),
+        "model": model,
+        "prompt_tokens": sum(v[2] for v in suggestions),
+        "completion_tokens": sum(v[3] for v in suggestions),
+        "files": len(content),
+        "requests": len(batches),
+        "failed_requests": len(batches) - len(suggestions),
+        "cache_hits": len(content) - len(misses),
+    }
+
+
+async def routed_review(content: dict, repo="", on_progress=None):
+    """Review files with the models that `route_for` picks for the repository and file type.
+
+    If a route has a triage model, it checks the files first, and only the
+    files it flags, or doesn't clearly pass, are escalated to the review
+    model. Returns a summary dict like `review`, with the numbers of all
+    models added up, and the requests, tokens and time spent per model.
+    """
+    groups = {}
+    for file, snippets in content.items():
+        route = route_for(repo, file)
+        groups.setdefault((route["triage"], route["review"]), {})[file] = snippets
+
+    models, progress = {}, {}
+
+    async def timed_review(role, model, files, **kwargs):
+        start = time.perf_counter()
+        result = await review(files, model=model, **kwargs)
+        stats = models.setdefault(model, {
+            "roles": [], "requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0,
+        })
+        if role not in stats["roles"]:
+            stats["roles"].append(role)
+        for key in ["requests", "prompt_tokens", "completion_tokens"]:
+            stats[key] += result[key]
+        stats["seconds"] += time.perf_counter() - start
+        return result
+
+    def feedback_so_far():
+        return {f: text for p in progress.values() for f, text in p().items()}
+
+    def group_progress(route):
+        def update(feedback):
+            progress[route] = feedback
+            on_progress(feedback_so_far)
+        return update if on_progress else None
+
+    async def review_group(route, files):
+        triage_model, review_model = route
+        triaged = None
+        if triage_model:
+            with span("triage"):
+                triaged = await timed_review("triage", triage_model, files, prompt=TRIAGE_PROMPT)
+            files = {
+                file: snippets for file, snippets in files.items()
+                if not is_clean(triaged["feedback"].get(file))
+            }
+            count("escalated_files", len(files))
+            logger.info(
+                f"{triage_model} escalated {len(files)} of {triaged['files']} files to {review_model}"
+            )
+        reviewed = None
+        if files:
+            reviewed = await timed_review(
+                "review", review_model, files, on_progress=group_progress(route)
+            )
+        return triaged, reviewed
+
+    outcomes = await asyncio.gather(*(review_group(k, v) for k, v in groups.items()))
+    triaged = [t for t, _ in outcomes if t]
+    reviewed = [r for _, r in outcomes if r]
+    results = triaged + reviewed
+    # Files the triage model passed get no feedback.
+    feedback = {}
+    for result in reviewed:
+        feedback.update(result["feedback"])
+    return {
+        "content": format_feedback(feedback),
+        "feedback": feedback,
+        "failed_files": sorted(f for r in reviewed for f in r["failed_files"]),
+        "model": ", ".join(models),
+        "models": models,
+        "prompt_tokens": sum(r["prompt_tokens"] for r in results),
+        "completion_tokens": sum(r["completion_tokens"] for r in results),
+        "files": len(content),
+        "triaged_files": sum(t["files"] for t in triaged),
+        "escalated_files": sum(r["files"] for t, r in outcomes if t and r),
+        "requests": sum(r["requests"] for r in results),
+        "failed_requests": sum(r["failed_requests"] for r in results),
+        # Triaged files may be looked up once per model.
+        "lookups": sum(r["files"] for r in results),
+        "cache_hits": sum(r["cache_hits"] for r in results),
+    }
+
+
+def collect_feedback(answers):
+    """Map `(batch, answer)` pairs to feedback per file, for files split across batches too."""
+    feedback = {}
+    for batch, answer in answers:
+        for file, text in parse_batch_answer(answer, batch).items():
+            feedback.setdefault(file, []).append(text)
+    return {file: "\n\n".join(texts) for file, texts in feedback.items()}
+
+
+def format_feedback(feedback):
     print_content = ""
-    for k, v in content.items():
-        print_content += f"{k}:\n\t\{v}\n\n"
-    logger.info(print_content)
+    for k, v in feedback.items():
+        if v:
+            print_content += f"{k}:\n\t{v}\n\n"
+    logger.debug(print_content)
+    return print_content
+
+
+class TokenCacheActor:
+    """Installation access token cache shared by all Serve replicas."""
+
+    def __init__(self):
+        self.cache = TokenCache()
+
+    async def get(self, installation_id):
+        return await self.cache.get(installation_id)
+
+
+token_cache = None
+
+
+def get_token_cache():
+    """Return this process's token cache, backed by the shared actor if enabled."""
+    global token_cache
+    if token_cache is None:
+        if SHARE_TOKEN_CACHE and get_ray():
+            actor = SharedActor(TokenCacheActor, "token-cache")
+            token_cache = TokenCache(
+                fetch=lambda installation_id: actor.get.remote(installation_id)
+            )
+        else:
+            token_cache = TokenCache()
+    return token_cache
+
+
+def merge_feedback(previous, feedback, head_sha):
+    """Add the feedback on new changes to the feedback of earlier runs."""
+    merged = dict(previous)
+    for file, text in feedback.items():
+        if not text:
+            continue
+        if merged.get(file):
+            merged[file] += f"\n\n_Changes up to {head_sha[:7]}:_\n{text}"
+        else:
+            merged[file] = text
+    return merged
+
+
+async def post_or_update_comment(issue_url, comment_url, body, headers):
+    """Update the comment at `comment_url` if possible, or post a new one.
+
+    Returns the URL of the comment, or None if it couldn't be posted.
+    """
+    client = get_http_client()
+    if comment_url:
+        response = await client.patch(comment_url, json={"body": body}, headers=headers)
+        if response.status_code == 200:
+            return comment_url
+    response = await client.post(
+        f"{issue_url}/comments", json={"body": body}, headers=headers
+    )
+    return response.json().get("url") if response.status_code == 201 else None
+
+
+async def post_or_update_comments(issue_url, comment_urls, bodies, headers):
+    """Post or update one comment per body, reusing `comment_urls` in order."""
+    return [
+        await post_or_update_comment(
+            issue_url, comment_urls[i] if i < len(comment_urls) else None, body, headers
+        )
+        for i, body in enumerate(bodies)
+    ]
+
+
+def repo_name(pr):
+    """The "owner/repo" name of the PR's repository."""
+    parts = pr["url"].split("/")
+    return f"{parts[-4]}/{parts[-3]}"
+
+
+def format_model_stats(models):
+    """One line per model with its requests, tokens and time spent."""
+    return "".join(
+        f"\n- {model} ({', '.join(stats['roles'])}): {stats['requests']} requests, "
+        + f"{stats['prompt_tokens']} prompt and {stats['completion_tokens']} "
+        + f"completion tokens, {stats['seconds']:.1f}s"
+        for model, stats in models.items()
+    )
+
+
+def progress_body(feedback):
+    return (
+        ":hourglass: Docu Mentor is analysing your PR, "
+        + "this comment will be updated as feedback comes in.\n\n"
+        + format_feedback(feedback)
+    )
+
+
+class CommentUpdater:
+    """Edit a comment with the latest body, at most once every `interval` seconds.
+
+    `update` takes a function that returns the body, and can be called as
+    often as needed. The body is only built when an edit is sent, so
+    intermediate bodies are skipped without building them. The first update
+    with feedback goes out right away.
+    """
+
+    def __init__(self, comment_url, headers, interval=STREAM_UPDATE_INTERVAL):
+        self.comment_url = comment_url
+        self.headers = headers
+        self.interval = interval
+        self.render = None
+        self.last_update = None
+        self.task = None
+        self.started = time.monotonic()
+
+    def update(self, render):
+        self.render = render
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self._flush())
 
-    return print_content, model, prompt_tokens, completion_tokens
+    async def _flush(self):
+        while self.render is not None:
+            if self.last_update is None:
+                record_duration("first_feedback", time.monotonic() - self.started)
+            else:
+                await asyncio.sleep(self.last_update + self.interval - time.monotonic())
+            self.last_update = time.monotonic()
+            render, self.render = self.render, None
+            body = render()
+            try:
+                await get_http_client().patch(
+                    self.comment_url, json={"body": body}, headers=self.headers
+                )
+            except httpx.HTTPError as e:
+                logger.info(f"Couldn't update comment {self.comment_url}: {e!r}")
 
+    async def close(self):
+        """Stop updating, as the final body is about to be posted."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
 
 
-app = FastAPI()
+async def run_review(pr, issue_url, headers, files_to_keep):
+    """Review the PR and post the results as a review or in the bot's comment.
 
+    If the PR was reviewed before with the same filter, only the changes
+    since the last reviewed head SHA that are part of the PR diff are
+    fetched, and only hunks that weren't reviewed yet are sent to the model.
+    With `REVIEW_OUTPUT` "review", new feedback is posted as a pull request
+    review, with comments on the lines it refers to. With "comment", without
+    new feedback, or if the review can't be posted, the previous comment is
+    updated in place instead of posting a new one, and parts of a review
+    that couldn't be posted go into it. With `STREAM_FEEDBACK`, a comment is
+    posted right away and updated as the answers stream in.
+    """
+    client = get_http_client()
+    json_headers = {**headers, "Accept": "application/vnd.github.full+json"}
 
-async def handle_webhook(request: Request):
-    data = await request.json()
+    # Get head branch and commit of the PR
+    with span("pr_head"):
+        head = pr.get("head") or await get_pr_head(pr, json_headers)
+    head_sha = head.get("sha", "")
 
+    store = get_review_state()
+    with span("review_state"):
+        state = await store.get(pr["url"]) if store else None
+    if state and state["files_to_keep"] != files_to_keep:
+        state = None
+    urls = [get_diff_url(pr)]
+    pr_lines = None
+    if state and head_sha:
+        # The compare diff starts at the previous head, so after the base branch
+        # was merged into the PR, it has all upstream changes too. Only the lines
+        # that are also added in the PR diff are reviewed.
+        with span("diff"):
+            async with client.stream("GET", urls[0], headers=headers) as pr_diff:
+                if pr_diff.status_code == 200:
+                    pr_lines = {
+                        file: set(lines)
+                        async for file, lines in aiter_diff_files(
+                            pr_diff.aiter_lines(), files_to_keep
+                        )
+                    }
+        if pr_lines is not None:
+            urls.insert(0, get_compare_diff_url(pr, state["head_sha"], head_sha))
+
+    # Stream the diff and start fetching each changed file as soon
+    # as its section arrives. Only files with added lines that
+    # match the filter are kept.
+    files_with_lines, unchanged_lines = {}, {}
+
+    async def changed_paths(response, pr_lines=None):
+        async for file, lines in aiter_diff_files(
+            response.aiter_lines(), files_to_keep, unchanged=unchanged_lines
+        ):
+            if pr_lines is not None:
+                lines = [line for line in lines if line in pr_lines.get(file, ())]
+                if not lines:
+                    continue
+            files_with_lines[file] = lines
+            yield file
+
+    ref = head_sha or head.get("ref", "")
+    budget = FileBudget()
+    # Spooled files are removed once their context is extracted, also on errors.
+    try:
+        # The diff download and the file downloads overlap, so they share a stage.
+        with span("diff_and_files"):
+            for url in urls:
+                async with client.stream("GET", url, headers=headers) as diff_response:
+                    if diff_response.status_code != 200 and url != urls[-1]:
+                        # E.g. the previous head is gone after a force push.
+                        logger.info(f"Can't compare to {state['head_sha']}, using the PR diff")
+                        continue
+                    paths = changed_paths(diff_response, pr_lines if url != urls[-1] else None)
+                    if FETCH_WHOLE_TREE:
+                        async for _ in paths:
+                            pass
+                    else:
+                        head_branch_files = await get_changed_files(
+                            pr, ref, paths, json_headers, budget=budget
+                        )
+                break
+        if FETCH_WHOLE_TREE:
+            with span("branch_files"):
+                head_branch_files = await get_branch_files(pr, ref, json_headers, budget=budget)
+        logger.info(f"Fetched {len(head_branch_files)} files")
+
+        # Enrich diff data with context from the head branch.
+        with span("context"):
+            context_files = get_context_from_files(
+                head_branch_files, files_with_lines, max_tokens=MAX_SNIPPET_TOKENS
+            )
+            reviewed = state["hunks"] if state else {}
+            new_hunks = drop_reviewed_hunks(context_files, reviewed)
+    finally:
+        budget.close()
+    count("snippets", sum(len(v) for v in new_hunks.values()))
+
+    # Only send the snippets that need attention to the model.
+    with span("prefilter"):
+        new_hunks, prefiltered = prefilter(new_hunks, files_with_lines, unchanged_lines)
+    count("prefilter_skipped_snippets", prefiltered["skipped"])
+    count("prefilter_saved_tokens", prefiltered["tokens_saved"])
+    logger.info(f"Prefilter: {prefiltered}")
+    logger.info(
+        f"Reviewing {sum(len(v) for v in new_hunks.values())} of "
+        + f"{sum(len(v) for v in context_files.values())} hunks"
+    )
+
+    previous = state["feedback"] if state else {}
+    comment_url = state.get("comment_url") if state else None
+    overflow_urls = state.get("overflow_urls", []) if state else []
+    updater = None
+    if STREAM_FEEDBACK:
+        # Show a placeholder right away, and fill it in as feedback arrives.
+        with span("comment"):
+            comment_url = await post_or_update_comment(
+                issue_url, comment_url, progress_body(previous), json_headers
+            )
+        if comment_url:
+            updater = CommentUpdater(comment_url, json_headers)
+
+    def on_progress(feedback):
+        updater.update(lambda: progress_body(merge_feedback(previous, feedback(), head_sha)))
+
+    # Get suggestions from Docu Mentor
+    with span("review"):
+        result = await routed_review(
+            new_hunks, repo_name(pr), on_progress=on_progress if updater else None
+        )
+    if updater:
+        await updater.close()
+    hit_rate = result["cache_hits"] / max(result["lookups"], 1)
+    feedback = merge_feedback(previous, result["feedback"], head_sha)
+
+    header = ":rocket: Docu Mentor finished analysing your PR! :rocket:\n\n"
+    skipped = {
+        file: reason for file, reason in budget.skipped.items() if file in files_with_lines
+    }
+    footer = (
+        (
+            "I skipped these changed files: "
+            + ", ".join(f"{file} ({reason})" for file, reason in sorted(skipped.items()))
+            + ".\n\n"
+            if skipped else ""
+        )
+        + "This bot is proudly powered by "
+        + "[Anyscale Endpoints](https://app.endpoints.anyscale.com/).\n"
+        + f"In its last run, it looked at {result['files']} files with new changes"
+        + (f" up to {head_sha[:7]}" if head_sha else "")
+        + f", used {result['prompt_tokens']} prompt tokens, "
+        + f"and {result['completion_tokens']} completion tokens in total "
+        + f"across {result['requests']} requests"
+        + f" ({result['failed_requests']} failed). "
+        + (
+            f"{result['escalated_files']} of {result['triaged_files']} triaged files "
+            + "needed the review model. "
+            if result["triaged_files"] else ""
+        )
+        + f"{result['cache_hits']} of {result['lookups']} file lookups "
+        + f"({hit_rate:.0%}) were answered from cache. "
+        + f"{prefiltered['skipped']} of {prefiltered['snippets']} snippets "
+        + f"(about {prefiltered['tokens_saved']} tokens) didn't need the model.\n"
+        + format_model_stats(result["models"])
+    )
+
+    reviews, unposted = None, ""
+    comments, rest = anchor_feedback(result["feedback"], files_with_lines)
+    # Earlier reviews stay on the PR, so only new feedback is posted, and
+    # runs without any only update the comment instead of adding a review.
+    if REVIEW_OUTPUT == "review" and (comments or rest):
+        if rest:
+            summary = f"Take a look at your results:\n{format_feedback(rest)}\n\n"
+        else:
+            summary = "Take a look at my comments on your changes.\n\n"
+        with span("comment"):
+            reviews, unposted = await post_review(
+                pr["url"], head_sha, header + summary + footer, comments, json_headers
+            )
+        if reviews:
+            count("review_comments", len(comments))
+
+    if reviews and not unposted:
+        # Point the streamed comment, if any, to the review.
+        if comment_url:
+            with span("comment"):
+                await post_or_update_comment(
+                    issue_url, comment_url,
+                    header + "Take a look at my review below.\n\n" + footer, json_headers,
+                )
+    else:
+        if reviews:
+            # The parts of the review that couldn't be posted go in the comment.
+            results = f"Take a look at my review below, and at the rest of it here:\n{unposted}"
+        else:
+            results = f"Take a look at your results:\n{format_feedback(feedback)}"
+        body = header + results + "\n\n" + footer
+        # Let's comment on the PR, updating our previous comments if there are any.
+        # Bodies over GitHub's size limit are continued in further comments.
+        with span("comment"):
+            urls = await post_or_update_comments(
+                issue_url, [comment_url, *overflow_urls], split_text(body), json_headers
+            )
+        comment_url, overflow_urls = urls[0], urls[1:]
+
+    if store and head_sha:
+        hunks = {file: list(hashes) for file, hashes in reviewed.items()}
+        for file, snippets in new_hunks.items():
+            if file not in result["failed_files"]:
+                hunks.setdefault(file, []).extend(hunk_hash(file, s) for s in snippets)
+        with span("review_state"):
+            await store.set(pr["url"], {
+                "head_sha": head_sha,
+                "files_to_keep": files_to_keep,
+                "hunks": hunks,
+                "feedback": feedback,
+                "comment_url": comment_url,
+                "overflow_urls": overflow_urls,
+            })
+
+
+async def process_webhook(data):
     installation = data.get("installation")
     if installation and installation.get("id"):
         installation_id = installation.get("id")
         logger.info(f"Installation ID: {installation_id}")
 
-        JWT_TOKEN = generate_jwt()
-
-        installation_access_token = await get_installation_access_token(
-            JWT_TOKEN, installation_id
-        )
+        with span("installation_token"):
+            installation_access_token, _ = await get_token_cache().get(installation_id)
 
         headers = {
             "Authorization": f"token {installation_access_token}",
@@ -156,16 +1114,25 @@ async def handle_webhook(request: Request):
     # If PR exists and is opened
     if "pull_request" in data.keys() and (
         data["action"] in ["opened", "reopened"]
-    ):  # use "synchronize" for tracking new commits
+    ):
         pr = data.get("pull_request")
 
         # Greet the user and show instructions.
-        async with httpx.AsyncClient() as client:
-            await client.post(
-                f"{pr['issue_url']}/comments",
-                json={"body": GREETING},
-                headers=headers,
-            )
+        client = get_http_client()
+        await client.post(
+            f"{pr['issue_url']}/comments",
+            json={"body": GREETING},
+            headers=headers,
+        )
+        return JSONResponse(content={}, status_code=200)
+
+    # On new commits, update the review of PRs that we already reviewed.
+    if "pull_request" in data.keys() and data["action"] == "synchronize":
+        pr = data.get("pull_request")
+        store = get_review_state()
+        state = await store.get(pr["url"]) if store else None
+        if state:
+            await run_review(pr, pr["issue_url"], headers, state["files_to_keep"])
         return JSONResponse(content={}, status_code=200)
 
     # Check if the event is a new or modified issue comment
@@ -178,86 +1145,120 @@ async def handle_webhook(request: Request):
 
             # Get the comment body
             comment = data.get("comment")
-            comment_body = comment.get("body")
-            # Remove all whitespace characters except for regular spaces
-            comment_body = comment_body.translate(
-                str.maketrans("", "", string.whitespace.replace(" ", ""))
-            )
+            comment_body = clean_comment(comment.get("body"))
 
             # Skip if the bot talks about itself
             author_handle = comment["user"]["login"]
 
             # Check if the bot is mentioned in the comment
             if (
-                author_handle != "docu-mentor[bot]"
-                and "@docu-mentor run" in comment_body
+                author_handle != BOT_LOGIN
+                and MENTION in comment_body
             ):
-                async with httpx.AsyncClient() as client:
-                    # Fetch diff from GitHub
-                    files_to_keep = comment_body.replace(
-                        "@docu-mentor run", ""
-                    ).split(" ")
-                    files_to_keep = [item for item in files_to_keep if item]
-
-                    logger.info(files_to_keep)
-
-                    url = get_diff_url(pr)
-                    diff_response = await client.get(url, headers=headers)
-                    diff = diff_response.text
-
-                    files_with_lines = parse_diff_to_line_numbers(diff)
-
-                    # Get head branch of the PR
-                    headers["Accept"] = "application/vnd.github.full+json"
-                    head_branch = await get_pr_head_branch(pr, headers)
-
-                    # Get files from head branch
-                    head_branch_files = await get_branch_files(pr, head_branch, headers)
-                    print("HEAD FILES", head_branch_files)
-
-                    # Enrich diff data with context from the head branch.
-                    context_files = get_context_from_files(head_branch_files, files_with_lines)
-
-                    # Filter the dictionary
-                    if files_to_keep:
-                        context_files = {
-                            k: context_files[k]
-                            for k in context_files
-                            if any(sub in k for sub in files_to_keep)
-                        }
-
-                    # Get suggestions from Docu Mentor
-                    content, model, prompt_tokens, completion_tokens = \
-                        ray_mentor(context_files) if ray.is_initialized() else mentor(context_files)
-
-
-                    # Let's comment on the PR
-                    await client.post(
-                        f"{comment['issue_url']}/comments",
-                        json={
-                            "body": f":rocket: Docu Mentor finished "
-                            + "analysing your PR! :rocket:\n\n"
-                            + "Take a look at your results:\n"
-                            + f"{content}\n\n"
-                            + "This bot is proudly powered by "
-                            + "[Anyscale Endpoints](https://app.endpoints.anyscale.com/).\n"
-                            + f"It used the model {model}, used {prompt_tokens} prompt tokens, "
-                            + f"and {completion_tokens} completion tokens in total."
-                        },
-                        headers=headers,
-                    )
-
-@serve.deployment(route_prefix="/")
-@serve.ingress(app)
-class ServeBot:
+                files_to_keep = comment_body.replace(
+                    MENTION, ""
+                ).split(" ")
+                files_to_keep = [item for item in files_to_keep if item]
+
+                logger.info(files_to_keep)
+
+                await run_review(pr, comment["issue_url"], headers, files_to_keep)
+
+
+async def process_job(job):
+    """Process a queued `(delivery_id, data)` job, timing each of its stages."""
+    delivery_id, data = job
+    with trace_delivery(delivery_id):
+        await process_webhook(data)
+
+
+job_queue = JobQueue(process_job)
+event_router = EventRouter()
+
+
+def dropped_response(reason):
+    """Answer to a delivery that the event router dropped."""
+    if reason == "bad signature":
+        return JSONResponse(content={"status": "unauthorized"}, status_code=401)
+    return JSONResponse(content={"status": "ignored", "reason": reason}, status_code=200)
+
+
+async def enqueue_webhook(request: Request):
+    """Acknowledge a webhook delivery right away and process it in the background.
+
+    Deliveries the bot doesn't act on are dropped before they're queued.
+    """
+    reason, data = event_router.route(request.headers, await request.body())
+    if data is None:
+        return dropped_response(reason)
+    delivery_id = request.headers.get("X-GitHub-Delivery")
+    repo = data.get("repository", {}).get("full_name", "")
+    try:
+        accepted = job_queue.submit(delivery_id, repo, (delivery_id, data))
+    except QueueFull:
+        logger.info(f"Rejecting delivery {delivery_id}: job queue is full")
+        return JSONResponse(content={"status": "busy"}, status_code=503)
+    status = "queued" if accepted else "duplicate"
+    return JSONResponse(content={"status": status}, status_code=202)
+
+
+def create_app():
+    """Create the bot's FastAPI app.
+
+    Ray, the LLM client and GitHub credentials are only set up once they're
+    needed, so the app starts quickly and runs without Ray as well.
+    """
+    app = FastAPI()
+
+    @app.on_event("startup")
+    async def startup():
+        job_queue.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        await job_queue.stop()
+        await close_http_client()
+
     @app.get("/")
-    async def root(self):
+    async def root():
         return {"message": "Docu Mentor reporting for duty!"}
 
+    @app.get("/stats")
+    async def stats():
+        stats = {**job_queue.stats(), "webhooks": event_router.stats()}
+        pool = get_mentor_pool()
+        if pool is not None:
+            stats["mentors"] = await pool.stats()
+        return stats
+
     @app.post("/webhook/")
-    async def handle_webhook_route(self, request: Request):
-        return await handle_webhook(request)
+    async def handle_webhook_route(request: Request):
+        return await enqueue_webhook(request)
+
+    return app
+
+
+# Run with: uvicorn main:app
+app = create_app()
+
+
+def build_bot():
+    """Bind the Ray Serve deployment of the app."""
+    from ray import serve
+
+    @serve.deployment(route_prefix="/")
+    @serve.ingress(create_app())
+    class ServeBot:
+        def __init__(self):
+            # Each replica owns one pooled client for all of its GitHub calls.
+            self.client = get_http_client()
+
+    return ServeBot.bind()
 
 
-# Run with: serve run main:bot
-bot = ServeBot.bind()
+def __getattr__(name):
+    # Run with: serve run main:bot
+    # Ray Serve is only imported when the deployment is looked up.
+    if name == "bot":
+        return build_bot()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
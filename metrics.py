@@ -0,0 +1,134 @@
+from collections import Counter, defaultdict
+import contextlib
+import contextvars
+from dotenv import load_dotenv
+import logging
+import os
+import sys
+import time
+
+load_dotenv()
+
+logger = logging.getLogger("Docu Mentor")
+
+# Set to "true" to emit OpenTelemetry spans for each stage, keyed by delivery ID.
+# Requires the optional "opentelemetry-api" package and a configured exporter.
+OTEL_TRACES = os.environ.get("OTEL_TRACES", "false").lower() == "true"
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+STAGE_BOUNDARIES = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+
+COUNTERS = {
+    "webhooks_accepted": "Webhook deliveries queued for processing.",
+    "webhooks_dropped": "Webhook deliveries dropped by the event router.",
+    "github_requests": "Requests sent to GitHub.",
+    "github_bytes": "Bytes downloaded from GitHub.",
+    "blob_cache_hits": "File contents served from the blob cache.",
+    "snippets": "Snippets extracted from the changed files.",
+    "prefilter_skipped_snippets": "Snippets the prefilter kept from the LLM.",
+    "prefilter_saved_tokens": "Estimated prompt tokens saved by the prefilter.",
+    "escalated_files": "Files the triage model passed on to the review model.",
+    "llm_requests": "Requests sent to the LLM, including retries.",
+    "llm_retries": "LLM requests retried after a transient error.",
+    "prompt_tokens": "Prompt tokens sent to the LLM.",
+    "completion_tokens": "Completion tokens received from the LLM.",
+    "review_comments": "Line comments posted in pull request reviews.",
+}
+
+_metrics = {}
+
+
+class DeliveryStats:
+    """Time spent per stage and counters of a single webhook delivery.
+
+    Stages that run concurrently, such as LLM requests, add up their durations.
+    """
+
+    def __init__(self, delivery_id):
+        self.delivery_id = delivery_id
+        self.stages = defaultdict(float)
+        self.counts = Counter()
+
+    def summary(self):
+        stages = ", ".join(f"{k}={v:.3f}s" for k, v in self.stages.items())
+        counts = ", ".join(f"{k}={v}" for k, v in self.counts.items())
+        return f"Delivery {self.delivery_id}: {stages} | {counts}"
+
+
+current_delivery = contextvars.ContextVar("current_delivery", default=None)
+
+
+def _get_metric(cls, name, description, **kwargs):
+    """Create Ray metrics lazily, as they need a connection to the Ray cluster."""
+    if name not in _metrics:
+        # If Ray wasn't even imported, it can't be initialized either.
+        ray = sys.modules.get("ray")
+        if ray is None or not ray.is_initialized():
+            return None
+        from ray.util import metrics
+        _metrics[name] = getattr(metrics, cls)(name, description=description, **kwargs)
+    return _metrics[name]
+
+
+def count(name, value=1):
+    """Add `value` to the counter `name`, one of `COUNTERS`."""
+    if value <= 0:
+        return
+    delivery = current_delivery.get()
+    if delivery is not None:
+        delivery.counts[name] += value
+    counter = _get_metric("Counter", f"docu_mentor_{name}", COUNTERS[name])
+    if counter is not None:
+        counter.inc(value)
+
+
+def record_duration(stage, seconds):
+    delivery = current_delivery.get()
+    if delivery is not None:
+        delivery.stages[stage] += seconds
+    histogram = _get_metric(
+        "Histogram",
+        "docu_mentor_stage_seconds",
+        "Duration of each stage of the review pipeline.",
+        boundaries=STAGE_BOUNDARIES,
+        tag_keys=("stage",),
+    )
+    if histogram is not None:
+        histogram.observe(seconds, tags={"stage": stage})
+
+
+@contextlib.contextmanager
+def span(stage, **attributes):
+    """Time a stage of the pipeline, and trace it if OpenTelemetry is enabled."""
+    with contextlib.ExitStack() as stack:
+        if OTEL_TRACES and trace is not None:
+            delivery = current_delivery.get()
+            if delivery is not None and delivery.delivery_id:
+                attributes["github.delivery_id"] = delivery.delivery_id
+            stack.enter_context(
+                trace.get_tracer("docu-mentor").start_as_current_span(
+                    f"docu-mentor.{stage}", attributes=attributes
+                )
+            )
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record_duration(stage, time.perf_counter() - start)
+
+
+@contextlib.contextmanager
+def trace_delivery(delivery_id):
+    """Collect the stages of a webhook delivery under one root span."""
+    stats = DeliveryStats(delivery_id)
+    token = current_delivery.set(stats)
+    try:
+        with span("webhook"):
+            yield stats
+    finally:
+        current_delivery.reset(token)
+        logger.info(stats.summary())
@@ -0,0 +1,186 @@
+import bisect
+from collections import Counter
+from dotenv import load_dotenv
+import io
+import os
+import re
+import tokenize
+
+from batching import format_batch
+from utils import estimate_tokens
+
+load_dotenv()
+
+# "safe" skips snippets without any prose changes, "strict" also skips prose
+# that passes the built-in rules, and "off" sends every snippet to the model.
+PREFILTER = os.environ.get("PREFILTER", "safe").lower()
+
+# Files the built-in spelling and style rules apply to in "strict" mode.
+PROSE_EXTENSIONS = {".md", ".mdx", ".rst", ".txt", ".adoc", ".asciidoc", ".tex", ".ipynb"}
+PROSE_FILE_NAMES = {"README", "CHANGELOG", "CONTRIBUTING", "LICENSE", "NOTICE", "AUTHORS"}
+# Generated and data files without any prose. All other files are reviewed.
+NON_PROSE_EXTENSIONS = {".json", ".lock", ".svg", ".map", ".csv", ".tsv", ".sum"}
+NON_PROSE_FILE_NAMES = {
+    "package-lock.json", "npm-shrinkwrap.json", "yarn.lock", "pnpm-lock.yaml",
+    "poetry.lock", "Pipfile.lock", "Cargo.lock", "Gemfile.lock", "composer.lock", "go.sum",
+}
+MINIFIED = re.compile(r"\.min\.(js|mjs|css)$")
+# In Python code, only docstrings, comments and new definitions are worth a look.
+CODE_EXTENSIONS = {".py", ".pyi"}
+
+# Lines without any letters, e.g. blank lines, table rules or closing brackets.
+TRIVIAL_LINE = re.compile(r"^[\W_\d]*$")
+
+MISSPELLINGS = {
+    "accomodate", "acheive", "adress", "alot", "arguement", "begining", "beleive",
+    "calender", "commited", "definately", "dependant", "dosen't", "doesnt",
+    "enviroment", "existance", "explicitely", "goverment", "guage", "independant",
+    "lenght", "neccessary", "occured", "occurence", "paramter", "parmeter", "persistant",
+    "posible", "preceeding", "recieve", "refered", "relevent", "reponse", "retreive",
+    "seperate", "sucess", "succesful", "teh", "thier", "tommorow", "untill", "wich",
+    "writting",
+}
+
+# Rules in the spirit of Vale's write-good and Google developer style packages.
+STYLE_RULES = [
+    ("repeated word", re.compile(r"\b(\w+)\s+\1\b", re.IGNORECASE)),
+    ("weasel word", re.compile(
+        r"\b(simply|just|easily|obviously|clearly|basically|of course|very)\b",
+        re.IGNORECASE,
+    )),
+    ("latin abbreviation", re.compile(r"\b(e\.g|i\.e|etc|vs|via)\b\.?", re.IGNORECASE)),
+    ("wordiness", re.compile(
+        r"\b(in order to|utilize|leverage|a number of|at this point in time)\b",
+        re.IGNORECASE,
+    )),
+    ("passive voice", re.compile(
+        r"\b(is|are|was|were|be|been|being)\s+(\w+ed|\w+en)\b", re.IGNORECASE
+    )),
+    ("exclamation", re.compile(r"\w!")),
+    ("double space", re.compile(r"\S  +\S")),
+    ("please", re.compile(r"\bplease\b", re.IGNORECASE)),
+    ("click here", re.compile(r"\bclick here\b", re.IGNORECASE)),
+]
+MAX_SENTENCE_WORDS = 30
+
+
+def is_prose_file(file):
+    name = os.path.basename(file)
+    stem, extension = os.path.splitext(name)
+    return extension.lower() in PROSE_EXTENSIONS or stem.upper() in PROSE_FILE_NAMES
+
+
+def is_non_prose_file(file):
+    name = os.path.basename(file)
+    extension = os.path.splitext(name)[1].lower()
+    return (
+        name in NON_PROSE_FILE_NAMES
+        or extension in NON_PROSE_EXTENSIONS
+        or MINIFIED.search(name.lower()) is not None
+    )
+
+
+def python_prose_lines(text):
+    """Return the 0-based lines of Python code with docstrings, comments or definitions.
+
+    Docstrings are string literals that make up a statement of their own.
+    Returns None if `text` can't be tokenized, e.g. because a snippet starts
+    in the middle of a docstring.
+    """
+    lines = set()
+    previous = tokenize.NEWLINE
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(text).readline):
+            if token.type in (tokenize.NL, tokenize.COMMENT):
+                if token.type == tokenize.COMMENT:
+                    lines.add(token.start[0] - 1)
+                continue
+            if (
+                (token.type == tokenize.STRING and previous in (
+                    tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT
+                ))
+                or (token.type == tokenize.NAME and token.string in ("def", "class"))
+            ):
+                lines.update(range(token.start[0] - 1, token.end[0]))
+            previous = token.type
+    except (tokenize.TokenError, SyntaxError):
+        return None
+    return lines
+
+
+def find_issues(text):
+    """Return the names of the built-in spelling and style rules that `text` breaks."""
+    issues = []
+    words = re.findall(r"[\w']+", text.lower())
+    if any(word in MISSPELLINGS for word in words):
+        issues.append("spelling")
+    issues.extend(name for name, pattern in STYLE_RULES if pattern.search(text))
+    sentences = re.split(r"[.!?]\s", text)
+    if any(len(sentence.split()) > MAX_SENTENCE_WORDS for sentence in sentences):
+        issues.append("long sentence")
+    return issues
+
+
+def classify_snippet(file, snippet, changed, unchanged=frozenset(), mode=PREFILTER):
+    """Say why a snippet doesn't need the model, or return "review" if it does.
+
+    `changed` holds the sorted 0-based numbers of the added lines of the
+    file, and `unchanged` those that only differ from the removed ones in
+    whitespace. Returns "non-prose", "unchanged", "clean" or "review".
+    """
+    if mode == "off":
+        return "review"
+    if is_non_prose_file(file):
+        return "non-prose"
+    lines = snippet["text"].split("\n")
+    offset = snippet["start_line"] - 1
+    start = bisect.bisect_left(changed, offset)
+    end = bisect.bisect_left(changed, offset + len(lines))
+    numbers = [
+        number - offset
+        for number in changed[start:end]
+        if number not in unchanged and not TRIVIAL_LINE.match(lines[number - offset])
+    ]
+    if not numbers:
+        return "unchanged"
+    changed_lines = [lines[number] for number in numbers]
+    if os.path.splitext(file)[1].lower() in CODE_EXTENSIONS:
+        # Decided on the whole snippet, since a changed line inside a
+        # docstring doesn't look like prose on its own.
+        prose = python_prose_lines(snippet["text"])
+        if prose is not None and not prose.intersection(numbers):
+            return "non-prose"
+    if mode == "strict" and not is_prose_file(file):
+        # Docstrings are checked for completeness by the model, not by the rules.
+        return "review"
+    if mode == "strict" and not find_issues("\n".join(changed_lines)):
+        return "clean"
+    return "review"
+
+
+def prefilter(content, files_with_lines, unchanged=None, mode=PREFILTER, model=None):
+    """Drop the snippets that don't need the model.
+
+    `content` maps files to snippets as returned by `get_context_from_files`.
+    Returns the remaining snippets and a report with the number of snippets
+    seen and skipped, the reasons they were skipped, and the estimated
+    number of prompt tokens saved.
+    """
+    unchanged = unchanged or {}
+    kept, reasons, tokens_saved = {}, Counter(), 0
+    for file, snippets in content.items():
+        changed = sorted(files_with_lines.get(file, []))
+        file_unchanged = set(unchanged.get(file, ()))
+        for snippet in snippets:
+            reason = classify_snippet(file, snippet, changed, file_unchanged, mode)
+            if reason == "review":
+                kept.setdefault(file, []).append(snippet)
+            else:
+                reasons[reason] += 1
+                tokens_saved += estimate_tokens(format_batch({file: [snippet]}), model)
+    return kept, {
+        "snippets": sum(len(snippets) for snippets in content.values()),
+        "skipped": sum(reasons.values()),
+        "reasons": dict(reasons),
+        "tokens_saved": tokens_saved,
+    }
@@ -0,0 +1,177 @@
+from dotenv import load_dotenv
+import logging
+import os
+import re
+
+from utils import get_http_client
+
+load_dotenv()
+
+logger = logging.getLogger("Docu Mentor")
+
+# GitHub rejects comment and review bodies longer than this many characters.
+MAX_BODY_CHARS = 65536
+
+# Line comments per review. Reviews with more comments are split into several.
+MAX_REVIEW_COMMENTS = int(os.environ.get("MAX_REVIEW_COMMENTS", 50))
+
+LINE_REF = re.compile(r"\blines?\s+(\d+)(?:\s*(?:-|–|to)\s*(\d+))?", re.IGNORECASE)
+LIST_ITEM = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s+")
+
+
+def split_points(text):
+    """Split the feedback for a file into its points.
+
+    List items and paragraphs are separate points, continuation lines
+    stay with the point they belong to.
+    """
+    points, current = [], []
+    for line in text.split("\n"):
+        if not line.strip() or (LIST_ITEM.match(line) and current):
+            if current:
+                points.append("\n".join(current))
+            current = [line] if line.strip() else []
+        else:
+            current.append(line)
+    if current:
+        points.append("\n".join(current))
+    return points
+
+
+def anchor_point(point, added):
+    """Return the `(start_line, line)` of the added lines a point refers to, or None.
+
+    `added` is the set of 1-based added lines of the file. Only the first
+    line reference of the point counts, and ranges are narrowed to a run
+    of consecutive added lines, which is always within a single hunk.
+    """
+    match = LINE_REF.search(point)
+    if not match:
+        return None
+    start, end = sorted((int(match.group(1)), int(match.group(2) or match.group(1))))
+    first = min((n for n in added if start <= n <= end), default=None)
+    if first is None:
+        return None
+    last = first
+    while last + 1 <= end and last + 1 in added:
+        last += 1
+    return first, last
+
+
+def anchor_feedback(feedback, files_with_lines):
+    """Map per-file feedback to line comments on the diff.
+
+    `files_with_lines` maps file names to their 0-based added lines, as
+    returned by `parse_diff_to_line_numbers`. Returns `(comments, rest)`,
+    where `comments` are review comments for the GitHub API, on the new
+    side of the diff, and `rest` maps files to the points that don't refer
+    to an added line, to be posted in the review body instead.
+    """
+    comments, rest = {}, {}
+    for file, text in feedback.items():
+        added = {line + 1 for line in files_with_lines.get(file, [])}
+        unanchored = []
+        for point in split_points(text or ""):
+            anchor = anchor_point(point, added) if added else None
+            if anchor is None:
+                unanchored.append(point)
+                continue
+            if (file, anchor) in comments:
+                comments[file, anchor]["body"] += f"\n{point}"
+                continue
+            start_line, line = anchor
+            comment = {"path": file, "line": line, "side": "RIGHT", "body": point}
+            if start_line != line:
+                comment.update(start_line=start_line, start_side="RIGHT")
+            comments[file, anchor] = comment
+        if unanchored:
+            rest[file] = "\n".join(unanchored)
+    return list(comments.values()), rest
+
+
+def split_text(text, limit=MAX_BODY_CHARS):
+    """Split `text` into chunks of at most `limit` characters, at line breaks if possible."""
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if current and len(current) + 1 + len(line) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+
+def truncate(text, limit=MAX_BODY_CHARS):
+    marker = "\n\n_(truncated)_"
+    return text if len(text) <= limit else text[: limit - len(marker)] + marker
+
+
+def plan_reviews(body, comments, max_comments=MAX_REVIEW_COMMENTS, limit=MAX_BODY_CHARS):
+    """Split a review that's too large for GitHub into several.
+
+    Returns a list of `(body, comments)` pairs. Long bodies are split at
+    line breaks, long comments are truncated, and at most `max_comments`
+    comments go into each review.
+    """
+    bodies = split_text(body, limit)
+    comments = [{**c, "body": truncate(c["body"], limit)} for c in comments]
+    groups = [
+        comments[i : i + max_comments] for i in range(0, len(comments), max_comments)
+    ]
+    parts = max(len(bodies), len(groups), 1)
+    return [
+        (
+            bodies[i] if i < len(bodies) else f"_Docu Mentor review, part {i + 1} of {parts}._",
+            groups[i] if i < len(groups) else [],
+        )
+        for i in range(parts)
+    ]
+
+
+def format_comments(comments):
+    """Comments as text, for when they can't be anchored to the diff."""
+    return "".join(
+        f"\n\n{c['path']}, line "
+        + (f"{c['start_line']}-{c['line']}" if "start_line" in c else f"{c['line']}")
+        + f":\n{c['body']}"
+        for c in comments
+    )
+
+
+async def post_review(pr_url, commit_id, body, comments, headers):
+    """Post the feedback as one pull request review, or several if it's too large.
+
+    If GitHub refuses the line comments of a review, e.g. because a line
+    isn't part of the diff anymore, they're added to its body instead.
+    Returns `(urls, rest)`, the URLs of the posted reviews and the text of
+    the parts that couldn't be posted, which is empty if all were.
+    """
+    client = get_http_client()
+    urls = []
+    pending = plan_reviews(body, comments)
+    while pending:
+        review_body, review_comments = pending.pop(0)
+        payload = {"event": "COMMENT", "body": review_body, "comments": review_comments}
+        if commit_id:
+            payload["commit_id"] = commit_id
+        response = await client.post(f"{pr_url}/reviews", json=payload, headers=headers)
+        if response.status_code == 422 and review_comments:
+            logger.info("Couldn't anchor the review comments, adding them to the body")
+            text = review_body + format_comments(review_comments)
+            pending[:0] = [(chunk, []) for chunk in split_text(text)]
+            continue
+        if response.status_code != 200:
+            logger.info(f"Couldn't post the review: {response.status_code}")
+            pending.insert(0, (review_body, review_comments))
+            rest = "\n\n".join(b + format_comments(c) for b, c in pending)
+            return urls, rest
+        urls.append(response.json().get("html_url"))
+    return urls, ""
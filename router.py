@@ -0,0 +1,108 @@
+from collections import Counter
+from dotenv import load_dotenv
+import hashlib
+import hmac
+import json
+import os
+import string
+
+import metrics
+
+load_dotenv()
+
+# Secret of the GitHub App's webhook. If set, deliveries without a matching
+# X-Hub-Signature-256 header are rejected.
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+
+MENTION = "@docu-mentor run"
+BOT_LOGIN = "docu-mentor[bot]"
+ROUTED_EVENTS = {"pull_request", "issue_comment"}
+
+
+def verify_signature(body, signature, secret):
+    """Whether `signature` is the "sha256=..." HMAC of the raw `body` with `secret`."""
+    if not signature or not signature.startswith("sha256="):
+        return False
+    expected = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature[len("sha256="):], expected)
+
+
+def clean_comment(body):
+    """Remove all whitespace characters except for regular spaces."""
+    return body.translate(str.maketrans("", "", string.whitespace.replace(" ", "")))
+
+
+def classify(data):
+    """Return "greet", "synchronize" or "review" for deliveries the bot acts on, else None."""
+    action = data.get("action")
+    if "pull_request" in data:
+        if action in ["opened", "reopened"]:
+            return "greet"
+        if action == "synchronize":
+            return "synchronize"
+        return None
+    if "issue" in data and action in ["created", "edited"]:
+        comment = data.get("comment") or {}
+        if (
+            "/pull/" in data["issue"].get("html_url", "")
+            and comment.get("user", {}).get("login") != BOT_LOGIN
+            and MENTION in clean_comment(comment.get("body") or "")
+        ):
+            return "review"
+    return None
+
+
+class EventRouter:
+    """Drops webhook deliveries the bot doesn't act on, as cheaply as possible.
+
+    The event type comes from the X-GitHub-Event header, and comments that
+    don't mention the bot are dropped before their payload is even parsed.
+    """
+
+    def __init__(self, secret=WEBHOOK_SECRET):
+        self.secret = secret
+        self.accepted = Counter()
+        self.dropped = Counter()
+
+    def route(self, headers, body):
+        """Return `(reason, data)` for a delivery with raw `body`.
+
+        For accepted deliveries, `reason` is what `classify` returned and
+        `data` is the parsed payload. For dropped ones, `data` is None and
+        `reason` says why, "bad signature" if the signature didn't match.
+        """
+        reason, data = self._route(headers, body)
+        if data is None:
+            self.dropped[reason] += 1
+            metrics.count("webhooks_dropped")
+        else:
+            self.accepted[reason] += 1
+            metrics.count("webhooks_accepted")
+        return reason, data
+
+    def _route(self, headers, body):
+        if self.secret and not verify_signature(
+            body, headers.get("X-Hub-Signature-256"), self.secret
+        ):
+            return "bad signature", None
+        # Deliveries without the header are classified by their payload alone.
+        event = headers.get("X-GitHub-Event")
+        if event is not None and event not in ROUTED_EVENTS:
+            return "event", None
+        # Comments mention the bot verbatim, even in the raw JSON.
+        if event == "issue_comment" and MENTION.split()[0].encode("utf-8") not in body:
+            return "no mention", None
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "invalid payload", None
+        if not isinstance(data, dict) or not data.get("installation"):
+            return "no installation", None
+        kind = classify(data)
+        if kind is None:
+            return "action", None
+        return kind, data
+
+    def stats(self):
+        """Return the number of accepted and dropped deliveries, by kind and reason."""
+        return {"accepted": dict(self.accepted), "dropped": dict(self.dropped)}
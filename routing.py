@@ -0,0 +1,48 @@
+from dotenv import load_dotenv
+import json
+import os
+import re
+
+load_dotenv()
+
+# Model that writes the feedback.
+REVIEW_MODEL = os.environ.get("REVIEW_MODEL", "codellama/CodeLlama-34b-Instruct-hf")
+# Smaller, faster model that checks files first. Only files it flags, or isn't
+# sure about, are sent to the review model. Leave empty to disable triage.
+TRIAGE_MODEL = os.environ.get("TRIAGE_MODEL", "")
+# Routes per repository and file extension, with "*" as wildcard, e.g.
+# {"*": {".py": {"triage": ""}}, "owner/repo": {"*": {"review": "meta-llama/Llama-2-70b-chat-hf"}}}
+MODEL_ROUTES = json.loads(os.environ.get("MODEL_ROUTES", "{}"))
+
+TRIAGE_PROMPT = """Check this content for problems.
+Don't comment on file names or other meta data, just the actual text.
+The <content> is in JSON format and maps file names to changed text snippets.
+For each file, write a line "### <file name>", followed by a line with only "OK"
+if the text needs no changes, or a very short list of the problems otherwise.
+"""
+
+CLEAN_ANSWER = re.compile(r"^\W*(ok|okay|lgtm|no (issues|problems)( found)?)\W*$", re.IGNORECASE)
+
+
+def route_for(repo, file, routes=None):
+    """Return the `{"triage": model, "review": model}` route of a file.
+
+    More specific routes override less specific ones, from the global
+    wildcard route to the one for the repository and the file's extension.
+    An empty triage model means files go straight to the review model.
+    """
+    routes = MODEL_ROUTES if routes is None else routes
+    extension = os.path.splitext(file)[1].lower()
+    route = {"triage": TRIAGE_MODEL, "review": REVIEW_MODEL}
+    for repo_key in ["*", repo]:
+        for extension_key in ["*", extension]:
+            route.update(routes.get(repo_key, {}).get(extension_key, {}))
+    return route
+
+
+def is_clean(answer):
+    """Whether a triage answer says the file needs no changes.
+
+    Anything else, including a missing answer, counts as a detected issue.
+    """
+    return bool(answer) and bool(CLEAN_ANSWER.match(answer.strip()))
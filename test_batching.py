@@ -0,0 +1,44 @@
+from batching import format_batch, parse_batch_answer, plan_batches
+import utils
+
+
+def snippets(*texts):
+    return [{"start_line": i, "end_line": i, "text": text} for i, text in enumerate(texts, 1)]
+
+
+def test_plan_batches_packs_small_files_and_splits_large_ones(monkeypatch):
+    monkeypatch.setattr(utils, "tiktoken", None)
+    content = {
+        "a.md": snippets("a" * 40),
+        "b.md": snippets("b" * 40),
+        "big.md": snippets("c" * 200, "d" * 200, "e" * 200),
+        "z.md": snippets("z" * 40),
+    }
+    batches = plan_batches(content, max_tokens=80)
+    assert [{f: len(s) for f, s in b.items()} for b in batches] == [
+        {"a.md": 1, "b.md": 1},
+        {"big.md": 1},
+        {"big.md": 1},
+        {"big.md": 1, "z.md": 1},
+    ]
+
+
+def test_plan_batches_accounts_for_overhead(monkeypatch):
+    monkeypatch.setattr(utils, "tiktoken", None)
+    content = {"a.md": snippets("a" * 40), "b.md": snippets("b" * 40)}
+    assert len(plan_batches(content, max_tokens=40)) == 1
+    assert len(plan_batches(content, max_tokens=40, overhead=10)) == 2
+
+
+def test_format_batch_includes_line_numbers():
+    assert '"lines 1-1": "Text."' in format_batch({"a.md": snippets("Text.")})
+
+
+def test_parse_batch_answer_maps_sections_to_files():
+    answer = "Overall fine.\n### a.md\nFix typo.\n## `b.md`:\nUse active voice.\n"
+    assert parse_batch_answer(answer, ["a.md", "b.md"]) == {
+        "a.md, b.md": "Overall fine.",
+        "a.md": "Fix typo.",
+        "b.md": "Use active voice.",
+    }
+    assert parse_batch_answer("### a.md\nAll good.", ["a.md"]) == {"a.md": "All good."}
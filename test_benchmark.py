@@ -0,0 +1,43 @@
+from benchmark import Scenario, make_pr, main_cli, measure_startup, percentile
+from utils import parse_diff_to_line_numbers
+import main
+import utils
+
+
+def test_make_pr_builds_a_matching_diff():
+    pr = make_pr(Scenario("tiny", files=2, hunks=3, lines=20, tree_size=5), 7)
+    lines = parse_diff_to_line_numbers(pr["diff"])
+    assert sorted(lines) == ["docs/page_0.md", "docs/page_1.md"]
+    assert len(pr["files"]) == 7
+    for path, added in lines.items():
+        content = pr["files"][path].split("\n")
+        assert [content[i] for i in added] == [
+            f"Teh new paragraph {h} dosen't read well." for h in range(3)
+        ]
+
+
+def test_percentile():
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile([3, 1, 2, 4], 99) == 4
+
+
+def test_benchmark_runs_against_local_stand_ins():
+    settings = [
+        (main, "USE_RAY"), (main, "STREAM_FEEDBACK"), (main, "rate_limiter"),
+        (main, "token_cache"), (utils, "GITHUB_FILES_API"), (utils, "BLOB_CACHE_DIR"),
+        (utils, "_http_client"), (main.get_openai(), "api_base"),
+    ]
+    before = [getattr(module, name) for module, name in settings]
+    results = main_cli(["--scenario", "small", "--runs", "2", "--llm-latency", "0"])
+    assert [r["scenario"] for r in results] == ["small"]
+    assert results[0]["github_requests"]["graphql"] == 1
+    assert results[0]["llm_requests"] == 1
+    assert results[0]["prompt_tokens"] > 0
+    # The bot's settings are restored for the code that runs next.
+    assert [getattr(module, name) for module, name in settings] == before
+
+
+def test_app_starts_without_ray_or_openai():
+    result = measure_startup("heroku", runs=1)
+    assert not result["ray"]
+    assert not result["openai"]
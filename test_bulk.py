@@ -0,0 +1,89 @@
+import json
+import os
+import subprocess
+
+import openai
+
+from bulk import list_files, main_cli, read_file
+from cache import MemoryCache
+from dispatcher import RateLimiter
+import main
+
+
+def make_checkout(path):
+    def git(*args):
+        subprocess.run(
+            ["git", "-C", str(path), "-c", "user.name=test", "-c", "user.email=test@example.com",
+             *args],
+            check=True, capture_output=True,
+        )
+
+    git("init", "-q")
+    (path / "doc").mkdir()
+    (path / "doc" / "intro.md").write_text("Teh intro.\nIt dosen't read well.\n")
+    (path / "doc" / "logo.png").write_bytes(b"\x89PNG\0\0")
+    (path / "setup.cfg").write_text("[metadata]\nname = test\n")
+    git("add", ".")
+    git("commit", "-q", "-m", "First")
+    (path / "doc" / "intro.md").write_text("Teh intro.\nIt dosen't read well.\nA new line.\n")
+    (path / "doc" / "usage.md").write_text("Usage is simple.\n")
+    git("add", ".")
+    git("commit", "-q", "-m", "Second")
+    return git
+
+
+def test_list_and_read_files_of_whole_files_or_changes(tmp_path):
+    make_checkout(tmp_path)
+    rows = list_files(str(tmp_path), ["doc/"])
+    assert sorted(row["file"] for row in rows) == ["doc/intro.md", "doc/logo.png", "doc/usage.md"]
+    files = {f["file"]: f for row in rows for f in read_file(row)}
+    assert sorted(files) == ["doc/intro.md", "doc/usage.md"]
+    assert files["doc/intro.md"]["lines"] == [0, 1, 2, 3]
+    assert read_file(rows[0], done={files[rows[0]["file"]]["key"]}) == []
+
+    rows = list_files(str(tmp_path), base="HEAD~1", head="HEAD")
+    changes = {f["file"]: f for row in rows for f in read_file(row)}
+    assert {file: f["lines"] for file, f in changes.items()} == {
+        "doc/intro.md": [2], "doc/usage.md": [0],
+    }
+    assert changes["doc/intro.md"]["text"] == "Teh intro.\nIt dosen't read well.\nA new line.\n"
+    assert files["doc/intro.md"]["key"] != changes["doc/intro.md"]["key"]
+
+
+def test_bulk_review_writes_results_and_resumes(tmp_path, monkeypatch):
+    checkout, output = tmp_path / "checkout", tmp_path / "output"
+    checkout.mkdir()
+    make_checkout(checkout)
+    prompts = []
+
+    async def acreate(model, messages, temperature):
+        prompts.append(messages[1]["content"])
+        return {
+            "choices": [{"message": {"content": "### doc/intro.md\nFix 'Teh'.\n### doc/usage.md\nOK."}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2},
+        }
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(main, "USE_RAY", "false")
+    monkeypatch.setattr(main, "suggestion_cache", MemoryCache())
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+
+    argv = [str(checkout), "--path", "doc/", "--output", str(output)]
+    summary = main_cli(argv)
+    assert len(prompts) == 1
+    # The logo is listed, but skipped as a binary file.
+    assert (summary["files"], summary["reviewed"], summary["skipped"]) == (3, 2, 1)
+    assert summary["prompt_tokens"] == 10
+    with open(output / "results.jsonl") as f:
+        results = {row["file"]: row for row in map(json.loads, f)}
+    assert results["doc/intro.md"]["feedback"] == "Fix 'Teh'."
+    report = (output / "report.md").read_text()
+    assert "## doc/intro.md\n\nFix 'Teh'." in report
+
+    # A second run only reviews files that changed since.
+    (checkout / "doc" / "usage.md").write_text("Usage is simple.\nTeh end.\n")
+    summary = main_cli(argv)
+    assert len(prompts) == 2
+    assert "doc/usage.md" in prompts[1] and "doc/intro.md" not in prompts[1]
+    assert (summary["skipped"], summary["reviewed"]) == (2, 1)
+    assert os.path.exists(output / "report.md")
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import sys
+
+from cache import DiskCache, MemoryCache, TieredCache, cache_key
+
+
+def test_cache_key_is_stable():
+    assert cache_key("model", ["a", "b"]) == cache_key("model", ["a", "b"])
+    assert cache_key("model", ["a", "b"]) != cache_key("model", ["b", "a"])
+
+
+def test_memory_cache_evicts_least_recently_used():
+    async def run():
+        cache = MemoryCache(max_entries=2)
+        await cache.set("a", 1)
+        await cache.set("b", 2)
+        await cache.get("a")
+        await cache.set("c", 3)
+        return [await cache.get(k) for k in "abc"]
+
+    assert asyncio.run(run()) == [1, None, 3]
+
+
+def test_memory_cache_expires_entries():
+    async def run():
+        cache = MemoryCache(ttl=0)
+        await cache.set("a", 1)
+        await asyncio.sleep(0.01)
+        return await cache.get("a")
+
+    assert asyncio.run(run()) is None
+
+
+def test_memory_cache_caps_total_size():
+    async def run():
+        cache = MemoryCache(max_bytes=2 * sys.getsizeof("x" * 100))
+        for key in "abc":
+            await cache.set(key, "x" * 100)
+        return [await cache.get(k) for k in "abc"], cache.size
+
+    values, size = asyncio.run(run())
+    assert values == [None, "x" * 100, "x" * 100]
+    assert size == 2 * sys.getsizeof("x" * 100)
+
+
+def test_tiered_cache_promotes_values_from_the_slow_tier(tmp_path):
+    async def run():
+        fast, slow = MemoryCache(), DiskCache(str(tmp_path))
+        await slow.set("a", "text")
+        cache = TieredCache(fast, slow)
+        value = await cache.get("a")
+        await cache.set("b", False)
+        return value, await fast.get("a"), await slow.get("b")
+
+    assert asyncio.run(run()) == ("text", "text", False)
+
+
+def test_disk_cache_caps_total_size(tmp_path):
+    async def run():
+        cache = DiskCache(str(tmp_path), max_bytes=250)
+        for i, key in enumerate("abc"):
+            await cache.set(key, "x" * 100)
+            os.utime(tmp_path / key, (i, i))
+        return [await cache.get(k) for k in "abc"]
+
+    assert asyncio.run(run()) == [None, "x" * 100, "x" * 100]
+
+
+def test_disk_cache_evicts_without_scanning_on_every_write(tmp_path, monkeypatch):
+    scans = []
+    cache = DiskCache(str(tmp_path), max_bytes=1000, rescan_every=10)
+    scan = cache._scan
+    monkeypatch.setattr(cache, "_scan", lambda: scans.append(1) or scan())
+
+    async def run():
+        for i in range(25):
+            await cache.set(str(i), "x" * 100)
+        return [await cache.get(str(i)) for i in range(25)]
+
+    values = asyncio.run(run())
+    assert len(scans) == 3
+    assert values[:-8] == [None] * 17 and values[-8:] == ["x" * 100] * 8
+    assert sorted(os.listdir(tmp_path), key=int) == [str(i) for i in range(17, 25)]
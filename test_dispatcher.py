@@ -0,0 +1,73 @@
+import asyncio
+import openai
+import pytest
+import time
+
+import dispatcher
+from dispatcher import RateLimiter, TokenBucket, dispatch, is_retryable
+
+
+def test_token_bucket_throttles_once_empty():
+    async def run():
+        bucket = TokenBucket(rate=600)  # 10 tokens per second
+        start = time.monotonic()
+        await bucket.acquire(600)
+        await bucket.acquire(2)
+        return time.monotonic() - start
+
+    assert 0.15 < asyncio.run(run()) < 1
+
+
+def test_rate_limiter_caps_concurrency():
+    running, peak = 0, 0
+
+    async def call():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return "ok"
+
+    async def run():
+        limiter = RateLimiter({"m": {"rpm": 10000, "tpm": 10000, "concurrency": 2}})
+        return await asyncio.gather(*(dispatch(call, limiter, "m", 1) for _ in range(6)))
+
+    assert asyncio.run(run()) == ["ok"] * 6
+    assert peak == 2
+
+
+def test_dispatch_retries_transient_errors(monkeypatch):
+    monkeypatch.setattr(dispatcher, "backoff_delay", lambda attempt: 0)
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise openai.error.RateLimitError("Slow down")
+        return "ok"
+
+    result = asyncio.run(dispatch(call, RateLimiter(), "m", 1, retries=3))
+    assert result == "ok"
+    assert len(attempts) == 3
+
+
+def test_dispatch_gives_up_on_timeouts_and_client_errors(monkeypatch):
+    monkeypatch.setattr(dispatcher, "backoff_delay", lambda attempt: 0)
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    async def invalid():
+        raise openai.error.InvalidRequestError("Bad request", None)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(dispatch(slow, RateLimiter(), "m", 1, retries=1, timeout=0.01))
+    with pytest.raises(openai.error.InvalidRequestError):
+        asyncio.run(dispatch(invalid, RateLimiter(), "m", 1))
+
+
+def test_is_retryable_checks_server_errors():
+    assert is_retryable(openai.error.APIError("Oops", http_status=502))
+    assert not is_retryable(openai.error.APIError("Oops", http_status=400))
+    assert not is_retryable(ValueError())
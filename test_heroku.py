@@ -0,0 +1,83 @@
+import asyncio
+import httpx
+
+import heroku
+
+
+OPENED = b'{"action": "opened", "installation": {"id": 1}, "pull_request": {}}'
+
+
+def test_query_retries_unavailable_upstream_and_passes_the_answer_through(monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            return httpx.Response(503, text="Service Unavailable")
+        if len(calls) == 2:
+            raise httpx.ConnectError("Connection refused")
+        return httpx.Response(202, json={"status": "queued"})
+
+    monkeypatch.setattr(heroku, "ANYSCALE_SERVICE_URL", "https://service.example.com")
+    monkeypatch.setattr(heroku, "FORWARD_BACKOFF_BASE", 0)
+
+    async def run():
+        monkeypatch.setattr(
+            heroku, "_forward_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=heroku.app), base_url="http://heroku"
+        ) as client:
+            return await client.post(
+                "/query", content=OPENED,
+                headers={"X-GitHub-Delivery": "d1", "Content-Type": "application/json"},
+            )
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 202
+    assert response.json() == {"status": "queued"}
+    assert len(calls) == 3
+    assert calls[-1].url == "https://service.example.com/webhook/"
+    assert calls[-1].content == OPENED
+    assert calls[-1].headers["X-GitHub-Delivery"] == "d1"
+
+
+def test_query_passes_non_json_errors_through(monkeypatch):
+    def handler(request):
+        return httpx.Response(500, text="Internal Server Error")
+
+    monkeypatch.setattr(heroku, "ANYSCALE_SERVICE_URL", "https://service.example.com")
+
+    async def run():
+        monkeypatch.setattr(
+            heroku, "_forward_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=heroku.app), base_url="http://heroku"
+        ) as client:
+            return await client.post("/query", content=OPENED)
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 500
+    assert response.text == "Internal Server Error"
+
+
+def test_query_drops_deliveries_the_bot_ignores(monkeypatch):
+    def handler(request):
+        raise AssertionError("Ignored deliveries must not be forwarded")
+
+    async def run():
+        monkeypatch.setattr(
+            heroku, "_forward_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=heroku.app), base_url="http://heroku"
+        ) as client:
+            return await client.post("/query", content=b"{}", headers={"X-GitHub-Event": "push"})
+
+    response = asyncio.run(run())
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "ignored", "reason": "event"}
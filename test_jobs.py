@@ -0,0 +1,77 @@
+import asyncio
+import pytest
+
+from jobs import JobQueue, QueueFull
+
+
+def test_job_queue_dedups_and_limits_concurrency_per_repo():
+    running = {"a": 0, "b": 0}
+    peak = {"a": 0, "b": 0}
+
+    async def handler(data):
+        repo = data["repo"]
+        running[repo] += 1
+        peak[repo] = max(peak[repo], running[repo])
+        await asyncio.sleep(0.01)
+        running[repo] -= 1
+
+    async def run():
+        queue = JobQueue(handler, max_size=10, num_workers=4, max_per_repo=1)
+        results = [
+            queue.submit(f"delivery-{i}", repo, {"repo": repo})
+            for i, repo in enumerate(["a", "a", "a", "b"])
+        ]
+        results.append(queue.submit("delivery-0", "a", {"repo": "a"}))
+        await queue.queue.join()
+        await queue.stop()
+        return results, queue.stats()
+
+    results, stats = asyncio.run(run())
+    assert results == [True, True, True, True, False]
+    assert peak == {"a": 1, "b": 1}
+    assert stats["processed"] == 4
+    assert stats["duplicates"] == 1
+    assert stats["depth"] == 0
+
+
+def test_job_queue_applies_backpressure():
+    async def handler(data):
+        await asyncio.sleep(1)
+
+    async def run():
+        queue = JobQueue(handler, max_size=1, num_workers=1)
+        queue.submit("delivery-0", "a", {})
+        await asyncio.sleep(0)  # let the worker pick up the first job
+        queue.submit("delivery-1", "a", {})
+        with pytest.raises(QueueFull):
+            queue.submit("delivery-2", "a", {})
+        stats = queue.stats()
+        await queue.stop()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats["depth"] == 1
+    assert stats["rejected"] == 1
+
+
+def test_job_queue_does_not_block_other_repos_behind_a_busy_one():
+    started = {}
+
+    async def handler(data):
+        started.setdefault(data["repo"], asyncio.get_running_loop().time())
+        await asyncio.sleep(0.05)
+
+    async def run():
+        queue = JobQueue(handler, max_size=10, num_workers=4, max_per_repo=2)
+        start = asyncio.get_running_loop().time()
+        for i in range(6):
+            queue.submit(f"a-{i}", "a", {"repo": "a"})
+        queue.submit("b-0", "b", {"repo": "b"})
+        await queue.queue.join()
+        await queue.stop()
+        return started["b"] - start, queue
+
+    delay, queue = asyncio.run(run())
+    assert delay < 0.04
+    assert queue.stats()["processed"] == 7
+    assert queue.active == {} and queue.waiting == {}
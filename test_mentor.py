@@ -1,8 +1,19 @@
-from main import mentor, ANYSCALE_API_ENDPOINT
+from main import amentor, mentor, review, ANYSCALE_API_ENDPOINT
+from cache import MemoryCache
+from dispatcher import RateLimiter
+import asyncio
+import httpx
+import json
+import main
 import openai
 import os
 import pytest
+import ray
 import re
+import reviews
+import routing
+import time
+import utils
 
 
 def gpt4_evaluator(answers):
@@ -18,8 +29,8 @@ def gpt4_evaluator(answers):
     At the very end, give an assessment of what percentage of answers were sufficient.
     E.g., if only 2 out of 50 answers needed improvement, success rate of 96%.
     It's important to return this success rate as string."""
-    res = mentor(content=answers, model="gpt-4", system_content=gpt4_instructions, extra_instructions=extra_instructions)
-    return res["choices"][0]["message"]["content"]
+    res = mentor(content=answers, model="gpt-4", system_content=gpt4_instructions, prompt=extra_instructions)
+    return res[0]
 
 
 
@@ -29,7 +40,7 @@ def test_mentor_sentences(flawed_sentences):
     openai.api_key = os.environ.get("ANYSCALE_API_KEY")
 
     # mentor test data with doc-sanity models hosted by Anyscale Endpoints
-    corrected_sentences = mentor(flawed_sentences)["choices"][0]["message"]["content"]
+    corrected_sentences = mentor(flawed_sentences)[0]
     print(corrected_sentences)
 
     # Redirect to OpenAI to use GPT-4 as evaluator
@@ -54,7 +65,7 @@ def test_mentor_paragraphs(flawed_paragraphs):
     openai.api_key = os.environ.get("ANYSCALE_API_KEY")
 
     # mentor test data with doc-sanity models hosted by Anyscale Endpoints
-    corrected_paragraphs = mentor(flawed_paragraphs)["choices"][0]["message"]["content"]
+    corrected_paragraphs = mentor(flawed_paragraphs)[0]
     print(corrected_paragraphs)
 
     # Redirect to OpenAI to use GPT-4 as evaluator
@@ -75,6 +86,559 @@ def test_mentor_paragraphs(flawed_paragraphs):
         assert percentage > 80
 
 
+class FakeAPIs:
+    """Fake model and GitHub APIs for reviews in-process.
+
+    The model answers each prompt with `answer(model, prompt)`, and records
+    the `(model, prompt)` in `calls`. GitHub answers with `github(request)`
+    while `run` runs a coroutine.
+    """
+
+    def __init__(self, monkeypatch):
+        self.monkeypatch = monkeypatch
+        self.calls = []
+        self.answer = lambda model, prompt: "Looks good."
+        self.github = lambda request: httpx.Response(200, json={})
+
+    @property
+    def prompts(self):
+        return [prompt for _, prompt in self.calls]
+
+    async def acreate(self, model, messages, temperature):
+        self.calls.append((model, messages[1]["content"]))
+        return {
+            "choices": [{"message": {"content": self.answer(model, messages[1]["content"])}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2},
+        }
+
+    def run(self, coroutine):
+        async def run():
+            transport = httpx.MockTransport(lambda request: self.github(request))
+            self.monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(transport=transport))
+            try:
+                return await coroutine
+            finally:
+                await utils.close_http_client()
+
+        return asyncio.run(run())
+
+
+@pytest.fixture
+def fake_apis(monkeypatch):
+    apis = FakeAPIs(monkeypatch)
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", apis.acreate)
+    monkeypatch.setattr(main, "get_ray", lambda: None)
+    monkeypatch.setattr(main, "suggestion_cache", MemoryCache())
+    monkeypatch.setattr(main, "review_state", MemoryCache())
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+    return apis
+
+
+def test_amentor_runs_concurrently(monkeypatch):
+    async def acreate(model, messages, temperature):
+        await asyncio.sleep(0.2)
+        return {
+            "choices": [{"message": {"content": "Looks good."}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 2},
+        }
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+
+    async def run():
+        start = asyncio.get_running_loop().time()
+        results = await asyncio.gather(*(amentor({"a.md": "Text."}) for _ in range(5)))
+        return results, asyncio.get_running_loop().time() - start
+
+    results, elapsed = asyncio.run(run())
+    assert results[0] == ("Looks good.", "codellama/CodeLlama-34b-Instruct-hf", 10, 2)
+    assert elapsed < 0.5
+
+
+def test_review_batches_files_and_reuses_cached_suggestions(fake_apis):
+    fake_apis.answer = lambda model, prompt: "\n".join(
+        f"### {file}\nFeedback for {file}." for file in ["a.md", "b.md"] if file in prompt
+    )
+
+    def snippet(text):
+        return [{"start_line": 1, "end_line": 1, "text": text}]
+
+    first = asyncio.run(review({"a.md": snippet("One."), "b.md": snippet("Two.")}))
+    second = asyncio.run(review({"a.md": snippet("One."), "b.md": snippet("Changed.")}))
+    calls = fake_apis.prompts
+
+    assert len(calls) == 2
+    assert (first["requests"], first["cache_hits"], first["prompt_tokens"]) == (1, 0, 10)
+    assert (second["requests"], second["cache_hits"], second["prompt_tokens"]) == (1, 1, 10)
+    assert "a.md" not in calls[1]
+    assert second["content"] == first["content"]
+    assert "Feedback for a.md." in first["content"]
+
+
+def test_review_doesnt_cache_feedback_without_file_headers(fake_apis):
+    fake_apis.answer = lambda model, prompt: "Fix the typo in 'Teh'."
+    content = {
+        "a.md": [{"start_line": 1, "end_line": 1, "text": "Teh a."}],
+        "b.md": [{"start_line": 1, "end_line": 1, "text": "B."}],
+    }
+
+    first = asyncio.run(review(content))
+    second = asyncio.run(review(content))
+
+    assert first["feedback"] == {"a.md, b.md": "Fix the typo in 'Teh'."}
+    assert second["feedback"] == first["feedback"]
+    assert (second["requests"], second["cache_hits"]) == (1, 0)
+
+
+def test_review_keeps_partial_results_when_a_request_fails(fake_apis):
+    def answer(model, prompt):
+        if "b.md" in prompt:
+            raise openai.error.InvalidRequestError("Context too long", None)
+        return "### a.md\nFix typo."
+
+    fake_apis.answer = answer
+
+    content = {
+        "a.md": [{"start_line": 1, "end_line": 1, "text": "Teh text."}],
+        "b.md": [{"start_line": 1, "end_line": 1, "text": "b" * 400}],
+    }
+    result = asyncio.run(review(content, max_batch_tokens=150))
+
+    assert (result["requests"], result["failed_requests"]) == (2, 1)
+    assert "Fix typo." in result["content"]
+    assert "couldn't review" in result["content"]
+    assert asyncio.run(main.suggestion_cache.get(
+        main.cache_key(result["model"], main.SYSTEM_CONTENT, main.BATCH_PROMPT, content["b.md"])
+    )) is None
+
+
+def test_mentor_pool_sends_requests_to_the_least_loaded_actor():
+    @ray.remote(num_cpus=0)
+    def answer(delay):
+        time.sleep(delay)
+        return "Done."
+
+    class FakeActor:
+        def __init__(self, delay):
+            self.calls = 0
+            self.mentor = self
+            self.delay = delay
+
+        def remote(self, content, model, system_content, prompt):
+            self.calls += 1
+            return answer.remote(self.delay)
+
+    slow, fast = FakeActor(10), FakeActor(0)
+    pool = main.MentorPool([slow, fast])
+    first = pool.submit("a", "model", "", "")
+    ray.get(pool.submit("b", "model", "", ""))
+    # The slow actor is still busy, so the fast one gets the next requests too.
+    ray.get(pool.submit("c", "model", "", ""))
+    ray.get(pool.submit("d", "model", "", ""))
+
+    assert (slow.calls, fast.calls) == (1, 3)
+    ray.cancel(first, force=True)
+
+
+def test_shared_actor_is_versioned_and_created_again_when_gone(monkeypatch):
+    created = []
+
+    class FakeActor:
+        def __init__(self, *args):
+            self.get = self
+            self.gone = not created
+            created.append(args)
+
+        async def remote(self, key):
+            if self.gone:
+                raise ray.exceptions.RayActorError()
+            return f"value of {key}"
+
+    class FakeActorClass:
+        def options(self, name, namespace, get_if_exists, **options):
+            assert get_if_exists and "lifetime" not in options
+            return self
+
+        def remote(self, *args):
+            return FakeActor(*args)
+
+    monkeypatch.setattr(main, "as_remote", lambda cls: FakeActorClass())
+    actor = main.SharedActor(main.CacheActor, "test-cache", 10, 60)
+    assert actor.name.startswith("docu-mentor-test-cache-")
+    assert actor.name != main.SharedActor(main.CacheActor, "test-cache", 10, 120).name
+    assert asyncio.run(actor.get.remote("key")) == "value of key"
+    assert created == [(10, 60), (10, 60)]
+
+
+def test_routed_review_only_escalates_flagged_files(fake_apis, monkeypatch):
+    fake_apis.answer = lambda model, prompt: (
+        "### a.md\nOK\n### b.md\nTypo in line 1." if model == "small"
+        else "### b.md\nReplace 'teh' with 'the'."
+    )
+    calls = fake_apis.calls
+    monkeypatch.setattr(
+        routing, "MODEL_ROUTES", {"owner/repo": {".md": {"triage": "small", "review": "large"}}}
+    )
+
+    content = {
+        "a.md": [{"start_line": 1, "end_line": 1, "text": "Fine text."}],
+        "b.md": [{"start_line": 1, "end_line": 1, "text": "Teh text."}],
+        "c.py": [{"start_line": 1, "end_line": 1, "text": '"""Docstring."""'}],
+    }
+    result = asyncio.run(main.routed_review(content, "owner/repo"))
+
+    assert [model for model, _ in calls].count("small") == 1
+    large = [c for model, c in calls if model == "large"]
+    assert len(large) == 1 and "b.md" in large[0] and "a.md" not in large[0]
+    assert [c for model, c in calls if model == main.REVIEW_MODEL] != []
+    assert set(result["feedback"]) == {"b.md", "c.py"}
+    assert (result["triaged_files"], result["escalated_files"]) == (2, 1)
+    assert result["models"]["small"]["roles"] == ["triage"]
+    assert result["models"]["large"]["requests"] == 1
+    assert result["prompt_tokens"] == 30 and result["requests"] == 3
+
+
+def test_run_review_only_reviews_new_hunks_and_updates_its_comment(fake_apis, monkeypatch):
+    lines = [f"Line {i}." for i in range(1, 31)]
+    old_file = "\n".join(lines[:1] + ["Teh first change."] + lines[1:])
+    new_file = old_file.replace("Line 25.", "Line 25.\nTeh second change.")
+    files = {"sha1": old_file, "sha2": new_file}
+    pr_diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,3 @@
+ Line 1.
++Teh first change.
+ Line 2.
+"""
+    compare_diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -25,2 +25,3 @@
+ Line 24.
+ Line 25.
++Teh second change.
+"""
+    diffs = {"sha1": pr_diff, "sha2": pr_diff + """@@ -24,2 +25,3 @@
+ Line 24.
+ Line 25.
++Teh second change.
+"""}
+    head = {}
+    requests = []
+
+    def github(request):
+        requests.append((request.method, request.url.path))
+        if request.url.path.endswith("/pull/1.diff"):
+            return httpx.Response(200, text=diffs[head["sha"]])
+        if "/compare/" in request.url.path:
+            return httpx.Response(200, text=compare_diff)
+        if "/contents/" in request.url.path:
+            return httpx.Response(200, text=files[request.url.params["ref"]])
+        if request.method == "POST":
+            return httpx.Response(201, json={"url": "https://api.github.com/comments/7"})
+        return httpx.Response(200, json={})
+
+    fake_apis.github = github
+    fake_apis.answer = lambda model, prompt: f"### README.md\nFeedback {len(fake_apis.calls)}."
+    monkeypatch.setattr(main, "REVIEW_OUTPUT", "comment")
+
+    pr_url = "https://api.github.com/repos/owner/repo/pulls/1"
+    issue_url = "https://api.github.com/repos/owner/repo/issues/1"
+    for sha in ["sha1", "sha2"]:
+        head["sha"] = sha
+        pr = {"url": pr_url, "head": {"ref": "feature", "sha": sha}}
+        fake_apis.run(main.run_review(pr, issue_url, {}, []))
+
+    prompts = fake_apis.prompts
+    assert len(prompts) == 2
+    assert "Teh first change." in prompts[0] and "Teh second change." not in prompts[0]
+    assert "Teh second change." in prompts[1] and "Teh first change." not in prompts[1]
+    assert ("GET", "/repos/owner/repo/compare/sha1...sha2") in requests
+    assert [r for r in requests if r[0] in ("POST", "PATCH")] == [
+        ("POST", "/repos/owner/repo/issues/1/comments"),
+        ("PATCH", "/comments/7"),
+    ]
+    state = asyncio.run(main.review_state.get(pr_url))
+    assert state["head_sha"] == "sha2"
+    assert "Feedback 1." in state["feedback"]["README.md"]
+    assert "Feedback 2." in state["feedback"]["README.md"]
+
+
+def test_run_review_ignores_upstream_changes_in_the_compare_diff(fake_apis, monkeypatch):
+    files = {"README.md": "Line 1.\nTeh change.\nUpstream line.", "UPSTREAM.md": "Upstream."}
+    pr_diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1 +1,2 @@
+ Line 1.
++Teh change.
+"""
+    # The base branch, with two upstream changes, was merged into the PR.
+    compare_diff = pr_diff.replace("+Teh change.", "+Teh change.\n+Upstream line.") + """\
+diff --git a/UPSTREAM.md b/UPSTREAM.md
+--- /dev/null
++++ b/UPSTREAM.md
+@@ -0,0 +1 @@
++Upstream.
+"""
+    fetched = []
+
+    def github(request):
+        if request.url.path.endswith("/pull/1.diff"):
+            return httpx.Response(200, text=pr_diff)
+        if "/compare/" in request.url.path:
+            return httpx.Response(200, text=compare_diff)
+        if "/contents/" in request.url.path:
+            path = request.url.path.split("/contents/")[1]
+            fetched.append(path)
+            return httpx.Response(200, text=files[path])
+        return httpx.Response(201, json={"url": "https://api.github.com/comments/7"})
+
+    fake_apis.github = github
+    fake_apis.answer = lambda model, prompt: "### README.md\nFeedback."
+    monkeypatch.setattr(main, "REVIEW_OUTPUT", "comment")
+
+    pr_url = "https://api.github.com/repos/owner/repo/pulls/1"
+    asyncio.run(main.review_state.set(pr_url, {
+        "head_sha": "sha1", "files_to_keep": [], "hunks": {}, "feedback": {},
+        "comment_url": None,
+    }))
+
+    pr = {"url": pr_url, "head": {"ref": "feature", "sha": "sha2"}}
+    fake_apis.run(main.run_review(pr, "https://api.github.com/repos/owner/repo/issues/1", {}, []))
+
+    prompts = fake_apis.prompts
+    assert fetched == ["README.md"]
+    assert len(prompts) == 1
+    assert "Teh change." in prompts[0]
+    state = asyncio.run(main.review_state.get(pr_url))
+    assert state["head_sha"] == "sha2"
+
+
+def test_run_review_posts_line_comments_in_one_review(fake_apis, monkeypatch):
+    content = "\n".join(["Line 1.", "Teh change.", "Line 3.", "Another change."])
+    diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,4 @@
+ Line 1.
++Teh change.
+ Line 3.
++Another change.
+"""
+    posted = []
+
+    def github(request):
+        if request.url.path.endswith("/pull/1.diff"):
+            return httpx.Response(200, text=diff)
+        if "/contents/" in request.url.path:
+            return httpx.Response(200, text=content)
+        if request.method == "POST":
+            posted.append((request.url.path, json.loads(request.content)))
+            return httpx.Response(200, json={"html_url": "https://github.com/review"})
+        return httpx.Response(200, json={})
+
+    fake_apis.github = github
+    fake_apis.answer = lambda model, prompt: (
+        "### README.md\n- Line 2: Fix the typo in 'Teh'.\n- Use a consistent style."
+    )
+    monkeypatch.setattr(main, "STREAM_FEEDBACK", False)
+    monkeypatch.setattr(main, "REVIEW_OUTPUT", "review")
+
+    pr = {
+        "url": "https://api.github.com/repos/owner/repo/pulls/1",
+        "head": {"ref": "feature", "sha": "sha1"},
+    }
+    fake_apis.run(main.run_review(pr, "https://api.github.com/repos/owner/repo/issues/1", {}, []))
+
+    assert [path for path, _ in posted] == ["/repos/owner/repo/pulls/1/reviews"]
+    review = posted[0][1]
+    assert review["commit_id"] == "sha1" and review["event"] == "COMMENT"
+    assert review["comments"] == [{
+        "path": "README.md", "line": 2, "side": "RIGHT",
+        "body": "- Line 2: Fix the typo in 'Teh'.",
+    }]
+    assert "Use a consistent style." in review["body"]
+    assert "Fix the typo" not in review["body"]
+
+
+def test_run_review_only_posts_reviews_with_new_feedback(fake_apis, monkeypatch):
+    diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1 +1,2 @@
+ Line 1.
++The change.
+"""
+    posted = []
+
+    def github(request):
+        if request.url.path.endswith("/pull/1.diff") or "/compare/" in request.url.path:
+            return httpx.Response(200, text=diff)
+        if "/contents/" in request.url.path:
+            return httpx.Response(200, text="Line 1.\nThe change.")
+        posted.append((request.method, request.url.path))
+        if request.method == "PATCH":
+            return httpx.Response(200, json={})
+        return httpx.Response(201, json={"url": "https://api.github.com/comments/7"})
+
+    fake_apis.github = github
+    fake_apis.answer = lambda model, prompt: ""
+    monkeypatch.setattr(main, "STREAM_FEEDBACK", False)
+    monkeypatch.setattr(main, "REVIEW_OUTPUT", "review")
+
+    issue_url = "https://api.github.com/repos/owner/repo/issues/1"
+    for sha in ["sha1", "sha2"]:
+        pr = {
+            "url": "https://api.github.com/repos/owner/repo/pulls/1",
+            "head": {"ref": "feature", "sha": sha},
+        }
+        fake_apis.run(main.run_review(pr, issue_url, {}, []))
+
+    assert posted == [
+        ("POST", "/repos/owner/repo/issues/1/comments"),
+        ("PATCH", "/comments/7"),
+    ]
+
+
+def test_run_review_puts_the_unposted_parts_of_a_review_in_the_comment(fake_apis, monkeypatch):
+    diff = """diff --git a/README.md b/README.md
+--- a/README.md
++++ b/README.md
+@@ -1 +1,3 @@
+ Line 1.
++Teh change.
++Another change.
+"""
+    posted_reviews, comments = [], []
+
+    def github(request):
+        if request.url.path.endswith("/pull/1.diff"):
+            return httpx.Response(200, text=diff)
+        if "/contents/" in request.url.path:
+            return httpx.Response(200, text="Line 1.\nTeh change.\nAnother change.")
+        if request.url.path.endswith("/reviews"):
+            posted_reviews.append(json.loads(request.content))
+            if len(posted_reviews) > 1:
+                return httpx.Response(502)
+            return httpx.Response(200, json={"html_url": "https://github.com/review/1"})
+        comments.append(json.loads(request.content)["body"])
+        return httpx.Response(201, json={"url": "https://api.github.com/comments/7"})
+
+    fake_apis.github = github
+    fake_apis.answer = lambda model, prompt: (
+        "### README.md\n- Line 2: Fix the typo in 'Teh'.\n- Line 3: Say what changed."
+    )
+    monkeypatch.setattr(main, "STREAM_FEEDBACK", False)
+    monkeypatch.setattr(main, "REVIEW_OUTPUT", "review")
+    plan_reviews = reviews.plan_reviews
+    monkeypatch.setattr(
+        reviews, "plan_reviews", lambda body, comments: plan_reviews(body, comments, max_comments=1)
+    )
+
+    pr = {
+        "url": "https://api.github.com/repos/owner/repo/pulls/1",
+        "head": {"ref": "feature", "sha": "sha1"},
+    }
+    fake_apis.run(main.run_review(pr, "https://api.github.com/repos/owner/repo/issues/1", {}, []))
+
+    assert len(posted_reviews) == 2 and len(comments) == 1
+    assert "Fix the typo" in posted_reviews[0]["comments"][0]["body"]
+    assert "Say what changed." in comments[0] and "Fix the typo" not in comments[0]
+
+def test_run_review_closes_the_file_budget_when_fetching_fails(fake_apis, monkeypatch):
+    budgets = []
+
+    class FileBudget(utils.FileBudget):
+        def __init__(self):
+            super().__init__()
+            self.closed = False
+            budgets.append(self)
+
+        def close(self):
+            self.closed = True
+            super().close()
+
+    async def get_changed_files(pr, ref, paths, headers, budget=None):
+        raise httpx.ReadTimeout("Timed out")
+
+    monkeypatch.setattr(main, "FileBudget", FileBudget)
+    monkeypatch.setattr(main, "get_changed_files", get_changed_files)
+    pr = {
+        "url": "https://api.github.com/repos/owner/repo/pulls/1",
+        "head": {"ref": "feature", "sha": "sha1"},
+    }
+    issue_url = "https://api.github.com/repos/owner/repo/issues/1"
+    with pytest.raises(httpx.ReadTimeout):
+        fake_apis.run(main.run_review(pr, issue_url, {}, []))
+    assert [budget.closed for budget in budgets] == [True]
+
+def test_review_streams_progress_per_file(monkeypatch):
+    async def acreate(model, messages, temperature, stream):
+        assert stream
+
+        async def chunks():
+            for text in ["### a.md\nFix ", "a.\n### b.md\n", "Fix b."]:
+                yield {"choices": [{"delta": {"content": text}}]}
+
+        return chunks()
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(main, "suggestion_cache", MemoryCache())
+    monkeypatch.setattr(main, "rate_limiter", RateLimiter())
+    progress = []
+
+    content = {
+        "a.md": [{"start_line": 1, "end_line": 1, "text": "Teh a."}],
+        "b.md": [{"start_line": 1, "end_line": 1, "text": "Teh b."}],
+    }
+    result = asyncio.run(review(content, on_progress=lambda feedback: progress.append(feedback())))
+
+    assert progress == [
+        {"a.md": "Fix"},
+        {"a.md": "Fix a."},
+        {"a.md": "Fix a.", "b.md": "Fix b."},
+    ]
+    assert result["feedback"] == {"a.md": "Fix a.", "b.md": "Fix b."}
+    assert result["completion_tokens"] > 0
+
+
+def test_format_feedback_lists_files_with_feedback():
+    assert main.format_feedback({"a.md": "Fix the typo.", "b.md": ""}) == "a.md:\n\tFix the typo.\n\n"
+
+def test_comment_updater_throttles_edits(monkeypatch):
+    bodies, rendered = [], []
+
+    def handler(request):
+        bodies.append(json.loads(request.content)["body"])
+        return httpx.Response(200, json={})
+
+    def render(i):
+        rendered.append(i)
+        return f"Body {i}"
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            updater = main.CommentUpdater("https://api.github.com/comments/7", {}, 0.1)
+            for i in range(5):
+                updater.update(lambda i=i: render(i))
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(0.2)
+            updater.update(lambda: render(5))
+            await updater.close()
+        finally:
+            await utils.close_http_client()
+
+    asyncio.run(run())
+    # The first body goes out at once, the next ones are coalesced without building them.
+    assert bodies == ["Body 0", "Body 4"]
+    assert rendered == [0, 4]
+
+
 @pytest.fixture
 def flawed_sentences():
     """Result of prompting GPT-4: I want to write a test in Python that takes a dictionary as input.
@@ -0,0 +1,33 @@
+import asyncio
+import time
+
+import metrics
+from metrics import count, span, trace_delivery
+
+
+def test_trace_delivery_collects_stages_and_counts():
+    async def fetch():
+        with span("fetch"):
+            await asyncio.sleep(0.01)
+        count("github_requests")
+
+    async def run():
+        with trace_delivery("delivery-1") as stats:
+            await asyncio.gather(fetch(), fetch())
+            count("prompt_tokens", 10)
+            count("completion_tokens", 0)
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats.stages["fetch"] >= 0.02
+    assert stats.stages["webhook"] >= 0.01
+    assert stats.counts == {"github_requests": 2, "prompt_tokens": 10}
+    assert "delivery-1" in stats.summary()
+
+
+def test_span_without_delivery_is_a_no_op():
+    start = time.perf_counter()
+    with span("context"):
+        count("snippets", 3)
+    assert metrics.current_delivery.get() is None
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,100 @@
+from prefilter import classify_snippet, find_issues, prefilter
+from utils import get_context_from_files, iter_diff_files
+
+
+def snippet(text, start_line=1):
+    return {"start_line": start_line, "end_line": start_line + text.count("\n"), "text": text}
+
+
+def test_classify_snippet_skips_non_prose_files():
+    assert classify_snippet("package-lock.json", snippet('{"a": 1}'), [0]) == "non-prose"
+    assert classify_snippet("poetry.lock", snippet("x = 1"), [0]) == "non-prose"
+    assert classify_snippet("docs/index.md", snippet("Some text."), [0]) == "review"
+    assert classify_snippet("README", snippet("Some text."), [0]) == "review"
+    assert classify_snippet("static/app.min.js", snippet("var a=1"), [0]) == "non-prose"
+    assert classify_snippet("src/app.js", snippet("// Teh helper."), [0]) == "review"
+    assert classify_snippet("config.yaml", snippet("# Teh port."), [0]) == "review"
+
+
+def test_classify_snippet_only_reviews_prose_in_code():
+    code = snippet("x = 1\ny = 2")
+    docstring = snippet('def f(x):\n    """Return x."""\n    return x')
+    assert classify_snippet("main.py", code, [1]) == "non-prose"
+    assert classify_snippet("main.py", docstring, [1]) == "review"
+
+
+def test_classify_snippet_reviews_edits_inside_docstrings():
+    text = 'def f(x):\n    """Do it.\n\n    x: teh value wich is used.\n    """\n    return x'
+    assert classify_snippet("mod.py", snippet(text), [3]) == "review"
+    assert classify_snippet("mod.py", snippet(text), [5]) == "non-prose"
+    # Snippets that start inside a docstring can't be tokenized, so they're kept.
+    inner = snippet('    x: teh value wich is used.\n    """\n    return x', start_line=4)
+    assert classify_snippet("mod.py", inner, [3]) == "review"
+
+
+def test_classify_snippet_ignores_trivial_and_whitespace_changes():
+    text = snippet("Title\n\n| a | b |\n|---|---|", start_line=10)
+    assert classify_snippet("doc.md", text, [10, 12]) == "unchanged"
+    assert classify_snippet("doc.md", text, [9]) == "review"
+    assert classify_snippet("doc.md", text, [9], unchanged={9}) == "unchanged"
+
+
+def test_classify_snippet_strict_mode_requires_rule_hits():
+    assert classify_snippet("doc.md", snippet("Run the tests."), [0], mode="strict") == "clean"
+    assert classify_snippet("doc.md", snippet("Run teh tests."), [0], mode="strict") == "review"
+    assert classify_snippet("doc.md", snippet("Run the tests."), [0], mode="off") == "review"
+
+
+def test_find_issues():
+    assert find_issues("Teh the the tests.") == ["spelling", "repeated word"]
+    assert find_issues("Simply click here!") == ["weasel word", "exclamation", "click here"]
+    assert find_issues("The config was changed, e.g. by a script.") == [
+        "latin abbreviation",
+        "passive voice",
+    ]
+    assert find_issues("Run the tests.") == []
+
+
+def test_prefilter_detects_reflowed_paragraphs_and_reports_savings():
+    diff = """diff --git a/doc.md b/doc.md
+--- a/doc.md
++++ b/doc.md
+@@ -1,10 +1,10 @@
+-A long paragraph that
+-was wrapped early.
++A long paragraph
++that was wrapped early.
+ Line 3.
+ Line 4.
+ Line 5.
+ Line 6.
+ Line 7.
+-Old sentence.
++New sentence.
+ Line 9.
+ Line 10.
+diff --git a/data.json b/data.json
+--- a/data.json
++++ b/data.json
+@@ -1 +1 @@
+-{"a": 1}
++{"a": 2}
+"""
+    files = {
+        "doc.md": "A long paragraph\nthat was wrapped early.\nLine 3.\nLine 4.\nLine 5.\n"
+        + "Line 6.\nLine 7.\nNew sentence.\nLine 9.\nLine 10.",
+        "data.json": '{"a": 2}',
+    }
+    unchanged = {}
+    lines = dict(iter_diff_files(diff.splitlines(), unchanged=unchanged))
+    assert unchanged == {"doc.md": [0, 1]}
+
+    content = get_context_from_files(files, lines, context_lines=1)
+    kept, report = prefilter(content, lines, unchanged, mode="safe")
+
+    assert kept == {"doc.md": [content["doc.md"][1]]}
+    assert "New sentence." in kept["doc.md"][0]["text"]
+    assert report["snippets"] == 3
+    assert report["skipped"] == 2
+    assert report["reasons"] == {"unchanged": 1, "non-prose": 1}
+    assert report["tokens_saved"] > 0
@@ -0,0 +1,111 @@
+import asyncio
+import httpx
+import json
+
+import reviews
+import utils
+from reviews import anchor_feedback, plan_reviews, post_review, split_points, split_text
+
+
+def test_split_points_keeps_continuation_lines():
+    text = "Intro line.\n\n- Line 3: first\n  more on first\n- second\n\nClosing."
+    assert split_points(text) == [
+        "Intro line.", "- Line 3: first\n  more on first", "- second", "Closing.",
+    ]
+
+
+def test_anchor_feedback_only_anchors_added_lines():
+    feedback = {
+        "a.md": "- Line 2: typo.\n- Lines 4-9: too long.\n- Line 7: not changed.\n- General.",
+        "a.md, b.md": "Shared remark on line 2.",
+    }
+    # 0-based added lines 1, 3, 4 and 5 are lines 2, 4, 5 and 6.
+    comments, rest = anchor_feedback(feedback, {"a.md": [1, 3, 4, 5]})
+    assert comments == [
+        {"path": "a.md", "line": 2, "side": "RIGHT", "body": "- Line 2: typo."},
+        {
+            "path": "a.md", "line": 6, "side": "RIGHT", "start_line": 4,
+            "start_side": "RIGHT", "body": "- Lines 4-9: too long.",
+        },
+    ]
+    assert rest == {
+        "a.md": "- Line 7: not changed.\n- General.",
+        "a.md, b.md": "Shared remark on line 2.",
+    }
+
+
+def test_split_text_respects_the_limit():
+    text = "\n".join(["a" * 4] * 5 + ["b" * 12])
+    chunks = split_text(text, limit=10)
+    assert all(len(chunk) <= 10 for chunk in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+    assert split_text("short", limit=10) == ["short"]
+
+
+def test_plan_reviews_splits_bodies_and_comments():
+    comments = [{"path": "a.md", "line": i, "side": "RIGHT", "body": "x" * 20} for i in range(5)]
+    parts = plan_reviews("body", comments, max_comments=2, limit=15)
+    assert [len(c) for _, c in parts] == [2, 2, 1]
+    assert parts[0][0] == "body" and parts[2][0] == "_Docu Mentor review, part 3 of 3._"
+    assert all(len(c["body"]) <= 15 for _, group in parts for c in group)
+
+
+def test_post_review_moves_rejected_comments_to_the_body(monkeypatch):
+    posted = []
+
+    def handler(request):
+        review = json.loads(request.content)
+        posted.append(review)
+        if review["comments"]:
+            return httpx.Response(422, json={"message": "Unprocessable Entity"})
+        return httpx.Response(200, json={"html_url": "https://github.com/review/1"})
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            comments = [{"path": "a.md", "line": 3, "side": "RIGHT", "body": "Fix it."}]
+            return await post_review(
+                "https://api.github.com/repos/o/r/pulls/1", "sha", "Summary", comments, {}
+            )
+        finally:
+            await utils.close_http_client()
+
+    assert asyncio.run(run()) == (["https://github.com/review/1"], "")
+    assert len(posted) == 2
+    assert posted[1]["body"] == "Summary\n\na.md, line 3:\nFix it."
+
+
+def test_post_review_returns_the_parts_it_couldnt_post(monkeypatch):
+    monkeypatch.setattr(
+        reviews, "plan_reviews", lambda body, comments: plan_reviews(body, comments, max_comments=1)
+    )
+    posted = []
+
+    def handler(request):
+        posted.append(json.loads(request.content))
+        if len(posted) > 1:
+            return httpx.Response(502)
+        return httpx.Response(200, json={"html_url": "https://github.com/review/1"})
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            comments = [
+                {"path": "a.md", "line": line, "side": "RIGHT", "body": f"Fix line {line}."}
+                for line in [3, 5, 7]
+            ]
+            return await post_review(
+                "https://api.github.com/repos/o/r/pulls/1", "sha", "Summary", comments, {}
+            )
+        finally:
+            await utils.close_http_client()
+
+    urls, rest = asyncio.run(run())
+    assert urls == ["https://github.com/review/1"]
+    assert len(posted) == 2
+    assert "Fix line 3." not in rest
+    assert "a.md, line 5:\nFix line 5." in rest and "a.md, line 7:\nFix line 7." in rest
@@ -0,0 +1,59 @@
+import hashlib
+import hmac
+import json
+
+from router import EventRouter, classify, verify_signature
+
+
+def payload(**data):
+    return json.dumps({"installation": {"id": 1}, **data}).encode("utf-8")
+
+
+def comment(body, login="someone"):
+    return payload(
+        action="created",
+        issue={"html_url": "https://github.com/owner/repo/pull/1", "pull_request": {}},
+        comment={"body": body, "user": {"login": login}},
+    )
+
+
+def test_verify_signature():
+    body = b'{"action": "opened"}'
+    signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert verify_signature(body, signature, "secret")
+    assert not verify_signature(body, signature, "other")
+    assert not verify_signature(body + b" ", signature, "secret")
+    assert not verify_signature(body, None, "secret")
+
+
+def test_classify():
+    assert classify(json.loads(payload(action="opened", pull_request={}))) == "greet"
+    assert classify(json.loads(payload(action="synchronize", pull_request={}))) == "synchronize"
+    assert classify(json.loads(payload(action="closed", pull_request={}))) is None
+    assert classify(json.loads(comment("@docu-mentor run docs/"))) == "review"
+    assert classify(json.loads(comment("Looks good to me."))) is None
+    assert classify(json.loads(comment("@docu-mentor run", login="docu-mentor[bot]"))) is None
+
+
+def test_router_drops_deliveries_before_parsing_them():
+    router = EventRouter(secret="")
+    # Neither of these payloads is even valid JSON, so they can't have been parsed.
+    assert router.route({"X-GitHub-Event": "push"}, b"{") == ("event", None)
+    assert router.route({"X-GitHub-Event": "issue_comment"}, b"{Nice!") == ("no mention", None)
+    reason, data = router.route(
+        {"X-GitHub-Event": "issue_comment"}, comment("@docu-mentor run")
+    )
+    assert reason == "review" and data["comment"]["body"] == "@docu-mentor run"
+    assert router.route({}, payload(action="closed", pull_request={})) == ("action", None)
+    assert router.stats() == {
+        "accepted": {"review": 1},
+        "dropped": {"event": 1, "no mention": 1, "action": 1},
+    }
+
+
+def test_router_rejects_bad_signatures():
+    router = EventRouter(secret="secret")
+    body = payload(action="opened", pull_request={})
+    signature = "sha256=" + hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+    assert router.route({"X-Hub-Signature-256": "sha256=0"}, body) == ("bad signature", None)
+    assert router.route({"X-Hub-Signature-256": signature}, body)[0] == "greet"
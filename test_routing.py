@@ -0,0 +1,22 @@
+from routing import is_clean, route_for
+
+
+def test_route_for_prefers_specific_routes():
+    routes = {
+        "*": {"*": {"triage": "small"}, ".py": {"triage": ""}},
+        "owner/repo": {"*": {"review": "large"}, ".md": {"triage": "tiny"}},
+    }
+    assert route_for("other/repo", "README.md", routes)["triage"] == "small"
+    assert route_for("other/repo", "main.py", routes)["triage"] == ""
+    assert route_for("owner/repo", "docs/INDEX.MD", routes) == {"triage": "tiny", "review": "large"}
+    assert route_for("owner/repo", "main.py", routes) == {"triage": "", "review": "large"}
+
+
+def test_is_clean_only_accepts_clear_passes():
+    assert is_clean("OK")
+    assert is_clean("  ok.\n")
+    assert is_clean("No issues found.")
+    assert not is_clean("")
+    assert not is_clean(None)
+    assert not is_clean("OK, but 'teh' should be 'the'.")
+    assert not is_clean("_Docu Mentor couldn't review (all of) this file, please try again later._")
@@ -0,0 +1,496 @@
+import asyncio
+import base64
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import httpx
+import json
+import pytest
+import time
+
+from cache import MemoryCache
+from metrics import trace_delivery
+import utils
+from utils import (
+    MeteredTransport,
+    TokenCache,
+    aiter_diff_files,
+    close_http_client,
+    FileBudget,
+    SpooledLines,
+    decode_file_content,
+    estimate_tokens,
+    generate_jwt,
+    get_branch_files,
+    get_changed_files,
+    get_context_from_files,
+    iter_diff_files,
+    parse_diff_to_line_numbers,
+)
+
+
+PR = {"url": "https://api.github.com/repos/owner/repo/pulls/1"}
+
+
+DIFF = """diff --git a/README.md b/README.md
+index 1111111..2222222 100644
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,3 @@
+ # Title
++A new line.
+ Some text.
+diff --git a/old.md b/old.md
+deleted file mode 100644
+--- a/old.md
++++ /dev/null
+@@ -1 +0,0 @@
+-Gone.
+"""
+
+
+def test_parse_diff_to_line_numbers():
+    assert parse_diff_to_line_numbers(DIFF) == {"README.md": [1], "old.md": []}
+
+
+def test_iter_diff_files_filters_and_skips_deleted_and_binary_files():
+    diff = DIFF + """diff --git a/docs/guide.md b/docs/guide.md
+--- a/docs/guide.md
++++ b/docs/guide.md
+@@ -3,2 +3,3 @@
+ Intro.
+++++ Not a header.
+ Outro.
+\\ No newline at end of file
+diff --git a/docs/logo.png b/docs/logo.png
+Binary files a/docs/logo.png and b/docs/logo.png differ
+"""
+    assert list(iter_diff_files(diff.splitlines())) == [
+        ("README.md", [1]),
+        ("docs/guide.md", [3]),
+    ]
+    assert list(iter_diff_files(diff.splitlines(), ["docs/"], with_text=True)) == [
+        ("docs/guide.md", [(3, "+++ Not a header.")]),
+    ]
+
+
+def test_aiter_diff_files_streams_files_as_they_arrive():
+    seen = []
+
+    async def lines():
+        for line in DIFF.splitlines():
+            if line.startswith("deleted file mode"):
+                # The first file is complete before the rest has arrived.
+                seen.append(list(received))
+            yield line
+
+    async def run():
+        async for item in aiter_diff_files(lines()):
+            received.append(item)
+
+    received = []
+    asyncio.run(run())
+    assert received == [("README.md", [1])]
+    assert seen == [[("README.md", [1])]]
+
+
+def test_decode_file_content_skips_binary():
+    assert decode_file_content("héllo".encode("utf-8")) == "héllo"
+    assert decode_file_content(b"\x89PNG\r\n\x1a\n\0\0") is None
+    assert decode_file_content(b"\xff\xfe\xfa") is None
+
+
+def test_estimate_tokens_falls_back_when_the_encoding_cant_be_loaded(monkeypatch):
+    class OfflineTiktoken:
+        def encoding_for_model(self, model):
+            raise OSError("no network")
+
+    monkeypatch.setattr(utils, "tiktoken", OfflineTiktoken())
+    utils.get_encoding.cache_clear()
+    try:
+        assert estimate_tokens("x" * 40, "some-model") == 11
+    finally:
+        utils.get_encoding.cache_clear()
+
+
+def test_get_context_from_files_skips_missing_files():
+    files = {"README.md": "# Title\nA new line.\nSome text."}
+    context = get_context_from_files(files, parse_diff_to_line_numbers(DIFF))
+    assert context == {
+        "README.md": [
+            {"start_line": 1, "end_line": 3, "text": "# Title\nA new line.\nSome text."}
+        ]
+    }
+
+
+def test_get_context_from_files_merges_overlapping_windows():
+    files = {"doc.md": "\n".join(f"line {i}" for i in range(1, 31))}
+    # Lines 5-9 are one added paragraph, line 20 is a separate change.
+    lines = {"doc.md": [4, 5, 6, 7, 8, 19]}
+    context = get_context_from_files(files, lines, context_lines=2)
+    assert [(s["start_line"], s["end_line"]) for s in context["doc.md"]] == [
+        (3, 11),
+        (18, 22),
+    ]
+    assert context["doc.md"][1]["text"] == "line 18\nline 19\nline 20\nline 21\nline 22"
+
+
+def test_get_context_from_files_splits_large_ranges(monkeypatch):
+    monkeypatch.setattr(utils, "tiktoken", None)
+    files = {"doc.md": "\n".join("x" * 40 for _ in range(10))}
+    lines = {"doc.md": list(range(10))}
+    context = get_context_from_files(files, lines, context_lines=0, max_tokens=35)
+    assert [(s["start_line"], s["end_line"]) for s in context["doc.md"]] == [
+        (1, 3),
+        (4, 6),
+        (7, 9),
+        (10, 10),
+    ]
+
+
+@pytest.mark.parametrize("text", ["", "one", "a\nb", "a\n", "\n\nx\n\n", "héllo\nwörld"])
+@pytest.mark.parametrize("threshold", [0, 1024])
+def test_spooled_lines_behave_like_split_lines(text, threshold):
+    lines, expected = SpooledLines(text, threshold), text.split("\n")
+    assert len(lines) == len(expected)
+    assert [lines[i] for i in range(len(lines))] == expected
+    assert lines[-1] == expected[-1]
+    assert lines[1:] == expected[1:]
+    assert lines[0:0] == []
+    assert str(lines) == text
+    with pytest.raises(IndexError):
+        lines[len(expected)]
+    lines.close()
+
+
+def test_get_context_from_files_reads_spooled_files():
+    text = "\n".join(f"line {i}" for i in range(1, 1001))
+    lines = {"doc.md": [499]}
+    spooled = SpooledLines(text, threshold=0)
+    assert get_context_from_files({"doc.md": spooled}, lines) == get_context_from_files(
+        {"doc.md": text}, lines
+    )
+
+
+def test_get_changed_files_keeps_files_within_the_budget(monkeypatch):
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+    contents = {"a.md": b"a" * 60, "b.md": b"b" * 60, "big.md": b"c" * 200}
+
+    def handler(request):
+        return httpx.Response(200, content=contents[request.url.path.split("/contents/")[1]])
+
+    budget = FileBudget(max_bytes=100, spool_threshold=10)
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_changed_files(
+                PR, "feature", ["a.md", "b.md", "big.md"], {}, max_size=100, budget=budget
+            )
+        finally:
+            await close_http_client()
+
+    files = asyncio.run(run())
+    assert len(files) == 1
+    [(kept, lines)] = files.items()
+    assert isinstance(lines, SpooledLines) and str(lines) == contents[kept].decode()
+    assert budget.skipped == {
+        ({"a.md", "b.md"} - {kept}).pop(): "over the memory budget of the review",
+        "big.md": "larger than the maximum file size",
+    }
+    budget.close()
+
+
+def test_get_changed_files_skips_binary_and_missing_files(monkeypatch):
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+    contents = {"README.md": b"# Title\n", "logo.png": b"\x89PNG\0\0"}
+    requested = []
+
+    def handler(request):
+        path = request.url.path.split("/contents/")[1]
+        requested.append(path)
+        assert request.url.params["ref"] == "feature"
+        if path not in contents:
+            return httpx.Response(404)
+        return httpx.Response(200, content=contents[path])
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_changed_files(
+                PR, "feature", ["README.md", "logo.png", "old.md"], {}
+            )
+        finally:
+            await close_http_client()
+
+    files = asyncio.run(run())
+    assert files == {"README.md": "# Title\n"}
+    assert sorted(requested) == ["README.md", "logo.png", "old.md"]
+
+
+def test_get_changed_files_accepts_async_paths(monkeypatch):
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+
+    def handler(request):
+        return httpx.Response(200, content=b"text")
+
+    async def paths():
+        for path in ["a.md", "b.md"]:
+            yield path
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_changed_files(PR, "feature", paths(), {})
+        finally:
+            await close_http_client()
+
+    assert asyncio.run(run()) == {"a.md": "text", "b.md": "text"}
+
+
+def test_get_branch_files_caches_blobs_by_sha(monkeypatch):
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+    blobs = {"aaa": b"# Title\n", "bbb": b"\x89PNG\0\0"}
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.path)
+        if "/git/trees/" in request.url.path:
+            return httpx.Response(200, json={"tree": [
+                {"path": path, "sha": sha, "type": "blob", "size": len(blob),
+                 "url": f"https://api.github.com/repos/owner/repo/git/blobs/{sha}"}
+                for path, sha, blob in [("README.md", "aaa", blobs["aaa"]),
+                                        ("logo.png", "bbb", blobs["bbb"])]
+            ]})
+        sha = request.url.path.split("/")[-1]
+        return httpx.Response(200, json={"content": base64.b64encode(blobs[sha]).decode()})
+
+    monkeypatch.setattr(utils, "_blob_cache", MemoryCache())
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            first = await get_branch_files(PR, "main", {})
+            second = await get_branch_files(PR, "main", {})
+        finally:
+            await close_http_client()
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second == {"README.md": "# Title\n"}
+    assert sum("/git/blobs/" in path for path in requested) == 2
+
+
+def test_get_changed_files_caches_contents_at_commit_shas(monkeypatch):
+    monkeypatch.setattr(utils, "GITHUB_FILES_API", "rest")
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.params["ref"])
+        return httpx.Response(200, content=b"text")
+
+    monkeypatch.setattr(utils, "_blob_cache", MemoryCache())
+    sha = "a" * 40
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            for ref in [sha, sha, "feature", "feature"]:
+                assert await get_changed_files(PR, ref, ["a.md"], {}) == {"a.md": "text"}
+        finally:
+            await close_http_client()
+
+    asyncio.run(run())
+    assert requested == [sha, "feature", "feature"]
+
+
+def graphql_handler(blobs, requested):
+    """Fake GitHub GraphQL API answering blob queries from `blobs` by expression or oid."""
+
+    def handler(request):
+        body = json.loads(request.content)
+        requested.append(body)
+        repository = {
+            alias: blobs.get(value)
+            for alias, value in body["variables"].items()
+            if alias not in ("owner", "name")
+        }
+        return httpx.Response(200, json={"data": {"repository": repository}})
+
+    return handler
+
+
+def test_get_changed_files_batches_graphql_queries(monkeypatch):
+    monkeypatch.setattr(utils, "GRAPHQL_BATCH_SIZE", 2)
+    requested = []
+    blobs = {
+        "sha:README.md": {"text": "# Title\n", "isBinary": False, "byteSize": 8},
+        "sha:logo.png": {"text": None, "isBinary": True, "byteSize": 6},
+        "sha:docs/big.md": {"text": None, "isBinary": False, "byteSize": 10 ** 9},
+    }
+
+    async def run():
+        monkeypatch.setattr(utils, "_http_client", httpx.AsyncClient(
+            transport=httpx.MockTransport(graphql_handler(blobs, requested))
+        ))
+        try:
+            return await get_changed_files(
+                PR, "sha", ["README.md", "logo.png", "docs/big.md", "old.md"], {}
+            )
+        finally:
+            await close_http_client()
+
+    assert asyncio.run(run()) == {"README.md": "# Title\n"}
+    assert len(requested) == 2
+    assert requested[0]["variables"] == {
+        "owner": "owner", "name": "repo", "e0": "sha:README.md", "e1": "sha:logo.png",
+    }
+
+
+def test_get_changed_files_fetches_truncated_blobs_over_rest(monkeypatch):
+    requested = []
+    blobs = {
+        "sha:README.md": {
+            "text": "# Title\n", "isTruncated": False, "isBinary": False, "byteSize": 8,
+        },
+        "sha:long.md": {
+            "text": "Line 1.\n", "isTruncated": True, "isBinary": False, "byteSize": 16,
+        },
+    }
+    graphql = graphql_handler(blobs, requested)
+
+    def handler(request):
+        if request.url.path == "/graphql":
+            return graphql(request)
+        requested.append(request.url.path)
+        return httpx.Response(200, content=b"Line 1.\nLine 2.\n")
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_changed_files(PR, "sha", ["README.md", "long.md"], {})
+        finally:
+            await close_http_client()
+
+    assert asyncio.run(run()) == {"README.md": "# Title\n", "long.md": "Line 1.\nLine 2.\n"}
+    assert "isTruncated" in requested[0]["query"]
+    assert requested[1:] == ["/repos/owner/repo/contents/long.md"]
+
+def test_get_changed_files_falls_back_to_rest(monkeypatch):
+    requested = []
+
+    def handler(request):
+        requested.append(request.url.path)
+        if request.url.path == "/graphql":
+            return httpx.Response(502)
+        return httpx.Response(200, content=b"text")
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_changed_files(PR, "feature", ["a.md", "b.md"], {})
+        finally:
+            await close_http_client()
+
+    assert asyncio.run(run()) == {"a.md": "text", "b.md": "text"}
+    assert sorted(requested) == [
+        "/graphql", "/repos/owner/repo/contents/a.md", "/repos/owner/repo/contents/b.md",
+    ]
+
+
+def test_get_branch_files_fetches_blobs_by_oid_with_graphql(monkeypatch):
+    requested = []
+    blobs = {
+        "aaa": {"text": "# Title\n", "isBinary": False, "byteSize": 8},
+        "bbb": {"text": None, "isBinary": True, "byteSize": 6},
+    }
+    graphql = graphql_handler(blobs, requested)
+
+    def handler(request):
+        if "/git/trees/" in request.url.path:
+            return httpx.Response(200, json={"tree": [
+                {"path": "README.md", "sha": "aaa", "type": "blob", "size": 8, "url": ""},
+                {"path": "logo.png", "sha": "bbb", "type": "blob", "size": 6, "url": ""},
+            ]})
+        return graphql(request)
+
+    monkeypatch.setattr(utils, "_blob_cache", None)
+    monkeypatch.setattr(utils, "BLOB_CACHE", "none")
+
+    async def run():
+        monkeypatch.setattr(
+            utils, "_http_client", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        )
+        try:
+            return await get_branch_files(PR, "main", {})
+        finally:
+            await close_http_client()
+
+    assert asyncio.run(run()) == {"README.md": "# Title\n"}
+    assert len(requested) == 1
+    assert "object(oid: $o0)" in requested[0]["query"]
+
+
+def test_metered_transport_counts_requests_and_bytes():
+    transport = MeteredTransport(
+        httpx.MockTransport(lambda request: httpx.Response(200, content=b"x" * 100))
+    )
+
+    async def run():
+        with trace_delivery("delivery-1") as stats:
+            async with httpx.AsyncClient(transport=transport) as client:
+                await client.get("https://api.github.com/a")
+                async with client.stream("GET", "https://api.github.com/b") as response:
+                    await response.aread()
+        return stats
+
+    stats = asyncio.run(run())
+    assert stats.counts == {"github_requests": 2, "github_bytes": 200}
+
+
+def test_token_cache_coalesces_and_refreshes_ahead_of_expiry():
+    calls = []
+
+    async def fetch(installation_id):
+        calls.append(installation_id)
+        await asyncio.sleep(0.01)
+        # The first token is about to expire, the second one is fresh.
+        return f"token-{len(calls)}", time.time() + (60 if len(calls) == 1 else 3600)
+
+    async def run():
+        cache = TokenCache(fetch=fetch, refresh_margin=300)
+        first = await asyncio.gather(*(cache.get(42) for _ in range(5)))
+        second = await cache.get(42)
+        third = await cache.get(42)
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert {token for token, _ in first} == {"token-1"}
+    assert second[0] == third[0] == "token-2"
+    assert calls == [42, 42]
+
+
+def test_generate_jwt_is_reused(monkeypatch):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    ).decode()
+    monkeypatch.setattr(utils, "PRIVATE_KEY", pem)
+    monkeypatch.setattr(utils, "APP_ID", "1")
+    monkeypatch.setattr(utils, "_jwt_token", None)
+    assert generate_jwt() == generate_jwt()
@@ -1,12 +1,24 @@
+from array import array
+import asyncio
 import base64
+from datetime import datetime
+import functools
 import httpx
+import io
 from dotenv import load_dotenv
-import jwt
+import logging
 import os
+import re
+import tempfile
 import time
+from urllib.parse import quote
+
+from cache import DiskCache, MemoryCache, TieredCache, cache_key
+import metrics
 
 load_dotenv()
 
+logger = logging.getLogger("Docu Mentor")
 
 
 APP_ID = os.environ.get("APP_ID")
@@ -15,27 +27,213 @@ PRIVATE_KEY = os.environ.get("PRIVATE_KEY", "")
 # with open('private-key.pem', 'r') as f:
 #     PRIVATE_KEY = f.read()
 
+# Files larger than this (in bytes) are not fetched for review.
+MAX_FILE_SIZE = int(os.environ.get("MAX_FILE_SIZE", 1024 * 1024))
+# Bytes of file contents a single review may hold. Further files are skipped and
+# listed in the results. Files larger than SPOOL_THRESHOLD bytes are kept in
+# temporary files in SPOOL_DIR, and only the lines around the changes are read.
+REVIEW_MEMORY_BUDGET = int(os.environ.get("REVIEW_MEMORY_BUDGET", 128 * 1024 * 1024))
+SPOOL_THRESHOLD = int(os.environ.get("SPOOL_THRESHOLD", 64 * 1024))
+SPOOL_DIR = os.environ.get("SPOOL_DIR") or None
+# Maximum number of file downloads in flight at the same time.
+MAX_CONCURRENT_FETCHES = int(os.environ.get("MAX_CONCURRENT_FETCHES", 10))
+
+# Fetch file contents with batched GraphQL queries of up to GRAPHQL_BATCH_SIZE
+# files each, or with one REST request per file: "graphql" or "rest". If a
+# GraphQL query fails, its files are fetched over REST instead.
+GITHUB_FILES_API = os.environ.get("GITHUB_FILES_API", "graphql").lower()
+GRAPHQL_BATCH_SIZE = int(os.environ.get("GRAPHQL_BATCH_SIZE", 50))
+GRAPHQL_URL = "https://api.github.com/graphql"
+
+# Settings of the shared HTTP client used for all GitHub calls.
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_KEEPALIVE_EXPIRY = float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", 30))
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 30))
+HTTP2 = os.environ.get("HTTP2", "false").lower() == "true"
+
+# Cache for decoded file contents, keyed by blob SHA: "tiered" (memory in front
+# of a disk cache that Serve replicas on the same node share), "memory" or "none".
+BLOB_CACHE = os.environ.get("BLOB_CACHE", "tiered").lower()
+BLOB_CACHE_MEMORY_BYTES = int(os.environ.get("BLOB_CACHE_MEMORY_BYTES", 64 * 1024 * 1024))
+BLOB_CACHE_DISK_BYTES = int(os.environ.get("BLOB_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+BLOB_CACHE_DIR = os.environ.get("BLOB_CACHE_DIR", ".cache/blobs")
+
+# Cached tokens are refreshed this many seconds before they expire.
+TOKEN_REFRESH_MARGIN = int(os.environ.get("TOKEN_REFRESH_MARGIN", 300))
+
+_http_client = None
+
+
+class CountingStream(httpx.AsyncByteStream):
+    """Response body that counts the bytes downloaded from GitHub."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    async def __aiter__(self):
+        async for chunk in self.stream:
+            metrics.count("github_bytes", len(chunk))
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """Transport that counts the requests and downloaded bytes of another one."""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        metrics.count("github_requests")
+        response = await self.transport.handle_async_request(request)
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=CountingStream(response.stream),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def create_http_client():
+    """Create a pooled HTTP client with keep-alive and, if available, HTTP/2."""
+    http2 = HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.info("HTTP/2 requires the 'h2' package, falling back to HTTP/1.1.")
+            http2 = False
+    transport = httpx.AsyncHTTPTransport(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    return httpx.AsyncClient(
+        transport=MeteredTransport(transport),
+        timeout=httpx.Timeout(HTTP_TIMEOUT),
+    )
+
+
+def get_http_client():
+    """Return the long-lived HTTP client shared by all GitHub calls."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = create_http_client()
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client and its open connections."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+_blob_cache = None
+
+
+def get_blob_cache():
+    """Return the cache of decoded file contents, or None if it's disabled.
+
+    Values are the decoded text of a blob, or False for binary blobs.
+    """
+    global _blob_cache
+    if _blob_cache is None and BLOB_CACHE != "none":
+        memory = MemoryCache(max_entries=100000, max_bytes=BLOB_CACHE_MEMORY_BYTES)
+        if BLOB_CACHE == "tiered":
+            _blob_cache = TieredCache(
+                memory, DiskCache(BLOB_CACHE_DIR, max_bytes=BLOB_CACHE_DISK_BYTES)
+            )
+        else:
+            _blob_cache = memory
+    return _blob_cache
+
+_jwt_token = None
+_jwt_expires_at = 0
+
+
 def generate_jwt():
+    """Return the app's JWT, reusing it until shortly before it expires."""
+    global _jwt_token, _jwt_expires_at
+    now = int(time.time())
+    if _jwt_token and now < _jwt_expires_at - 60:
+        return _jwt_token
     payload = {
-        "iat": int(time.time()),
-        "exp": int(time.time()) + (10 * 60),
+        "iat": now,
+        "exp": now + (10 * 60),
         "iss": APP_ID,
     }
     if PRIVATE_KEY:
-        jwt_token = jwt.encode(payload, PRIVATE_KEY, algorithm="RS256")
-        return jwt_token
+        # Only imported once the app needs its credentials.
+        import jwt
+        _jwt_token = jwt.encode(payload, PRIVATE_KEY, algorithm="RS256")
+        _jwt_expires_at = payload["exp"]
+        return _jwt_token
     raise ValueError("PRIVATE_KEY not found.")
 
 
-async def get_installation_access_token(jwt, installation_id):
+async def request_installation_access_token(jwt, installation_id):
+    """Return a new installation access token and its expiry as Unix timestamp."""
     url = f"https://api.github.com/app/installations/{installation_id}/access_tokens"
     headers = {
         "Authorization": f"Bearer {jwt}",
         "Accept": "application/vnd.github.v3+json",
     }
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, headers=headers)
-        return response.json()["token"]
+    response = await get_http_client().post(url, headers=headers)
+    data = response.json()
+    expires_at = datetime.fromisoformat(data["expires_at"].replace("Z", "+00:00"))
+    return data["token"], expires_at.timestamp()
+
+
+async def get_installation_access_token(jwt, installation_id):
+    token, _ = await request_installation_access_token(jwt, installation_id)
+    return token
+
+
+class TokenCache:
+    """Cache installation access tokens until shortly before they expire.
+
+    Concurrent requests for the same installation share a single refresh.
+    `fetch` is a coroutine function that takes an installation ID and returns
+    a `(token, expires_at)` tuple.
+    """
+
+    def __init__(self, fetch=None, refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.fetch = fetch or (
+            lambda installation_id: request_installation_access_token(
+                generate_jwt(), installation_id
+            )
+        )
+        self.refresh_margin = refresh_margin
+        self.tokens = {}
+        self.refreshes = {}
+
+    async def get(self, installation_id):
+        """Return a valid `(token, expires_at)` tuple for the installation."""
+        cached = self.tokens.get(installation_id)
+        if cached and time.time() < cached[1] - self.refresh_margin:
+            return cached
+        if installation_id not in self.refreshes:
+            self.refreshes[installation_id] = asyncio.ensure_future(
+                self._refresh(installation_id)
+            )
+        return await asyncio.shield(self.refreshes[installation_id])
+
+    async def _refresh(self, installation_id):
+        try:
+            self.tokens[installation_id] = await self.fetch(installation_id)
+            return self.tokens[installation_id]
+        finally:
+            del self.refreshes[installation_id]
 
 
 def get_diff_url(pr):
@@ -46,87 +244,636 @@ def get_diff_url(pr):
     return f"https://patch-diff.githubusercontent.com/raw/{owner}/{repo}/pull/{pr_number}.diff"
 
 
-async def get_branch_files(pr, branch, headers):
+def get_compare_diff_url(pr, base, head):
+    """URL of the diff between two commits of the PR's repository."""
+    original_url = pr.get("url")
+    parts = original_url.split("/")
+    owner, repo = parts[-4], parts[-3]
+    return f"https://api.github.com/repos/{owner}/{repo}/compare/{base}...{head}"
+
+
+def decode_file_content(raw):
+    """Decode raw file bytes to text, or return None for binary files."""
+    if b"\0" in raw[:8000]:
+        return None
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
+class SpooledLines:
+    """The lines of a file, spooled to a temporary file if it's larger than `threshold` bytes.
+
+    Behaves like the list of its lines for `len`, indexing and slicing, but
+    only reads the requested lines back, using an index of line offsets
+    that's built on first access.
+    """
+
+    def __init__(self, text, threshold=SPOOL_THRESHOLD):
+        data = text.encode("utf-8")
+        self.size = len(data)
+        self._file = tempfile.SpooledTemporaryFile(max_size=threshold, dir=SPOOL_DIR)
+        self._file.write(data)
+        self._offsets = None
+
+    def _line_offsets(self):
+        # The start of each line, and the end of the last line plus one.
+        if self._offsets is None:
+            offsets = array("q", [0])
+            position = 0
+            self._file.seek(0)
+            while chunk := self._file.read(1024 * 1024):
+                start = chunk.find(b"\n")
+                while start != -1:
+                    offsets.append(position + start + 1)
+                    start = chunk.find(b"\n", start + 1)
+                position += len(chunk)
+            offsets.append(position + 1)
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self):
+        return len(self._line_offsets()) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("SpooledLines only supports contiguous slices")
+            if start >= stop:
+                return []
+            offsets = self._line_offsets()
+            self._file.seek(offsets[start])
+            data = self._file.read(offsets[stop] - 1 - offsets[start])
+            return data.decode("utf-8").split("\n")
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        return self[index:index + 1][0]
+
+    def __str__(self):
+        self._file.seek(0)
+        return self._file.read().decode("utf-8")
+
+    def close(self):
+        self._file.close()
+
+
+class FileBudget:
+    """Bytes of file contents a review may hold, and the files it skipped.
+
+    Files are kept as `SpooledLines` until the budget is used up. `skipped`
+    maps the paths of the files left out to the reason why.
+    """
+
+    def __init__(self, max_bytes=REVIEW_MEMORY_BUDGET, spool_threshold=SPOOL_THRESHOLD):
+        self.remaining = max_bytes
+        self.spool_threshold = spool_threshold
+        self.skipped = {}
+        self.files = []
+
+    def keep(self, path, text):
+        """Return the spooled lines of `text`, or None if they don't fit into the budget."""
+        # Every character takes at least one byte in UTF-8.
+        if len(text) <= self.remaining:
+            lines = SpooledLines(text, self.spool_threshold)
+            if lines.size <= self.remaining:
+                self.remaining -= lines.size
+                self.files.append(lines)
+                return lines
+            lines.close()
+        self.skipped[path] = "over the memory budget of the review"
+        return None
+
+    def close(self):
+        for lines in self.files:
+            lines.close()
+        self.files = []
+
+
+class GraphQLError(Exception):
+    pass
+
+
+async def get_blobs_graphql(owner, repo, expressions=(), oids=(), headers=None):
+    """Fetch many blobs of a repository in a single GraphQL query.
+
+    Blobs are selected by `expressions` like "<sha>:<path>" or by their
+    `oids`. Returns one dict per blob, with its `text`, `isTruncated`,
+    `isBinary` and `byteSize`, or None where there's no such blob. Raises `GraphQLError`
+    if the query fails as a whole.
+    """
+    selectors = [("e", "String!", "expression", e) for e in expressions]
+    selectors += [("o", "GitObjectID!", "oid", o) for o in oids]
+    aliases = [f"{prefix}{i}" for i, (prefix, *_) in enumerate(selectors)]
+    variables = {"owner": owner, "name": repo}
+    declarations, fields = ["$owner: String!", "$name: String!"], []
+    for alias, (_, kind, argument, value) in zip(aliases, selectors):
+        variables[alias] = value
+        declarations.append(f"${alias}: {kind}")
+        fields.append(
+            f"{alias}: object({argument}: ${alias}) "
+            + "{ ... on Blob { text isTruncated isBinary byteSize } }"
+        )
+    query = (
+        f"query({', '.join(declarations)}) {{ repository(owner: $owner, name: $name) {{ "
+        + " ".join(fields)
+        + " } }"
+    )
+    response = await get_http_client().post(
+        GRAPHQL_URL, json={"query": query, "variables": variables}, headers=headers
+    )
+    if response.status_code != 200:
+        raise GraphQLError(f"status code {response.status_code}")
+    try:
+        body = response.json()
+    except ValueError:
+        raise GraphQLError("invalid JSON in the response")
+    repository = (body.get("data") or {}).get("repository")
+    if repository is None:
+        raise GraphQLError(body.get("errors") or "no repository in the response")
+    return [repository.get(alias) for alias in aliases]
+
+
+def blob_text(blob, max_size=MAX_FILE_SIZE):
+    """Text of a GraphQL blob, False for binary blobs, or None if it's missing or too large."""
+    if not blob or blob.get("byteSize", 0) > max_size:
+        return None
+    if blob.get("isBinary"):
+        return False
+    return blob.get("text")
+
+
+def is_incomplete(blob, max_size=MAX_FILE_SIZE):
+    """Whether GitHub truncated or left out the text of a blob that's small enough to review.
+
+    Such blobs have to be fetched over REST instead.
+    """
+    return bool(
+        blob and not blob.get("isBinary") and blob.get("byteSize", 0) <= max_size
+        and (blob.get("isTruncated") or blob.get("text") is None)
+    )
+
+
+async def get_branch_files(pr, branch, headers, budget=None):
+    """Fetch every file of the repository tree at the given branch.
+
+    Blobs that aren't cached yet are fetched in batched GraphQL queries, or
+    one by one over REST, so prefer `get_changed_files` unless you really
+    need the whole tree. With a `FileBudget`, files are returned as
+    `SpooledLines` as long as they fit into it.
+    """
     original_url = pr.get("url")
     parts = original_url.split("/")
     owner, repo = parts[-4], parts[-3]
     url = f"https://api.github.com/repos/{owner}/{repo}/git/trees/{branch}?recursive=1"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
-        tree = response.json().get('tree', [])
-        files = {}
-        for item in tree:
-            if item['type'] == 'blob':
-                file_url = item['url']
-                print(file_url)
-                file_response = await client.get(file_url, headers=headers)
-                content = file_response.json().get('content', '')
-                # Decode the base64 content
-                decoded_content = base64.b64decode(content).decode('utf-8')
-                files[item['path']] = decoded_content
-        return files
+    client = get_http_client()
+    cache = get_blob_cache()
+    response = await client.get(url, headers=headers)
+    tree = response.json().get('tree', [])
+    items = [
+        item for item in tree
+        if item['type'] == 'blob' and item.get('size', 0) <= MAX_FILE_SIZE
+    ]
+    contents = {}
 
+    def hold(item, decoded_content):
+        if budget is None or decoded_content is False:
+            return decoded_content
+        lines = budget.keep(item['path'], decoded_content)
+        return False if lines is None else lines
 
-async def get_pr_head_branch(pr, headers):
+    if cache:
+        # Blobs are immutable, so a cached blob never needs to be fetched again.
+        for item in items:
+            decoded_content = await cache.get(item['sha'])
+            if decoded_content is not None:
+                metrics.count("blob_cache_hits")
+                contents[item['sha']] = hold(item, decoded_content)
+    misses = [item for item in items if item['sha'] not in contents]
+
+    async def download(item):
+        file_response = await client.get(item['url'], headers=headers)
+        content = file_response.json().get('content', '')
+        # Decode the base64 content
+        decoded_content = decode_file_content(base64.b64decode(content))
+        return False if decoded_content is None else decoded_content
+
+    graphql = GITHUB_FILES_API == "graphql"
+    batch_size = GRAPHQL_BATCH_SIZE if graphql else max(len(misses), 1)
+    for start in range(0, len(misses), batch_size):
+        batch = misses[start:start + batch_size]
+        downloaded = None
+        if graphql:
+            try:
+                blobs = await get_blobs_graphql(
+                    owner, repo, oids=[item['sha'] for item in batch], headers=headers
+                )
+                downloaded = [
+                    await download(item) if is_incomplete(blob) else blob_text(blob)
+                    for item, blob in zip(batch, blobs)
+                ]
+            except (GraphQLError, httpx.HTTPError) as e:
+                logger.info(f"GraphQL fetch failed, falling back to REST: {e!r}")
+        if downloaded is None:
+            downloaded = [await download(item) for item in batch]
+        for item, decoded_content in zip(batch, downloaded):
+            if decoded_content is None:
+                continue
+            if cache:
+                await cache.set(item['sha'], decoded_content)
+            contents[item['sha']] = hold(item, decoded_content)
+
+    return {
+        item['path']: contents[item['sha']]
+        for item in items
+        if contents.get(item['sha']) not in (None, False)
+    }
+
+
+async def get_changed_files(
+        pr,
+        ref,
+        paths,
+        headers,
+        max_concurrency=MAX_CONCURRENT_FETCHES,
+        max_size=MAX_FILE_SIZE,
+        budget=None,
+    ):
+    """Fetch only the given files at `ref`, concurrently.
+
+    `paths` may also be an async iterable, in which case downloads start as
+    soon as their paths arrive. With GraphQL, the files are fetched in
+    batches of `GRAPHQL_BATCH_SIZE`, and with REST one by one. If `ref` is
+    a commit SHA, contents are cached by commit and path. Binary files,
+    files larger than `max_size` bytes and files that can't be retrieved
+    (e.g. because they were deleted) are left out of the result. With a
+    `FileBudget`, files are returned as `SpooledLines` as long as they fit
+    into it, and files that are too large are noted in its `skipped`.
+    """
+    original_url = pr.get("url")
+    parts = original_url.split("/")
+    owner, repo = parts[-4], parts[-3]
+    raw_headers = {**headers, "Accept": "application/vnd.github.raw"}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # Unlike branch names, commit SHAs always point to the same contents.
+    cache = get_blob_cache() if re.fullmatch(r"[0-9a-f]{40}", ref) else None
+    graphql = GITHUB_FILES_API == "graphql"
+
+    def too_large(path):
+        if budget is not None:
+            budget.skipped[path] = "larger than the maximum file size"
+
+    async def fetch(batch):
+        """Return the contents of a batch of paths, with False for binary files."""
+        contents = {}
+        if cache:
+            for path in batch:
+                cached = await cache.get(cache_key(ref, path))
+                if cached is not None:
+                    metrics.count("blob_cache_hits")
+                    contents[path] = cached
+        misses = [path for path in batch if path not in contents]
+        downloaded = None
+        if misses and graphql:
+            try:
+                blobs = await get_blobs_graphql(
+                    owner, repo, expressions=[f"{ref}:{path}" for path in misses],
+                    headers=headers,
+                )
+                downloaded = [blob_text(blob, max_size) for blob in blobs]
+                incomplete = [i for i, blob in enumerate(blobs) if is_incomplete(blob, max_size)]
+                refetched = await asyncio.gather(*(download(misses[i]) for i in incomplete))
+                for i, content in zip(incomplete, refetched):
+                    downloaded[i] = content
+                for path, blob in zip(misses, blobs):
+                    if blob and blob.get("byteSize", 0) > max_size:
+                        too_large(path)
+            except (GraphQLError, httpx.HTTPError) as e:
+                logger.info(f"GraphQL fetch failed, falling back to REST: {e!r}")
+        if downloaded is None:
+            downloaded = await asyncio.gather(*(download(path) for path in misses))
+        for path, content in zip(misses, downloaded):
+            if content is None:
+                logger.info(f"Skipping {path}: not found or too large")
+                continue
+            contents[path] = content
+            if cache:
+                await cache.set(cache_key(ref, path), content)
+        if budget is not None:
+            for path, content in contents.items():
+                if content is not False:
+                    lines = budget.keep(path, content)
+                    contents[path] = False if lines is None else lines
+        return contents
+
+    async def download(path):
+        url = f"https://api.github.com/repos/{owner}/{repo}/contents/{quote(path)}"
+        async with semaphore:
+            async with get_http_client().stream(
+                "GET", url, headers=raw_headers, params={"ref": ref}
+            ) as response:
+                if response.status_code != 200:
+                    logger.info(f"Skipping {path}: status code {response.status_code}")
+                    return None
+                if int(response.headers.get("content-length", 0)) > max_size:
+                    too_large(path)
+                    return None
+                raw = await response.aread()
+        if len(raw) > max_size:
+            too_large(path)
+            return None
+        content = decode_file_content(raw)
+        return False if content is None else content
+
+    batch_size = GRAPHQL_BATCH_SIZE if graphql else 1
+    tasks, batch = [], []
+
+    def flush():
+        tasks.append(asyncio.ensure_future(fetch(batch[:])))
+        batch.clear()
+
+    async def each_path():
+        if hasattr(paths, "__aiter__"):
+            async for path in paths:
+                yield path
+        else:
+            for path in paths:
+                yield path
+
+    async for path in each_path():
+        batch.append(path)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    files = {}
+    for contents in await asyncio.gather(*tasks):
+        files.update(
+            (path, content) for path, content in contents.items() if content is not False
+        )
+    return files
+
+
+async def get_pr_head(pr, headers):
+    """Return the `head` of the PR, with its branch `ref` and commit `sha`."""
     original_url = pr.get("url")
     parts = original_url.split("/")
     owner, repo, pr_number = parts[-4], parts[-3], parts[-1]
     url = f"https://api.github.com/repos/{owner}/{repo}/pulls/{pr_number}"
 
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url, headers=headers)
+    response = await get_http_client().get(url, headers=headers)
 
-        # Check if the response is successful
-        if response.status_code != 200:
-            print(f"Error: Received status code {response.status_code}")
-            print("Response body:", response.text)
-            return ''
+    # Check if the response is successful
+    if response.status_code != 200:
+        logger.info(f"Couldn't get the PR head: {response.status_code} {response.text}")
+        return {}
 
-        # Safely get the 'ref'
-        data = response.json()
-        head_data = data.get('head', {})
-        ref = head_data.get('ref', '')
-        return ref
+    data = response.json()
+    return data.get('head', {})
 
 
-def files_to_diff_dict(diff):
-    files_with_diff = {}
-    current_file = None
-    for line in diff.split("\n"):
+async def get_pr_head_branch(pr, headers):
+    head = await get_pr_head(pr, headers)
+    return head.get('ref', '')
+
+
+def matches_filter(path, files_to_keep):
+    """Whether `path` contains one of the `files_to_keep` patterns, if any are given."""
+    return not files_to_keep or any(sub in path for sub in files_to_keep)
+
+
+class DiffParser:
+    """Incremental unified diff parser, fed one line at a time.
+
+    `feed` returns a `(file, added)` tuple whenever a file section is complete,
+    and `close` returns the last one. `added` holds the 0-based line numbers
+    of the added lines in the new file, or `(line_number, text)` tuples if
+    `with_text` is set. Files that don't match `files_to_keep` are ignored
+    without collecting their lines, and so are binary and deleted files if
+    `skip_empty` is set, together with any other file without added lines.
+
+    If an `unchanged` dict is given, it's filled with the added lines of
+    each file whose block of removed and added lines only differs in
+    whitespace, e.g. because a paragraph was reflowed.
+    """
+
+    def __init__(
+            self, files_to_keep=None, skip_empty=True, with_text=False, unchanged=None
+        ):
+        self.files_to_keep = files_to_keep
+        self.skip_empty = skip_empty
+        self.with_text = with_text
+        self.unchanged = unchanged
+        self.file = None
+        self.added = []
+        self.skipping = True
+        self.in_hunk = False
+        self.line_number = 0
+        self.block_removed = []
+        self.block_added = []
+        self.file_unchanged = []
+
+    def _end_block(self):
+        if self.block_added and (
+            " ".join(" ".join(self.block_removed).split())
+            == " ".join(" ".join(text for _, text in self.block_added).split())
+        ):
+            self.file_unchanged.extend(number for number, _ in self.block_added)
+        self.block_removed, self.block_added = [], []
+
+    def _finish(self):
+        self._end_block()
+        file, added, unchanged = self.file, self.added, self.file_unchanged
+        self.file, self.added, self.file_unchanged = None, [], []
+        if file is None or self.skipping or (self.skip_empty and not added):
+            return None
+        if self.unchanged is not None and unchanged:
+            self.unchanged[file] = unchanged
+        return file, added
+
+    def feed(self, line):
+        line = line.rstrip("\r\n")
         if line.startswith("diff --git"):
-            current_file = line.split(" ")[2][2:]
-            files_with_diff[current_file] = {"text": []}
-        elif line.startswith("+") and not line.startswith("+++"):
-            files_with_diff[current_file]["text"].append(line[1:])
-    return files_with_diff
+            finished = self._finish()
+            self.file = line.split(" ")[2][2:]
+            self.skipping = not matches_filter(self.file, self.files_to_keep)
+            self.in_hunk = False
+            self.line_number = 0
+            return finished
+        if self.skipping:
+            return None
+        if not self.in_hunk:
+            if self.skip_empty and (
+                line.startswith("deleted file mode") or line.startswith("Binary files")
+            ):
+                self.skipping = True
+            elif line.startswith("@@"):
+                self.in_hunk = True
+                self.line_number = int(line.split(" ")[2].split(",")[0][1:]) - 1
+            return None
+        if line.startswith("@@"):
+            self._end_block()
+            self.line_number = int(line.split(" ")[2].split(",")[0][1:]) - 1
+        elif line.startswith("+"):
+            self.added.append(
+                (self.line_number, line[1:]) if self.with_text else self.line_number
+            )
+            if self.unchanged is not None:
+                self.block_added.append((self.line_number, line[1:]))
+            self.line_number += 1
+        elif line.startswith("-"):
+            if self.unchanged is not None:
+                self.block_removed.append(line[1:])
+        elif not line.startswith("\\"):
+            self._end_block()
+            self.line_number += 1
+        return None
+
+    def close(self):
+        return self._finish()
+
+
+def iter_diff_files(
+        lines, files_to_keep=None, skip_empty=True, with_text=False, unchanged=None
+    ):
+    """Yield `(file, added)` tuples from an iterable of diff lines, see `DiffParser`."""
+    parser = DiffParser(files_to_keep, skip_empty, with_text, unchanged)
+    for line in lines:
+        finished = parser.feed(line)
+        if finished:
+            yield finished
+    finished = parser.close()
+    if finished:
+        yield finished
+
+
+async def aiter_diff_files(
+        lines, files_to_keep=None, skip_empty=True, with_text=False, unchanged=None
+    ):
+    """Like `iter_diff_files`, but for async iterables such as `response.aiter_lines()`.
+
+    Each file is yielded as soon as its section of the diff has arrived, so
+    callers can start working on it while the rest is still downloading.
+    """
+    parser = DiffParser(files_to_keep, skip_empty, with_text, unchanged)
+    async for line in lines:
+        finished = parser.feed(line)
+        if finished:
+            yield finished
+    finished = parser.close()
+    if finished:
+        yield finished
+
+
+def files_to_diff_dict(diff):
+    return {
+        file: {"text": [text for _, text in added]}
+        for file, added in iter_diff_files(
+            io.StringIO(diff), skip_empty=False, with_text=True
+        )
+    }
 
 
 def parse_diff_to_line_numbers(diff):
-    files_with_line_numbers = {}
-    current_file = None
-    line_number = 0
-    for line in diff.split("\n"):
-        if line.startswith("diff --git"):
-            current_file = line.split(" ")[2][2:]
-            files_with_line_numbers[current_file] = []
-            line_number = 0
-        elif line.startswith("@@"):
-            line_number = int(line.split(" ")[2].split(",")[0][1:]) - 1
-        elif line.startswith("+") and not line.startswith("+++"):
-            files_with_line_numbers[current_file].append(line_number)
-            line_number += 1
-        elif not line.startswith("-"):
-            line_number += 1
-    return files_with_line_numbers
-
-
-def get_context_from_files(files, files_with_line_numbers, context_lines=2):
+    return dict(iter_diff_files(io.StringIO(diff), skip_empty=False))
+
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model):
+    """The `tiktoken` encoding of the model, or None if it can't be loaded."""
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads encodings on first use, which fails offline.
+        logger.info(f"Can't load a tokenizer for {model!r}, estimating tokens: {e!r}")
+        return None
+
+
+def estimate_tokens(text, model=None):
+    """Estimate the number of LLM tokens in a text.
+
+    Uses `tiktoken`, and roughly four characters per token if it's not
+    installed or its encoding can't be loaded.
+    """
+    encoding = get_encoding(model or "") if tiktoken is not None else None
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def merge_line_ranges(lines, context_lines, num_lines):
+    """Merge the context windows around the given lines into disjoint ranges.
+
+    Returns a sorted list of `[start, end)` ranges of 0-based line indices,
+    where adjacent or overlapping windows are coalesced into one range.
+    """
+    ranges = []
+    for line in sorted(lines):
+        start = max(line - context_lines, 0)
+        end = min(line + context_lines + 1, num_lines)
+        if start >= end:
+            continue
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], end)
+        else:
+            ranges.append([start, end])
+    return ranges
+
+
+def split_line_range(file_content, start, end, max_tokens, model=None):
+    """Split the lines `[start, end)` into ranges of at most `max_tokens` tokens each."""
+    ranges = []
+    tokens = 0
+    for line, text in enumerate(file_content[start:end], start):
+        line_tokens = estimate_tokens(text, model)
+        if line > start and tokens + line_tokens > max_tokens:
+            ranges.append((start, line))
+            start, tokens = line, 0
+        tokens += line_tokens
+    ranges.append((start, end))
+    return ranges
+
+
+def get_context_from_files(
+        files, files_with_line_numbers, context_lines=2, max_tokens=None, model=None
+    ):
+    """Extract the changed lines of each file with some surrounding context.
+
+    Overlapping context windows are merged into one snippet per range, and
+    ranges estimated at more than `max_tokens` tokens are split up. Each
+    snippet is a dict with its 1-based `start_line`, inclusive `end_line`
+    and `text`. Files can be strings or `SpooledLines`, of which only the
+    lines of the snippets are read.
+    """
     context_data = {}
     for file, lines in files_with_line_numbers.items():
-        file_content = files[file].split("\n")
+        if file not in files:
+            continue
+        file_content = files[file]
+        if isinstance(file_content, str):
+            file_content = file_content.split("\n")
         context_data[file] = []
-        for line in lines:
-            start = max(line - context_lines, 0)
-            end = min(line + context_lines + 1, len(file_content))
-            context_data[file].append('\n'.join(file_content[start:end]))
+        for start, end in merge_line_ranges(lines, context_lines, len(file_content)):
+            if max_tokens:
+                ranges = split_line_range(file_content, start, end, max_tokens, model)
+            else:
+                ranges = [(start, end)]
+            for snippet_start, snippet_end in ranges:
+                context_data[file].append({
+                    "start_line": snippet_start + 1,
+                    "end_line": snippet_end,
+                    "text": '\n'.join(file_content[snippet_start:snippet_end]),
+                })
     return context_data